@@ -27,15 +27,19 @@ ENV = env = environ.Env(
 )
 
 environ.Env.read_env(os.path.join(BASE_DIR, 'irpf.env'))
-try:
-    locale.setlocale(locale.LC_ALL, "pt_BR.UTF-8")
-except locale.Error:
-    ...
+if locale.getlocale(locale.LC_TIME) != ("pt_BR", "UTF-8"):
+    try:
+        locale.setlocale(locale.LC_ALL, "pt_BR.UTF-8")
+    except locale.Error:
+        ...
 PYTHON_IO_ENCODING = ENV.str('PYTHON_IO_ENCODING', default="utf-8")
 
-sys.stderr.reconfigure(encoding=PYTHON_IO_ENCODING)
-sys.stdout.reconfigure(encoding=PYTHON_IO_ENCODING)
-sys.stdin.reconfigure(encoding=PYTHON_IO_ENCODING)
+# reconfigura apenas os streams com outra codificação (ou sem suporte, ex: redirecionados por ferramentas)
+for _stream in (sys.stderr, sys.stdout, sys.stdin):
+    if (getattr(_stream, "encoding", None) or "").lower() != PYTHON_IO_ENCODING.lower() and \
+            hasattr(_stream, "reconfigure"):
+        _stream.reconfigure(encoding=PYTHON_IO_ENCODING)
+del _stream
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/3.2/howto/deployment/checklist/
@@ -49,7 +53,7 @@ DEBUG = env('DEBUG')
 ALLOWED_HOSTS = env.list("ALLOWED_HOSTS", default=["*"])
 
 # verão do projeto
-IRPF_VERSION = '1.0.0'
+IRPF_VERSION = '1.1.0'
 
 XADMIN_TITLE = "B3 - IRPF"
 XADMIN_FOOTER_TITLE = f'irpf - v{IRPF_VERSION}'
@@ -82,6 +86,17 @@ INSTALLED_APPS = [
 
 TICKER_VALIDATOR = "irpf.utils.ticker_validator"
 
+# processos usados na extração de dados das notas de corretagem (importação em lote)
+IRPF_BROKERAGE_NOTE_WORKERS = ENV.int("IRPF_BROKERAGE_NOTE_WORKERS", default=os.cpu_count() or 1)
+
+# armazenamento dos valores monetários: "decimal" (padrão) ou "integer" (inteiro escalado por 10^IRPF_MONEY_SCALE)
+# A troca em um banco existente requer o comando "money_storage" (dump -> migrate -> load).
+IRPF_MONEY_STORAGE = ENV.str("IRPF_MONEY_STORAGE", default="decimal")
+IRPF_MONEY_SCALE = ENV.int("IRPF_MONEY_SCALE", default=8)
+
+# cache das planilhas abertas no visualizador de arquivos excel
+IRPF_XLSX_VIEWER_CACHE_DIR = ENV.str("IRPF_XLSX_VIEWER_CACHE_DIR", default=str(BASE_DIR.joinpath("cache", "xlsx")))
+
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend', # this is default
     'guardian.backends.ObjectPermissionBackend',
@@ -121,6 +136,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'irpf.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'b3irpf.urls'
@@ -150,6 +166,37 @@ WSGI_APPLICATION = 'b3irpf.wsgi.application'
 DATABASES = {
     'default': env.db(default=f"sqlite:////{BASE_DIR / 'irpf.sqlite3'}")
 }
+# conexões persistentes (segundos; 0 fecha a cada requisição) com verificação no início da requisição
+DATABASES['default'].setdefault('CONN_MAX_AGE', ENV.int("CONN_MAX_AGE", default=60))
+DATABASES['default'].setdefault('CONN_HEALTH_CHECKS', ENV.bool("CONN_HEALTH_CHECKS", default=True))
+
+CACHES = {
+    'default': env.cache("CACHE_URL", default="locmemcache://")
+}
+
+# cálculo do preço médio nos relatórios: "python" (registro a registro) ou "sql" (agregação no banco)
+IRPF_REPORT_ENGINE = ENV.str("IRPF_REPORT_ENGINE", default="python")
+
+# cache de resultados de relatórios (segundos)
+IRPF_REPORT_CACHE_TIMEOUT = ENV.int("IRPF_REPORT_CACHE_TIMEOUT", default=3600)
+
+# geração única de relatórios simultâneos: travas entre processos e espera máxima (segundos)
+IRPF_REPORT_LOCK_DIR = ENV.str("IRPF_REPORT_LOCK_DIR", default=str(BASE_DIR.joinpath("cache", "locks")))
+IRPF_REPORT_SINGLE_FLIGHT_TIMEOUT = ENV.int("IRPF_REPORT_SINGLE_FLIGHT_TIMEOUT", default=300)
+
+# relatórios gerados ao mesmo tempo por usuário (0 sem limite) e prazo da geração (segundos; 0 sem prazo)
+IRPF_REPORT_MAX_RUNNING = ENV.int("IRPF_REPORT_MAX_RUNNING", default=2)
+IRPF_REPORT_TIMEOUT = ENV.int("IRPF_REPORT_TIMEOUT", default=300)
+
+# meses de estatísticas calculados no relatório sem registro salvo (0 sem limite; acima disso 'stats_backfill')
+IRPF_STATS_BACKFILL_MAX_MONTHS = ENV.int("IRPF_STATS_BACKFILL_MAX_MONTHS", default=24)
+
+# perfil (cProfile) das views de relatório e importação: fração amostrada (0 desativa) e
+# segundos de uma requisição lenta (0 desativa; a próxima requisição da mesma view é perfilada)
+IRPF_PROFILING_SAMPLE_RATE = ENV.float("IRPF_PROFILING_SAMPLE_RATE", default=0.0)
+IRPF_PROFILING_SLOW = ENV.float("IRPF_PROFILING_SLOW", default=0)
+IRPF_PROFILING_DIR = ENV.str("IRPF_PROFILING_DIR", default=str(BASE_DIR.joinpath("cache", "profiles")))
+IRPF_PROFILING_MAX_FILES = ENV.int("IRPF_PROFILING_MAX_FILES", default=200)
 
 
 # Password validation
@@ -4,7 +4,6 @@ from django.contrib.auth import get_permission_codename
 from django.core.management import call_command
 from django.forms import ModelForm
 
-from correpy.parsers.brokerage_notes.b3_parser.nuinvest import NunInvestParser
 from irpf import permissions
 from irpf.models import Asset, Negotiation, Earnings, Position, Institution, Bonus, Bookkeeping, \
 	BrokerageNote, AssetEvent, FoundsAdministrator, Taxes, Subscription, BonusInfo, TaxRate, DayTrade, \
@@ -15,9 +14,12 @@ from irpf.report.earnings import EarningsReportMonth
 from irpf.report.negotiation import NegotiationReportMonth
 from irpf.themes import themes
 from irpf.utils import MonthYearDates
+from irpf.views.brokerage_note import AdminBrokerageNoteImportView
 from irpf.views.import_list import AdminImportListModelView
-from irpf.views.report_irpf import ReportIRPFFAdminView
-from irpf.views.xlsx_viewer import AdminXlsxViewer
+from irpf.views.profiling import AdminProfilesView
+from irpf.views.report_irpf import ReportIRPFFAdminView, ReportIRPFExportAdminView, ReportIRPFApiAdminView, \
+	ReportIRPFAssetAdminView
+from irpf.views.xlsx_viewer import AdminXlsxViewer, AdminXlsxViewerData
 from irpf.widgets import MonthYearField, MonthYearWidget
 from moneyfield import MoneyModelForm
 from xadmin import sites, site
@@ -25,7 +27,16 @@ from xadmin.views import ListAdminView, ModelFormAdminView, BaseAdminView
 
 site.register_view("^irpf/import/(?P<model_app_label>.+)/$", AdminImportListModelView, "import_listmodel")
 site.register_view("^irpf/report/(?P<model_app_label>.+)/$", ReportIRPFFAdminView, "reportirpf")
+site.register_view("^irpf/export/(?P<model_app_label>[^/]+)/(?P<export_name>[a-z]+)/(?P<export_format>[a-z]+)/$",
+                   ReportIRPFExportAdminView, "reportirpf_export")
+site.register_view("^irpf/fragment/report/(?P<model_app_label>[^/]+)/$", ReportIRPFAssetAdminView,
+                   "reportirpf_asset")
+site.register_view("^irpf/api/report/(?P<model_app_label>[^/]+)/$", ReportIRPFApiAdminView, "reportirpf_api")
+site.register_view("^irpf/xlsx/viewer/data/(?P<key>[0-9a-f]{64})/(?P<sheet>[0-9]+)/$", AdminXlsxViewerData,
+                   "xlsx_viewer_data")
 site.register_view("^irpf/xlsx/viewer", AdminXlsxViewer, "xlsx_viewer")
+site.register_view("^irpf/brokeragenote/import/$", AdminBrokerageNoteImportView, "brokerage_note_import")
+site.register_view("^irpf/profiles/$", AdminProfilesView, "profiles")
 
 site.register_plugin(ListActionModelPlugin, ListAdminView)
 site.register_plugin(GuardianAdminPlugin, ListAdminView)
@@ -37,6 +48,27 @@ site.register_plugin(BreadcrumbMonthsAdminPlugin, ReportIRPFFAdminView)
 site.register_plugin(BrokerageNoteAdminPlugin, ModelFormAdminView)
 
 
+# parsers por cnpj da corretora (importados no primeiro uso)
+brokerage_note_parsers = {
+	# NU INVEST CORRETORA DE VALORES S.A.
+	'62169875000179': "correpy.parsers.brokerage_notes.b3_parser.nuinvest.NunInvestParser"
+}
+brokerage_note_field_update = [
+	'reference_id',
+	'reference_date',
+	'settlement_fee',
+	'registration_fee',
+	'term_fee',
+	'ana_fee',
+	'emoluments',
+	'operational_fee',
+	'execution',
+	'custody_fee',
+	'taxes',
+	'others'
+]
+
+
 def _get_field_opts(name, model):
 	return model._meta.get_field(name)
 
@@ -52,6 +84,13 @@ class ReportIRPFFAdminViewOptions:
 	}
 
 
+@sites.register(AdminBrokerageNoteImportView)
+class AdminBrokerageNoteImportViewOptions:
+	guardian_permissions_models = permissions.permission_models
+	brokerage_note_parsers = brokerage_note_parsers
+	brokerage_note_field_update = brokerage_note_field_update
+
+
 @sites.register(BaseAdminView)
 class BaseSetting:
 	enable_themes = True
@@ -168,7 +207,9 @@ class AssetAdmin:
 			return super().save_models()
 		finally:
 			try:
-				call_command("setup_assets")
+				if (new_obj := getattr(self, "new_obj", None)) and new_obj.code:
+					# vincula somente os registros do ativo criado/alterado
+					call_command("setup_assets", codes=[new_obj.code])
 			except Exception as exc:
 				self.message_user(f"Falha atualizando assets: {exc}")
 
@@ -238,25 +279,13 @@ class BrokerageNoteAdmin(BaseIRPFAdmin):
 		'institution',
 		'reference_date'
 	)
-	brokerage_note_parsers = {
-		# NU INVEST CORRETORA DE VALORES S.A.
-		'62169875000179': NunInvestParser
-	}
-	brokerage_note_field_update = [
-		'reference_id',
-		'reference_date',
-		'settlement_fee',
-		'registration_fee',
-		'term_fee',
-		'ana_fee',
-		'emoluments',
-		'operational_fee',
-		'execution',
-		'custody_fee',
-		'taxes',
-		'others'
-	]
+	brokerage_note_parsers = brokerage_note_parsers
+	brokerage_note_field_update = brokerage_note_field_update
 	inlines = [NegotiationInline]
+	# ListActionModelPlugin
+	list_action_activate = True
+	list_action_report = False
+	list_action_import_view = "brokerage_note_import"
 
 	def negotiation_count(self, instance):
 		"""Informa de total de ativos vinculados a nota"""
@@ -8,6 +8,13 @@ class IrpfConfig(AppConfig):
 
 	def ready(self):
 		from irpf.models import DayTrade, SwingTrade
+		from django.core.signals import request_started
+		from irpf import signals
+		from irpf.db import close_unusable_connections
+
+		signals.connect()
+		request_started.connect(close_unusable_connections,
+		                        dispatch_uid="irpf_close_unusable_connections")
 
 		DayTrade.setup_defaults()
 		SwingTrade.setup_defaults()
@@ -0,0 +1,560 @@
+import collections
+import datetime
+import functools
+import hashlib
+import importlib.metadata
+import io
+import itertools
+import logging
+import os
+import pickle
+import re
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_permission_codename
+from django.core.exceptions import PermissionDenied
+from django.core.files.base import ContentFile
+from django.db.transaction import atomic
+from django.utils.crypto import salted_hmac, constant_time_compare
+from django.utils.module_loading import import_string
+from guardian.shortcuts import assign_perm
+
+from correpy.domain.entities.brokerage_note import BrokerageNote as Note
+from correpy.domain.entities.security import Security
+from correpy.domain.entities.transaction import Transaction
+from correpy.domain.enums import TransactionType
+from irpf.fields import normalize_ticker
+from irpf.models import BrokerageNote, Negotiation, Asset, Institution, DataVersion, MonthlyTradeSummary, \
+	ReportCheckpoint, Statistic
+from irpf.permissions import permission_models
+from irpf.report.utils import MoneyLC, TransactionGroup
+
+logger = logging.getLogger("irpf.brokerage_note")
+
+# parser padrão (correpy/PyMuPDF são importados apenas no primeiro uso)
+DEFAULT_PARSER = "correpy.parsers.brokerage_notes.b3_parser.b3_parser.B3Parser"
+
+
+def get_parser_class(parsers: dict, institution: Institution):
+	"""Parser da nota para a corretora (classe ou caminho 'modulo.Classe')"""
+	try:
+		parser = parsers[institution.cnpj_nums]
+	except (KeyError, TypeError):
+		parser = DEFAULT_PARSER
+	if isinstance(parser, str):
+		parser = import_string(parser)
+	return parser
+
+
+def parse_brokerage_note(parser_class, content: bytes) -> list[Note]:
+	"""Extrai as notas do arquivo (executada também nos processos de trabalho)"""
+	parser = parser_class(brokerage_note=io.BytesIO(content))
+	return list(parser.parse_brokerage_note())
+
+
+NoteHeader = collections.namedtuple("NoteHeader", ("reference_id", "reference_date"))
+
+
+def read_note_header(parser_class, content: bytes):
+	"""Número e data do pregão lidos somente da primeira página da nota (sem a extração completa)
+	Segue a mesma regra de localização do parser (correpy). Retorna None quando não for possível.
+	"""
+	import fitz
+	try:
+		with fitz.open(stream=content, filetype="pdf") as doc:
+			page = doc[0]
+			if not (rects := page.search_for(parser_class.REFERENCE_NOTE_ID)):
+				return None
+			reference_rect = rects[0]
+			if rects := page.search_for(parser_class.CI_TITLE):
+				ci_rect = rects[0]
+			else:
+				ci_rect = fitz.Rect(reference_rect.x0, reference_rect.y0,
+				                    page.rect.width, page.rect.height * 0.25)
+			rect = reference_rect | ci_rect
+			words = [word for word in page.get_text("words")
+			         if fitz.Rect(word[:4]).intersects(rect)]
+		# palavras agrupadas por linha (y1 arredondado) e ordenadas por coluna (x0)
+		words.sort(key=lambda word: (round(word[3]), word[0]))
+		lines = [" ".join(word[4] for word in items)
+		         for _, items in itertools.groupby(words, key=lambda word: round(word[3]))]
+		if (match := re.search(r"^\D*(\d+)", lines[1])) is None:
+			return None
+		reference_date = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", "".join(lines))[0]
+		return NoteHeader(int(match.group(1)), datetime.datetime.strptime(reference_date, "%d/%m/%Y").date())
+	except (ValueError, IndexError, fitz.FileDataError):
+		# layout diferente do esperado ou arquivo inválido (a nota é extraída por completo)
+		return None
+	except Exception:
+		logger.exception("note header not read (%s)", parser_class.__name__)
+		return None
+
+
+def get_content_hash(content: bytes) -> str:
+	"""Hash (sha256) do conteúdo do arquivo da nota"""
+	return hashlib.sha256(content).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def get_correpy_version() -> str:
+	"""Versão instalada do correpy (as correções do parser invalidam o cache de notas)"""
+	try:
+		return importlib.metadata.version("correpy")
+	except importlib.metadata.PackageNotFoundError:
+		return "0"
+
+
+class BrokerageNoteParseCache:
+	"""Cache dos dados extraídos das notas (por requisição e persistente)
+	Indexado pelo hash do conteúdo do arquivo, pelo parser usado na extração e pela versão do correpy.
+	"""
+	storage_path = "notes/cache"
+	key_salt = "irpf.brokerage_note.BrokerageNoteParseCache"
+	# formato dos dados gravados
+	version = 1
+
+	def __init__(self, storage=None):
+		if storage is None:
+			storage = BrokerageNote._meta.get_field("note").storage
+		self.storage = storage
+		self.results = {}
+
+	def get_key(self, parser_class, content_hash: str) -> str:
+		return f"{content_hash}.{parser_class.__name__.lower()}.{get_correpy_version()}.v{self.version}"
+
+	def get_path(self, key: str) -> str:
+		return f"{self.storage_path}/{key}.bin"
+
+	def _signature(self, data: bytes) -> bytes:
+		return salted_hmac(self.key_salt, data, algorithm="sha256").digest()
+
+	def _dumps(self, notes: list[Note]) -> bytes:
+		data = zlib.compress(pickle.dumps(notes, protocol=pickle.HIGHEST_PROTOCOL))
+		return self._signature(data) + data
+
+	def _loads(self, data: bytes) -> list[Note]:
+		signature, data = data[:32], data[32:]
+		# somente dados gerados pelo projeto (pickle)
+		if not constant_time_compare(signature, self._signature(data)):
+			raise ValueError("invalid signature")
+		return pickle.loads(zlib.decompress(data))
+
+	def get(self, parser_class, content_hash: str):
+		key = self.get_key(parser_class, content_hash)
+		try:
+			return self.results[key]
+		except KeyError:
+			pass
+		try:
+			with self.storage.open(self.get_path(key), 'rb') as fp:
+				notes = self._loads(fp.read())
+		except Exception:
+			return None
+		self.results[key] = notes
+		return notes
+
+	def set(self, parser_class, content_hash: str, notes: list[Note]):
+		key = self.get_key(parser_class, content_hash)
+		self.results[key] = notes
+		path = self.get_path(key)
+		try:
+			if not self.storage.exists(path):
+				self.storage.save(path, ContentFile(self._dumps(notes)))
+		except OSError:
+			# a falha no cache não impede o registro da nota
+			pass
+
+	def delete(self, content_hash: str):
+		"""Remove os dados gravados do arquivo (todos os parsers e versões)"""
+		try:
+			_, filenames = self.storage.listdir(self.storage_path)
+		except OSError:
+			return
+		for filename in filenames:
+			if filename.startswith(f"{content_hash}."):
+				self.storage.delete(f"{self.storage_path}/{filename}")
+		for key in [key for key in self.results if key.startswith(f"{content_hash}.")]:
+			del self.results[key]
+
+	def parse(self, parser_class, content: bytes, content_hash: str = None) -> list[Note]:
+		"""Extrai os dados da nota somente quando não estão no cache"""
+		if content_hash is None:
+			content_hash = get_content_hash(content)
+		if (notes := self.get(parser_class, content_hash)) is None:
+			notes = parse_brokerage_note(parser_class, content)
+			self.set(parser_class, content_hash, notes)
+		return notes
+
+
+def get_clean_ticker(transaction: Transaction) -> str:
+	"""Retorna o ticker (code) simplificado"""
+	return normalize_ticker(transaction.security.ticker)
+
+
+def get_transaction_kind(transaction: Transaction, model=Negotiation):
+	"""Categoria da negociação (compra, venda) da transação"""
+	if transaction.transaction_type == TransactionType.BUY:
+		kind = model.KIND_BUY
+	elif transaction.transaction_type == TransactionType.SELL:
+		kind = model.KIND_SELL
+	else:
+		kind = None
+	return kind
+
+
+def get_transactions_group(note_transactions: list[Transaction]) -> collections.OrderedDict:
+	"""Agrupa transações que pertençam ao mesmo ativo (com compra e venda separado)"""
+	results = collections.OrderedDict()
+
+	def transaction_group_by(tns: Transaction):
+		return get_clean_ticker(tns), tns.transaction_type
+
+	for (ticker, transaction_type), items in itertools.groupby(note_transactions, key=transaction_group_by):
+		ts = TransactionGroup()
+		# soma as quantidade e totais para cada categoria (compra, venda)
+		# calcula o preço médio final com base no total de todas as negociações do ativo
+		for transaction in items:
+			ts.quantity += transaction.amount
+			ts.total += transaction.amount * transaction.unit_price
+
+		results[ticker] = Transaction(
+			transaction_type=transaction_type,
+			amount=ts.quantity,
+			unit_price=ts.avg_price,
+			security=Security(ticker)
+		)
+	return results
+
+
+def get_note_tax(note: Note):
+	"""Total de taxas da nota (rateadas entre as negociações)"""
+	return sum([note.settlement_fee,
+	            note.term_fee,
+	            note.ana_fee,
+	            note.registration_fee,
+	            note.taxes,
+	            note.emoluments,
+	            note.others])
+
+
+def assign_object_perms(user, model, queryset, permissions=None):
+	"""Configura permissões de objeto (em lote) para o usuário"""
+	if permissions is None:
+		permissions = permission_models
+	opts = model._meta
+	for perm_name in permissions[model]:
+		permission_codename = f"{opts.app_label}.{get_permission_codename(perm_name, opts)}"
+		# tem que ter permissão de modelo para ter permissão de objeto
+		if user.has_perm(permission_codename):
+			assign_perm(permission_codename, user, queryset)
+		else:
+			raise PermissionDenied(permission_codename)
+
+
+class NoteFile:
+	"""Arquivo de nota de corretagem e o resultado da extração de dados"""
+
+	def __init__(self, name: str, content: bytes):
+		self.name = name
+		self.content = content
+		self.content_hash = get_content_hash(content)
+		self.notes: list[Note] = []
+		self.instance: BrokerageNote = None
+		self.error = None
+
+	@property
+	def is_valid(self):
+		return self.error is None
+
+	def __str__(self):
+		return self.name
+
+
+def iter_note_files(files):
+	"""Arquivos de notas (pdf), incluindo os compactados (zip)"""
+	for file in files:
+		content = file.read()
+		if zipfile.is_zipfile(io.BytesIO(content)):
+			with zipfile.ZipFile(io.BytesIO(content)) as zf:
+				for info in zf.infolist():
+					if info.is_dir() or not info.filename.lower().endswith(".pdf"):
+						continue
+					yield NoteFile(os.path.basename(info.filename), zf.read(info))
+		else:
+			yield NoteFile(os.path.basename(file.name), content)
+
+
+class BrokerageNoteParserPool:
+	"""Extração dos dados de várias notas usando um conjunto de processos"""
+
+	def __init__(self, max_workers: int = None, cache: BrokerageNoteParseCache = None):
+		if max_workers is None:
+			max_workers = getattr(settings, "IRPF_BROKERAGE_NOTE_WORKERS", None) or os.cpu_count() or 1
+		if cache is None:
+			cache = BrokerageNoteParseCache()
+		self.max_workers = max_workers
+		self.cache = cache
+
+	def parse(self, parser_class, note_files: list[NoteFile]) -> list[NoteFile]:
+		# somente os arquivos ainda não processados
+		pending = []
+		for note_file in note_files:
+			if (notes := self.cache.get(parser_class, note_file.content_hash)) is None:
+				pending.append(note_file)
+			else:
+				note_file.notes = notes
+		if self.max_workers < 2 or len(pending) < 2:
+			for note_file in pending:
+				try:
+					note_file.notes = parse_brokerage_note(parser_class, note_file.content)
+				except Exception as exc:
+					note_file.error = exc
+		else:
+			max_workers = min(self.max_workers, len(pending))
+			with ProcessPoolExecutor(max_workers=max_workers) as executor:
+				futures = [(note_file, executor.submit(parse_brokerage_note, parser_class, note_file.content))
+				           for note_file in pending]
+				for note_file, future in futures:
+					try:
+						note_file.notes = future.result()
+					except Exception as exc:
+						note_file.error = exc
+		for note_file in pending:
+			if note_file.is_valid:
+				self.cache.set(parser_class, note_file.content_hash, note_file.notes)
+		return note_files
+
+
+class NegotiationMatcher:
+	"""Vincula as transações das notas às negociações já registradas
+	Uma consulta para todas as datas das notas e atualização em lote.
+	"""
+	negotiation_model = Negotiation
+	asset_model = Asset
+	trade_summary_model = MonthlyTradeSummary
+	checkpoint_model = ReportCheckpoint
+	statistic_model = Statistic
+
+	def __init__(self, user, institution: Institution, negotiation_model=None, asset_model=None):
+		self.user = user
+		self.institution = institution
+		if negotiation_model is not None:
+			self.negotiation_model = negotiation_model
+		if asset_model is not None:
+			self.asset_model = asset_model
+		self.negotiations = collections.defaultdict(list)
+		self.updated = {}
+		self.unmatched = []
+
+	@staticmethod
+	def get_key(date, code: str, kind: str, quantity) -> tuple:
+		"""Chave de comparação da negociação com a transação da nota"""
+		return date, code, kind.lower(), quantity
+
+	def load(self, dates):
+		"""Negociações (do usuário e corretora) das datas das notas"""
+		queryset = self.negotiation_model.objects.filter(
+			date__in=set(dates),
+			institution_name=self.institution.name,
+			user=self.user
+		)
+		for negotiation in queryset:
+			key = self.get_key(negotiation.date, negotiation.code,
+			                   negotiation.kind, negotiation.quantity)
+			self.negotiations[key].append(negotiation)
+
+	def add(self, note: Note, instance: BrokerageNote):
+		"""Distribui as taxas da nota entre as negociações"""
+		tax = get_note_tax(note)
+		transactions = get_transactions_group(note.transactions)
+		paid = sum([(transactions[ticker].amount * transactions[ticker].unit_price)
+		            for ticker in transactions])
+		for ticker in transactions:
+			transaction = transactions[ticker]
+			if (kind := get_transaction_kind(transaction, self.negotiation_model)) is None:
+				continue
+			# rateio de taxas proporcional ao valor pago
+			avg_tax = MoneyLC(tax * ((transaction.amount * transaction.unit_price) / paid))
+			key = self.get_key(instance.reference_date, ticker, kind, transaction.amount)
+			if negotiations := self.negotiations.get(key):
+				for negotiation in negotiations:
+					negotiation.brokerage_note = instance
+					negotiation.tax = avg_tax
+					self.updated[negotiation.pk] = negotiation
+			else:
+				self.unmatched.append((transaction, instance, ticker, kind, avg_tax))
+
+	def _new_negotiation(self, transaction: Transaction, instance, ticker, kind, tax, assets):
+		return self.negotiation_model(
+			code=ticker,
+			kind=kind,
+			date=instance.reference_date,
+			quantity=transaction.amount,
+			price=transaction.unit_price,
+			total=transaction.amount * transaction.unit_price,
+			tax=tax,
+			brokerage_note=instance,
+			irrf=transaction.source_withheld_taxes,
+			institution_name=self.institution.name,
+			asset=assets.get(ticker),
+			user=self.user
+		)
+
+	@atomic
+	def save(self, save_transactions: bool = False, permissions=None):
+		"""Grava as alterações (e as negociações novas quando 'save_transactions')"""
+		if self.updated:
+			self.negotiation_model.objects.bulk_update(list(self.updated.values()),
+			                                           ['brokerage_note', 'tax'])
+		created = []
+		if save_transactions and self.unmatched:
+			tickers = {ticker for _, _, ticker, _, _ in self.unmatched}
+			assets = self.asset_model.objects.in_bulk(tickers, field_name='code')
+			created = self.negotiation_model.objects.bulk_create([
+				self._new_negotiation(*item, assets=assets) for item in self.unmatched
+			])
+			# nem todos os bancos retornam a chave primária no 'bulk_create'
+			queryset = self.negotiation_model.objects.filter(
+				brokerage_note__in={item[1] for item in self.unmatched},
+				user=self.user
+			).exclude(pk__in=list(self.updated))
+			assign_object_perms(self.user, self.negotiation_model, queryset,
+			                    permissions=permissions)
+		if self.updated or created:
+			# operações em lote não enviam sinais (totais mensais, resultados salvos e cache de relatórios)
+			negotiations = list(itertools.chain(self.updated.values(), created))
+			self.trade_summary_model.refresh(self.user, [
+				self.trade_summary_model.get_key(negotiation) for negotiation in negotiations
+			])
+			date = min(negotiation.date for negotiation in negotiations)
+			self.checkpoint_model.invalidate(self.user, date=date)
+			self.statistic_model.invalidate_cache(self.user, date=date)
+			DataVersion.touch(self.user)
+		return created
+
+
+class BrokerageNoteImporter:
+	"""Importação de várias notas de corretagem de uma mesma corretora"""
+	brokerage_note_model = BrokerageNote
+	parser_pool_class = BrokerageNoteParserPool
+	negotiation_matcher_class = NegotiationMatcher
+
+	def __init__(self, user, institution: Institution, parser_class,
+	             field_update=(), save_transactions: bool = False,
+	             permissions=None, max_workers: int = None):
+		self.user = user
+		self.institution = institution
+		self.parser_class = parser_class
+		self.field_update = field_update
+		self.save_transactions = save_transactions
+		self.permissions = permissions
+		self.max_workers = max_workers
+
+	def _setup_instance(self, note_file: NoteFile) -> bool:
+		"""Cria a instância do modelo com os dados da nota extraída"""
+		if not note_file.is_valid:
+			return False
+		if not note_file.notes:
+			note_file.error = ValueError("nenhuma nota encontrada no arquivo")
+			return False
+		instance = self.brokerage_note_model(user=self.user, institution=self.institution,
+		                                     content_hash=note_file.content_hash)
+		for note in note_file.notes:
+			for field_name in self.field_update:
+				setattr(instance, field_name, getattr(note, field_name))
+		if not (instance.reference_id and instance.reference_date):
+			note_file.error = ValueError("número ou data do pregão não encontrados na nota")
+			return False
+		note_file.instance = instance
+		return True
+
+	def _check_content_duplicates(self, note_files: list[NoteFile]):
+		"""Arquivos já registrados (mesmo conteúdo) dispensam a extração de dados"""
+		registered = set(self.brokerage_note_model.objects.filter(
+			content_hash__in={nf.content_hash for nf in note_files},
+			user=self.user
+		).values_list('content_hash', flat=True))
+		for note_file in note_files:
+			if note_file.content_hash in registered:
+				note_file.error = ValueError("nota já registrada (arquivo idêntico)")
+			registered.add(note_file.content_hash)
+
+	def _check_header_duplicates(self, note_files: list[NoteFile]):
+		"""Notas já registradas identificadas somente pelo cabeçalho (antes da extração completa)"""
+		headers = {}
+		for note_file in note_files:
+			if header := read_note_header(self.parser_class, note_file.content):
+				headers[note_file] = header
+		if not headers:
+			return
+		registered = set(self.brokerage_note_model.objects.filter(
+			reference_date__in={header.reference_date for header in headers.values()},
+			institution=self.institution,
+			user=self.user
+		).values_list('reference_id', 'reference_date'))
+		for note_file, header in headers.items():
+			if header in registered:
+				note_file.error = ValueError(f"nota {header.reference_id} de "
+				                             f"{header.reference_date:%d/%m/%Y} já registrada")
+
+	def _check_duplicates(self, note_files: list[NoteFile]):
+		"""Notas já registradas ou repetidas no lote"""
+		registered = set(self.brokerage_note_model.objects.filter(
+			reference_date__in={nf.instance.reference_date for nf in note_files},
+			institution=self.institution,
+			user=self.user
+		).values_list('reference_id', 'reference_date'))
+		for note_file in note_files:
+			instance = note_file.instance
+			key = (instance.reference_id, instance.reference_date)
+			if key in registered:
+				note_file.error = ValueError(f"nota {instance.reference_id} de "
+				                             f"{instance.reference_date:%d/%m/%Y} já registrada")
+			registered.add(key)
+
+	@atomic
+	def save(self, note_files: list[NoteFile]):
+		for note_file in note_files:
+			note_file.instance.note.save(note_file.name, ContentFile(note_file.content), save=False)
+		self.brokerage_note_model.objects.bulk_create([nf.instance for nf in note_files])
+
+		# nem todos os bancos retornam a chave primária no 'bulk_create'
+		queryset = self.brokerage_note_model.objects.filter(
+			reference_id__in={nf.instance.reference_id for nf in note_files},
+			reference_date__in={nf.instance.reference_date for nf in note_files},
+			institution=self.institution,
+			user=self.user
+		)
+		instances = {(obj.reference_id, obj.reference_date): obj for obj in queryset}
+		for note_file in note_files:
+			note_file.instance = instances[(note_file.instance.reference_id,
+			                                note_file.instance.reference_date)]
+		assign_object_perms(self.user, self.brokerage_note_model,
+		                    queryset.filter(pk__in=[nf.instance.pk for nf in note_files]),
+		                    permissions=self.permissions)
+
+		matcher = self.negotiation_matcher_class(self.user, self.institution)
+		matcher.load([nf.instance.reference_date for nf in note_files])
+		for note_file in note_files:
+			for note in note_file.notes:
+				matcher.add(note, note_file.instance)
+		matcher.save(save_transactions=self.save_transactions,
+		             permissions=self.permissions)
+
+	def import_files(self, files) -> list[NoteFile]:
+		"""Extrai e registra as notas dos arquivos (erros são registrados por arquivo)"""
+		note_files = list(iter_note_files(files))
+		self._check_content_duplicates(note_files)
+		self._check_header_duplicates([nf for nf in note_files if nf.is_valid])
+		pool = self.parser_pool_class(max_workers=self.max_workers)
+		pool.parse(self.parser_class, [nf for nf in note_files if nf.is_valid])
+		valid_files = [nf for nf in note_files if self._setup_instance(nf)]
+		if valid_files:
+			self._check_duplicates(valid_files)
+			valid_files = [nf for nf in valid_files if nf.is_valid]
+		if valid_files:
+			self.save(valid_files)
+		return note_files
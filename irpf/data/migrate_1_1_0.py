@@ -0,0 +1,82 @@
+import sys
+
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.functions import Upper, Trim
+
+from irpf.brokerage_note import get_content_hash
+from irpf.models import Asset, Negotiation, Earnings, BrokerageNote, MonthlyTradeSummary, Position, \
+	ReportCheckpoint, Statistic, DataVersion
+
+
+def merge_assets(code: str, assets: list) -> Asset:
+	"""Move os registros dos ativos duplicados para o ativo com o código normalizado (ou o mais antigo)"""
+	asset = next((obj for obj in assets if obj.code == code), assets[0])
+	duplicates = [obj for obj in assets if obj.pk != asset.pk]
+	users = set()
+	for relation in Asset._meta.related_objects:
+		if not (relation.one_to_many or relation.one_to_one):
+			continue
+		queryset = relation.related_model.objects.filter(**{f"{relation.field.name}__in": duplicates})
+		if hasattr(relation.related_model, 'user'):
+			users.update(queryset.values_list('user', flat=True).distinct())
+		if relation.related_model is Position:
+			# posições são recalculadas pelo relatório (unique_together com o ativo)
+			queryset.delete()
+			continue
+		queryset.update(**{relation.field.name: asset})
+	for user in users:
+		Position.objects.filter(user=user, asset=asset).update(is_valid=False)
+		ReportCheckpoint.invalidate(user)
+		Statistic.invalidate_cache(user)
+		DataVersion.touch(user)
+	for obj in duplicates:
+		obj.delete()
+	return asset
+
+
+def merge_duplicated_assets():
+	"""Ativos com o mesmo código normalizado (ex: 'petr4' e 'PETR4') impedem a atualização (código único)"""
+	queryset = Asset.objects.annotate(code_normalized=Upper(Trim('code')))
+	duplicated = (queryset.order_by().values('code_normalized')
+	              .annotate(count=Count('pk'))
+	              .filter(count__gt=1)
+	              .values_list('code_normalized', flat=True))
+	for code in list(duplicated):
+		assets = list(queryset.filter(code_normalized=code).order_by('pk'))
+		codes = ', '.join(repr(obj.code) for obj in assets)
+		with transaction.atomic():
+			asset = merge_assets(code, assets)
+		print(f"Ativos {codes} unidos no ativo pk={asset.pk}")
+
+
+def init(migration):
+	"""
+	* Une os ativos duplicados pelo código normalizado
+	* Normaliza os códigos de negociação para caixa alta (buscas exatas no lugar de 'iexact')
+	* Hash do conteúdo dos arquivos das notas de corretagem
+	* Tipo (slug) e código de entrada/saída dos proventos
+	* Totais mensais das negociações
+	"""
+	merge_duplicated_assets()
+	for model in (Asset, Negotiation, Earnings):
+		count = model.objects.update(code=Upper(Trim('code')))
+		print(f"{count} {model._meta.verbose_name} normalizados")
+
+	for brokerage_note in BrokerageNote.objects.filter(content_hash=''):
+		try:
+			with brokerage_note.note.file as note_file:
+				brokerage_note.content_hash = get_content_hash(note_file.read())
+		except FileNotFoundError:
+			print(f"Falha na leitura do arquivo '{brokerage_note.note.name}'", file=sys.stderr)
+			continue
+		brokerage_note.save(update_fields=['content_hash'])
+
+	# poucos valores distintos: um 'update' por valor
+	for kind in Earnings.objects.values_list('kind', flat=True).order_by().distinct():
+		Earnings.objects.filter(kind=kind).update(kind_slug=Earnings.get_kind_slug(kind))
+	for flow in Earnings.objects.values_list('flow', flat=True).order_by().distinct():
+		Earnings.objects.filter(flow=flow).update(flow_code=Earnings.get_flow_code(flow))
+
+	count = MonthlyTradeSummary.rebuild()
+	print(f"{count} {MonthlyTradeSummary._meta.verbose_name_plural.lower()} registrados")
@@ -0,0 +1,11 @@
+from django.db import connections
+
+
+def close_unusable_connections(**kwargs):
+	"""Verifica as conexões persistentes no início de cada requisição ('CONN_HEALTH_CHECKS')
+	Equivalente ao suporte nativo do django 4.1+, que não existe na versão 3.2.
+	"""
+	for conn in connections.all():
+		if (conn.settings_dict.get('CONN_HEALTH_CHECKS') and conn.connection is not None and
+				not conn.in_atomic_block and not conn.is_usable()):
+			conn.close()
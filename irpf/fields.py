@@ -1,22 +1,107 @@
 import decimal
 
 import datetime
+import functools
 import re
+import sys
 from decimal import Decimal
 import moneyfield
 import moneyfield.fields
+from django import forms
+from django.conf import settings
+from django.core import exceptions
 from django.db import models
+from django.utils.functional import cached_property
 
 from correpy.domain.entities.security import BDR_TICKER_PATTERN
 
 
+MONEY_STORAGE_DECIMAL = "decimal"
+MONEY_STORAGE_INTEGER = "integer"
+
+
+class ScaledDecimalField(models.BigIntegerField):
+	"""Decimal armazenado como inteiro escalado (valor * 10^scale)
+	A soma no banco é exata e a leitura não passa pela conversão de texto/real para Decimal.
+	"""
+	description = "Decimal number (scaled integer storage)"
+
+	def __init__(self, *args, scale: int = 8, decimal_places: int = None, **kwargs):
+		self.scale = scale
+		self.decimal_places = scale if decimal_places is None else min(decimal_places, scale)
+		super().__init__(*args, **kwargs)
+
+	def deconstruct(self):
+		name, path, args, kwargs = super().deconstruct()
+		kwargs['scale'] = self.scale
+		kwargs['decimal_places'] = self.decimal_places
+		return name, path, args, kwargs
+
+	@cached_property
+	def validators(self):
+		# os limites de 'BigIntegerField' valem para o valor escalado (não para o Decimal)
+		return [*self.default_validators, *self._validators]
+
+	def to_python(self, value):
+		if value is None:
+			return value
+		value = getattr(value, "amount", value)
+		if isinstance(value, float):
+			value = str(value)
+		try:
+			return Decimal(value)
+		except (decimal.InvalidOperation, TypeError, ValueError):
+			raise exceptions.ValidationError(
+				self.error_messages['invalid'],
+				code='invalid',
+				params={'value': value},
+			)
+
+	def get_prep_value(self, value):
+		value = models.Field.get_prep_value(self, value)
+		if value is None:
+			return None
+		value = self.to_python(value).scaleb(self.scale)
+		return int(value.to_integral_value(rounding=decimal.ROUND_HALF_EVEN))
+
+	def from_db_value(self, value, expression, connection):
+		if value is None:
+			return value
+		return Decimal(int(value)).scaleb(-self.scale)
+
+	def formfield(self, **kwargs):
+		return models.Field.formfield(self, **{
+			'form_class': forms.DecimalField,
+			'decimal_places': self.decimal_places,
+			**kwargs,
+		})
+
+
 class MoneyField(moneyfield.MoneyField):
-	"""Cria um campo moneyfield sem o proxy field_amount e currency fixo"""
+	"""Cria um campo moneyfield sem o proxy field_amount e currency fixo
+	Com 'IRPF_MONEY_STORAGE=integer' o valor é armazenado como inteiro escalado (ScaledDecimalField).
+	"""
 	def __init__(self, *args, **kwargs):
 		kwargs.setdefault("amount_proxy", False)
 		kwargs.setdefault('amount_default', Decimal(0))
 		kwargs.setdefault('currency', 'BRL')
 		super().__init__(*args, **kwargs)
+		if getattr(settings, "IRPF_MONEY_STORAGE", MONEY_STORAGE_DECIMAL) == MONEY_STORAGE_INTEGER:
+			self.amount_field = self._get_scaled_amount_field(self.amount_field)
+
+	@staticmethod
+	def _get_scaled_amount_field(field: models.DecimalField) -> ScaledDecimalField:
+		return ScaledDecimalField(
+			verbose_name=field.verbose_name,
+			scale=getattr(settings, "IRPF_MONEY_SCALE", 8),
+			decimal_places=field.decimal_places,
+			default=field.default,
+			null=field.null,
+			blank=field.blank,
+			editable=field.editable,
+			help_text=field.help_text,
+			db_index=field.db_index,
+		)
 
 	def formfield(self, **kwargs):
 		field = super().formfield(**kwargs)
@@ -38,25 +123,61 @@ class DateField(models.DateField):
 		return value
 
 
-class CharCodeField(models.CharField):
-	TICKER_PATTERN = (
-		re.compile(BDR_TICKER_PATTERN),
-		re.compile("([A-Z-0-9]{4})[0-9]+")
-	)
+class UpperCharField(models.CharField):
+	"""Texto normalizado em caixa alta (permite buscas exatas usando o índice da coluna)"""
+
+	def to_python(self, value):
+		value = super().to_python(value)
+		if isinstance(value, str):
+			value = value.strip().upper()
+		return value
+
+
+TICKER_PATTERN = (
+	re.compile(BDR_TICKER_PATTERN),
+	re.compile("([A-Z-0-9]{4})[0-9]+")
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_ticker(value: str) -> str:
+	"""Ticker canônico: caixa alta e sem a parte fracionária ('petr4f' -> 'PETR4')
+	O resultado é internado (os mesmos códigos se repetem em todas as linhas de importação).
+	"""
+	value = value.strip().upper()
+	for pattern in TICKER_PATTERN:
+		if result := pattern.search(value):
+			return sys.intern(result[0])
+	raise ValueError(f"unknown format ticker '{value}'")
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize_code_name(value: str, is_code: bool = False) -> str:
+	"""Código (is_code=True) ou nome de um produto no formato da B3 ('PETR4 - PETROBRAS')"""
+	try:
+		code, name = value.split('-', 1)
+	except ValueError:
+		value = value.strip()
+		if is_code:
+			value = normalize_ticker(value)
+	else:
+		value = normalize_ticker(code) if is_code else name.strip()
+	return value
+
+
+class CharCodeField(UpperCharField):
+	TICKER_PATTERN = TICKER_PATTERN
 
 	@classmethod
 	def _get_simple_ticker(cls, ticker):
 		"""Retorna o ticker (code) sem a parte fracionária"""
-		for pattern in cls.TICKER_PATTERN:
-			if result := pattern.search(ticker):
-				return result[0]
-		raise ValueError(f"unknown format ticker '{ticker}'")
+		return normalize_ticker(ticker)
 
 	def to_python(self, value):
 		value = super().to_python(value)
 		if isinstance(value, str):
 			# removes the fractional portion of the code.
-			value = self._get_simple_ticker(value)
+			value = normalize_ticker(value)
 		return value
 
 
@@ -69,16 +190,7 @@ class CharCodeNameField(models.CharField):
 		value = super().to_python(value)
 		if isinstance(value, str):
 			# removes the fractional portion of the code.
-			try:
-				code, name = value.split('-', 1)
-			except ValueError:
-				value = value.strip()
-				if self._is_code:
-					value = CharCodeField().to_python(value)
-			else:
-				value = name.strip()
-				if self._is_code:
-					value = CharCodeField().to_python(code)
+			value = normalize_code_name(value, self._is_code)
 		return value
 
 
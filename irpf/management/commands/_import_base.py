@@ -5,7 +5,6 @@ from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand
 from django.db.transaction import atomic
 from guardian.shortcuts import assign_perm
-from openpyxl import load_workbook
 from irpf.permissions import permission_models
 
 User = get_user_model()
@@ -92,6 +91,7 @@ class Command(BaseCommand):
 			self.save_instance(**data)
 
 	def handle(self, *args, **options):
+		from openpyxl import load_workbook
 		wb = None
 		with options['filepath'] as filepath:
 			try:
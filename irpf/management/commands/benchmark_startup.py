@@ -0,0 +1,73 @@
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management import get_commands
+from django.core.management.base import BaseCommand
+
+# mede (em um processo novo) django.setup() - que inclui o autodiscover dos módulos 'adminx' - e as urls do admin
+SETUP_SCRIPT = """
+import os, time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "b3irpf.settings")
+start = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+print(setup - start, time.perf_counter() - setup)
+"""
+
+
+class Command(BaseCommand):
+	help = """
+	Tempo de inicialização a frio: django.setup(), autodiscover do admin e cada comando do projeto
+	"""
+
+	def add_arguments(self, parser):
+		parser.add_argument("--repeat", type=int, default=5,
+		                    help="Execuções de cada medição (é exibida a mediana).")
+		parser.add_argument("--commands", nargs="*", default=None,
+		                    help="Comandos medidos (padrão: todos os comandos do app irpf).")
+
+	@staticmethod
+	def get_env() -> dict:
+		env = os.environ.copy()
+		env.setdefault("DJANGO_SETTINGS_MODULE", "b3irpf.settings")
+		return env
+
+	def run(self, args: list) -> subprocess.CompletedProcess:
+		return subprocess.run([sys.executable, *args],
+		                      cwd=settings.BASE_DIR,
+		                      env=self.get_env(),
+		                      capture_output=True,
+		                      text=True,
+		                      check=True)
+
+	def time_command(self, name: str) -> float:
+		"""Tempo total do processo 'manage.py <comando> --help' (carrega o comando sem executá-lo)"""
+		script = ("import sys, time, runpy; start = time.perf_counter(); "
+		          f"sys.argv = ['manage.py', {name!r}, '--help']\n"
+		          "try:\n    runpy.run_path('manage.py', run_name='__main__')\n"
+		          "except SystemExit:\n    pass\n"
+		          "print(time.perf_counter() - start, file=sys.stderr)")
+		return float(self.run(["-c", script]).stderr.strip().splitlines()[-1])
+
+	def handle(self, *args, **options):
+		repeat = max(options['repeat'], 1)
+		setup, urls = [], []
+		for _ in range(repeat):
+			values = self.run(["-c", SETUP_SCRIPT]).stdout.split()
+			setup.append(float(values[0]))
+			urls.append(float(values[1]))
+		self.stdout.write(f"django.setup() + autodiscover: {statistics.median(setup) * 1000:.1f} ms")
+		self.stdout.write(f"urls (admin): {statistics.median(urls) * 1000:.1f} ms")
+
+		names = options['commands']
+		if names is None:
+			names = sorted(name for name, app in get_commands().items() if app == 'irpf')
+		for name in names:
+			times = [self.time_command(name) for _ in range(repeat)]
+			self.stdout.write(f"{name}: {statistics.median(times) * 1000:.1f} ms")
@@ -0,0 +1,72 @@
+import json
+from decimal import Decimal
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+	help = """
+	Preserva os valores monetários na troca do armazenamento (IRPF_MONEY_STORAGE=decimal/integer)
+	1. dump (armazenamento atual); 2. altera IRPF_MONEY_STORAGE; 3. makemigrations/migrate; 4. load
+	"""
+	chunk_size = 2000
+
+	def add_arguments(self, parser):
+		parser.add_argument("action", choices=("dump", "load"))
+		parser.add_argument("--file", default="money_storage.jsonl",
+		                    help="Arquivo com os valores (uma linha json por registro).")
+
+	@staticmethod
+	def get_money_models():
+		for model in apps.get_app_config('irpf').get_models():
+			if fields := [field.name for field in getattr(model._meta, 'moneyfields', ())]:
+				yield model, fields
+
+	def dump(self, filename: str):
+		with open(filename, "w") as fp:
+			for model, fields in self.get_money_models():
+				count = 0
+				queryset = model.objects.order_by().values_list('pk', *fields)
+				for pk, *values in queryset.iterator(chunk_size=self.chunk_size):
+					fp.write(json.dumps({
+						'model': model._meta.label,
+						'pk': pk,
+						'values': dict(zip(fields, (None if v is None else str(v) for v in values)))
+					}) + "\n")
+					count += 1
+				print(f"{count} {model._meta.verbose_name} exportados")
+
+	def _bulk_update(self, model, fields: list, objs: list):
+		model.objects.bulk_update(objs, fields, batch_size=self.chunk_size)
+		objs.clear()
+
+	def load(self, filename: str):
+		models_fields = {model._meta.label: (model, fields) for model, fields in self.get_money_models()}
+		pending, count = {}, 0
+		with open(filename) as fp:
+			for line in fp:
+				data = json.loads(line)
+				model, fields = models_fields[data['model']]
+				obj = model(pk=data['pk'])
+				for name, value in data['values'].items():
+					setattr(obj, name, None if value is None else Decimal(value))
+				objs = pending.setdefault(model, [])
+				objs.append(obj)
+				if len(objs) >= self.chunk_size:
+					self._bulk_update(model, fields, objs)
+				count += 1
+		for model, objs in pending.items():
+			if objs:
+				self._bulk_update(model, models_fields[model._meta.label][1], objs)
+		print(f"{count} registros atualizados")
+
+	def handle(self, *args, **options):
+		filename = options['file']
+		if options['action'] == "dump":
+			self.dump(filename)
+		else:
+			try:
+				self.load(filename)
+			except FileNotFoundError:
+				raise CommandError(f"arquivo '{filename}' não encontrado")
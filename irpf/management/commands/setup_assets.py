@@ -1,32 +1,39 @@
 from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery, Exists
 
-from irpf.models import Earnings, Negotiation, Asset
+from irpf.models import Earnings, Negotiation, MonthlyTradeSummary, Asset, DataVersion, ReportCheckpoint, Statistic
 
 
 class Command(BaseCommand):
 	"""Configura os ativos ao modelo cujo valor é Null
 	"""
 	asset_model = Asset
-	update_models = [Earnings, Negotiation]
+	update_models = [Earnings, Negotiation, MonthlyTradeSummary]
 
-	def get_db_asset(self, ticker: str):
-		"""O ativo"""
-		try:
-			asset = self.asset_model.objects.get(code__iexact=ticker)
-		except self.asset_model.DoesNotExist:
-			asset = None
-		return asset
+	def add_arguments(self, parser):
+		parser.add_argument("--codes", nargs="*", default=None,
+		                    help="Limita a atualização aos códigos de negociação informados.")
+
+	def get_asset_queryset(self):
+		"""Ativo com o mesmo código do registro (subquery)"""
+		return self.asset_model.objects.filter(code=OuterRef('code'))
 
 	def handle(self, *args, **options):
+		codes = options.get('codes')
+		assets = self.get_asset_queryset()
 		for model in self.update_models:
-			count = 0
-			for instance in model.objects.filter(asset__isnull=True):
-				instance.asset = self.get_db_asset(instance.code)
-				if not instance.asset:
-					continue
-				instance.save()
-				count += 1
-
+			queryset = model.objects.filter(asset__isnull=True)
+			if codes:
+				# os códigos são armazenados em caixa alta
+				queryset = queryset.filter(code__in=[code.strip().upper() for code in codes])
+			# um único 'UPDATE ... SET asset_id = (SELECT ...)' por modelo
+			count = queryset.filter(Exists(assets)).update(
+				asset=Subquery(assets.values('pk')[:1])
+			)
 			if count > 0:
+				# 'update' não envia sinais (invalida o cache e os resultados salvos dos relatórios)
+				DataVersion.touch()
+				ReportCheckpoint.invalidate()
+				Statistic.invalidate_cache()
 				opts = model._meta
 				print(f"{count} {opts.verbose_name} atualizados")
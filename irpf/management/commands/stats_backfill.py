@@ -0,0 +1,36 @@
+import datetime
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from irpf.management.commands._import_base import UserType
+from irpf.models import Negotiation
+from irpf.report.stats import StatisticResolver
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+	help = """Calcula as estatísticas mensais não salvas (prejuízo acumulado) desde o início das negociações
+	Os relatórios calculam no máximo IRPF_STATS_BACKFILL_MAX_MONTHS meses; este comando não tem limite.
+	"""
+	resolver_class = StatisticResolver
+
+	def add_arguments(self, parser):
+		parser.add_argument("--user", type=UserType(User.objects.all()), default=None,
+		                    help="Limita o cálculo ao usuário (chave primária).")
+		parser.add_argument("--date", type=datetime.date.fromisoformat, default=None,
+		                    help="Último mês calculado (AAAA-MM-DD; padrão o mês anterior).")
+
+	def handle(self, *args, **options):
+		if (date := options.get('date')) is None:
+			date = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+		date = self.resolver_class.get_month_end(date)
+		if (user := options.get('user')) is not None:
+			users = [user]
+		else:
+			users = User.objects.filter(pk__in=Negotiation.objects.values('user')).order_by('pk')
+		for user in users:
+			resolver = self.resolver_class(user, max_months=0)
+			if resolver.backfill(date):
+				print(f"{user}: estatísticas calculadas até {date:%m/%Y}")
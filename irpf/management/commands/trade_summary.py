@@ -0,0 +1,21 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from irpf.management.commands._import_base import UserType
+from irpf.models import MonthlyTradeSummary
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+	help = """Recria os totais mensais das negociações (MonthlyTradeSummary)"""
+	trade_summary_model = MonthlyTradeSummary
+
+	def add_arguments(self, parser):
+		parser.add_argument("--user", type=UserType(User.objects.all()), default=None,
+		                    help="Limita a reconstrução ao usuário (chave primária).")
+
+	def handle(self, *args, **options):
+		count = self.trade_summary_model.rebuild(options.get('user'))
+		opts = self.trade_summary_model._meta
+		print(f"{count} {opts.verbose_name_plural.lower()} registrados")
@@ -1,17 +1,18 @@
+import calendar
 import datetime
 import decimal
 import re
-from collections import defaultdict
 from decimal import Decimal
 
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import TruncMonth
 from django.utils import timezone
 from django.utils.formats import date_format
 from django.utils.functional import cached_property, classproperty
 from django.utils.text import slugify
 
-from irpf.fields import CharCodeField, DateField, CharCodeNameField, DecimalBRField, MoneyField
+from irpf.fields import CharCodeField, UpperCharField, DateField, CharCodeNameField, DecimalBRField, MoneyField
 from irpf.storage import FileSystemOverwriteStorage
 
 DECIMAL_MAX_DIGITS = 28
@@ -29,6 +30,36 @@ class ProjectMigration(models.Model):
 		return f"v{self.version}"
 
 
+class DataVersion(models.Model):
+	"""Versão dos dados do usuário (alterada a cada modificação que afeta os relatórios)
+	Usada na chave do cache de relatórios.
+	"""
+	user = models.OneToOneField(settings.AUTH_USER_MODEL,
+	                            verbose_name="Usuário",
+	                            on_delete=models.CASCADE)
+	version = models.PositiveBigIntegerField(verbose_name="Versão", default=0)
+	updated = models.DateTimeField(verbose_name="Atualizado em", auto_now=True)
+
+	class Meta:
+		verbose_name = "Versão dos dados"
+
+	def __str__(self):
+		return f"{self.user} - v{self.version}"
+
+	@classmethod
+	def get_version(cls, user) -> int:
+		instance, _ = cls.objects.get_or_create(user=user)
+		return instance.version
+
+	@classmethod
+	def touch(cls, user=None):
+		"""Nova versão dos dados do usuário (de todos os usuários quando 'user' for None)"""
+		queryset = cls.objects.all()
+		if user is not None:
+			queryset = queryset.filter(user=user)
+		return queryset.update(version=models.F('version') + 1, updated=timezone.now())
+
+
 class Bookkeeping(models.Model):
 	name = models.CharField(verbose_name="Nome", max_length=512)
 	cnpj = models.CharField(verbose_name="CNPJ", max_length=32,
@@ -84,9 +115,9 @@ class Asset(models.Model):
 		(CATEGORY_OTHERS, "OUTROS")
 	)
 
-	code = models.CharField(verbose_name="Código de negociação",
-	                        unique=True,
-	                        max_length=8)
+	code = UpperCharField(verbose_name="Código de negociação",
+	                      unique=True,
+	                      max_length=8)
 	name = models.CharField(verbose_name="Nome", max_length=512)
 	cnpj = models.CharField(verbose_name="CNPJ", max_length=32)
 
@@ -285,7 +316,7 @@ class Negotiation(ImportModelMixin, BaseIRPFModel):
 		data['total'] = cls._convert_decimal(data.get('total'), Decimal(0))
 		try:
 			ticker = opts.get_field("code").to_python(data['code'])
-			data['asset'] = Asset.objects.get(code__iexact=ticker)
+			data['asset'] = Asset.objects.get(code=ticker)
 		except Asset.DoesNotExist:
 			pass
 		return data
@@ -312,7 +343,164 @@ class Negotiation(ImportModelMixin, BaseIRPFModel):
 			models.Index(fields=['code']),
 			models.Index(fields=['kind']),
 			models.Index(fields=['institution_name']),
-			models.Index(fields=['-date', 'code', 'kind', 'institution_name'])
+			models.Index(fields=['-date', 'code', 'kind', 'institution_name']),
+			models.Index(fields=['user', 'date'])
+		]
+
+
+class MonthlyTradeSummary(BaseIRPFModel):
+	"""Totais mensais das negociações (usuário / ativo / instituição / mês)
+	Mantido pelos sinais de 'Negotiation' e pelas importações em lote ('refresh'). Cada grupo
+	afetado é recalculado a partir das negociações, então o resultado não depende da ordem das alterações.
+	"""
+	negotiation_model = Negotiation
+
+	# primeiro dia do mês
+	date = DateField(verbose_name="Mês")
+	code = CharCodeField(verbose_name="Código de negociação",
+	                     max_length=8)
+	asset = models.ForeignKey(Asset, on_delete=models.CASCADE,
+	                          verbose_name="Ativo",
+	                          null=True)
+	institution_name = models.CharField(verbose_name="Instituição",
+	                                    max_length=512)
+
+	buy_quantity = models.DecimalField(verbose_name="Compras (quantidade)",
+	                                   max_digits=19,
+	                                   decimal_places=0,
+	                                   default=Decimal(0))
+	buy_total = MoneyField(verbose_name="Compras (total)",
+	                       max_digits=DECIMAL_MAX_DIGITS,
+	                       decimal_places=DECIMAL_PLACES)
+	buy_tax = MoneyField(verbose_name="Compras (taxas)",
+	                     max_digits=DECIMAL_MAX_DIGITS,
+	                     decimal_places=DECIMAL_PLACES)
+	buy_count = models.PositiveIntegerField(verbose_name="Compras (negociações)", default=0)
+
+	sell_quantity = models.DecimalField(verbose_name="Vendas (quantidade)",
+	                                    max_digits=19,
+	                                    decimal_places=0,
+	                                    default=Decimal(0))
+	sell_total = MoneyField(verbose_name="Vendas (total)",
+	                        max_digits=DECIMAL_MAX_DIGITS,
+	                        decimal_places=DECIMAL_PLACES)
+	sell_tax = MoneyField(verbose_name="Vendas (taxas)",
+	                      max_digits=DECIMAL_MAX_DIGITS,
+	                      decimal_places=DECIMAL_PLACES)
+	sell_count = models.PositiveIntegerField(verbose_name="Vendas (negociações)", default=0)
+
+	@property
+	def count(self) -> int:
+		return self.buy_count + self.sell_count
+
+	@staticmethod
+	def get_month(date: datetime.date) -> datetime.date:
+		return date.replace(day=1)
+
+	@classmethod
+	def get_key(cls, negotiation) -> tuple:
+		"""Grupo da negociação (código, instituição, mês)"""
+		return negotiation.code, negotiation.institution_name, cls.get_month(negotiation.date)
+
+	@classmethod
+	def _aggregate(cls, queryset):
+		buy = models.Q(kind__iexact=cls.negotiation_model.KIND_BUY)
+		sell = models.Q(kind__iexact=cls.negotiation_model.KIND_SELL)
+		return queryset.order_by().values(
+			'user', 'code', 'institution_name', month=TruncMonth('date')
+		).annotate(
+			asset_id=models.Max('asset'),
+			buy_quantity=models.Sum('quantity', filter=buy),
+			buy_total=models.Sum('total', filter=buy),
+			buy_tax=models.Sum('tax', filter=buy),
+			buy_count=models.Count('pk', filter=buy),
+			sell_quantity=models.Sum('quantity', filter=sell),
+			sell_total=models.Sum('total', filter=sell),
+			sell_tax=models.Sum('tax', filter=sell),
+			sell_count=models.Count('pk', filter=sell),
+		)
+
+	@classmethod
+	def _from_row(cls, row: dict):
+		month = row['month']
+		if isinstance(month, datetime.datetime):
+			month = month.date()
+		defaults = Decimal(0)
+		return cls(
+			user_id=row['user'],
+			date=month,
+			code=row['code'],
+			asset_id=row['asset_id'],
+			institution_name=row['institution_name'],
+			buy_quantity=row['buy_quantity'] or defaults,
+			buy_total=row['buy_total'] or defaults,
+			buy_tax=row['buy_tax'] or defaults,
+			buy_count=row['buy_count'],
+			sell_quantity=row['sell_quantity'] or defaults,
+			sell_total=row['sell_total'] or defaults,
+			sell_tax=row['sell_tax'] or defaults,
+			sell_count=row['sell_count'],
+		)
+
+	@classmethod
+	def _lock(cls, user=None):
+		"""Bloqueia os usuários até o fim da transação
+		Duas transações recriando o mesmo grupo (remoção + inserção) violariam o 'unique_together';
+		as linhas do resumo podem não existir ainda, então o bloqueio é feito no usuário.
+		"""
+		queryset = cls._meta.get_field('user').related_model.objects.select_for_update()
+		if user is not None:
+			queryset = queryset.filter(pk=getattr(user, 'pk', user))
+		list(queryset.order_by('pk').values_list('pk', flat=True))
+
+	@classmethod
+	def _rebuild(cls, user=None, **query) -> int:
+		"""Recria os totais dos grupos selecionados por 'query' (mesmo filtro nos dois modelos)"""
+		summary_qs = cls.objects.filter(**query)
+		negotiation_qs = cls.negotiation_model.objects.filter(**query)
+		if user is not None:
+			summary_qs = summary_qs.filter(user=user)
+			negotiation_qs = negotiation_qs.filter(user=user)
+		with transaction.atomic():
+			cls._lock(user)
+			summary_qs.delete()
+			objs = cls.objects.bulk_create(
+				[cls._from_row(row) for row in cls._aggregate(negotiation_qs).iterator()],
+				batch_size=1000
+			)
+		return len(objs)
+
+	@classmethod
+	def refresh(cls, user, keys) -> int:
+		"""Recalcula os grupos (código, instituição, mês) informados
+		Os filtros são a união dos grupos; grupos a mais são recalculados sem alterar o resultado.
+		"""
+		if not (keys := set(keys)):
+			return 0
+		codes, institutions, months = zip(*keys)
+		end_date = max(months)
+		end_date = end_date.replace(day=calendar.monthrange(end_date.year, end_date.month)[1])
+		return cls._rebuild(user,
+		                    code__in=set(codes),
+		                    institution_name__in=set(institutions),
+		                    date__range=[min(months), end_date])
+
+	@classmethod
+	def rebuild(cls, user=None) -> int:
+		"""Recria todos os totais (do usuário ou de todos os usuários)"""
+		return cls._rebuild(user)
+
+	def __str__(self):
+		return f'{self.code} - {self.date:%m/%Y} ({self.institution_name})'
+
+	class Meta:
+		unique_together = ("user", "code", "institution_name", "date")
+		verbose_name = "Resumo mensal de negociações"
+		verbose_name_plural = "Resumos mensais de negociações"
+		ordering = ("-date", "code")
+		indexes = [
+			models.Index(fields=['user', 'date']),
+			models.Index(fields=['user', 'code', 'date'])
 		]
 
 
@@ -344,6 +532,9 @@ class Bonus(BaseIRPFModel):
 		verbose_name = "Bonificação"
 		verbose_name_plural = "Bonificações"
 		ordering = ("-date", "-date_com")
+		indexes = [
+			models.Index(fields=['user', 'date_com'])
+		]
 
 
 class BonusInfo(BaseIRPFModel):
@@ -416,11 +607,29 @@ class Earnings(ImportModelMixin, BaseIRPFModel):
 		(FLOW_CREDIT, FLOW_CREDIT),
 		(FLOW_DEBIT, FLOW_DEBIT)
 	)
+	FLOW_CODE_UNKNOWN = 0
+	FLOW_CODE_CREDIT = 1
+	FLOW_CODE_DEBIT = 2
+	FLOW_CODE_CHOICES = (
+		(FLOW_CODE_UNKNOWN, "Desconhecido"),
+		(FLOW_CODE_CREDIT, FLOW_CREDIT),
+		(FLOW_CODE_DEBIT, FLOW_DEBIT)
+	)
 
 	date = DateField(verbose_name="Data")
 	flow = models.CharField(verbose_name="Entrada/Saída", max_length=16)
+	flow_code = models.PositiveSmallIntegerField(verbose_name="Entrada/Saída (código)",
+	                                             choices=FLOW_CODE_CHOICES,
+	                                             default=FLOW_CODE_UNKNOWN,
+	                                             editable=False)
 
 	kind = models.CharField(verbose_name="Tipo de Movimentação", max_length=256)
+	kind_slug = models.SlugField(verbose_name="Tipo de Movimentação (slug)",
+	                             max_length=256,
+	                             db_index=False,
+	                             default="",
+	                             blank=True,
+	                             editable=False)
 	code = CharCodeNameField(verbose_name="Código", max_length=512, is_code=True)
 	name = CharCodeNameField(verbose_name="Nome do ativo", max_length=256)
 	asset = models.ForeignKey(Asset, on_delete=models.CASCADE,
@@ -451,24 +660,41 @@ class Earnings(ImportModelMixin, BaseIRPFModel):
 		data['total'] = cls._convert_decimal(data.get('total'), Decimal(0))
 		try:
 			ticker = opts.get_field("code").to_python(data['code'])
-			data['asset'] = Asset.objects.get(code__iexact=ticker)
+			data['asset'] = Asset.objects.get(code=ticker)
 		except Asset.DoesNotExist:
 			pass
 		return data
 
-	@cached_property
-	def kind_slug(self):
-		return slugify(self.kind).replace('-', "_")
+	@staticmethod
+	def get_kind_slug(kind: str) -> str:
+		return slugify(kind).replace('-', "_")
 
-	@cached_property
+	@classmethod
+	def get_flow_code(cls, flow: str) -> int:
+		flow = flow.strip().lower()
+		if flow == cls.FLOW_CREDIT.lower():
+			return cls.FLOW_CODE_CREDIT
+		elif flow == cls.FLOW_DEBIT.lower():
+			return cls.FLOW_CODE_DEBIT
+		return cls.FLOW_CODE_UNKNOWN
+
+	@property
 	def is_credit(self):
 		"""Se é crédito"""
-		return self.flow.lower() == self.FLOW_CREDIT.lower()
+		return self.flow_code == self.FLOW_CODE_CREDIT
 
-	@cached_property
+	@property
 	def is_debit(self):
 		"""Se é débito"""
-		return self.flow.lower() == self.FLOW_DEBIT.lower()
+		return self.flow_code == self.FLOW_CODE_DEBIT
+
+	def save(self, *args, **kwargs):
+		# valores calculados uma única vez (consultas e relatórios usam as colunas)
+		self.kind_slug = self.get_kind_slug(self.kind)
+		self.flow_code = self.get_flow_code(self.flow)
+		if (update_fields := kwargs.get('update_fields')) is not None:
+			kwargs['update_fields'] = {*update_fields, 'kind_slug', 'flow_code'}
+		return super().save(*args, **kwargs)
 
 	def __str__(self):
 		return f'{self.code} - {self.name} - {self.total}'
@@ -482,7 +708,8 @@ class Earnings(ImportModelMixin, BaseIRPFModel):
 			models.Index(fields=['flow']),
 			models.Index(fields=['code']),
 			models.Index(fields=['name']),
-			models.Index(fields=['-date', 'flow', 'kind', 'code'])
+			models.Index(fields=['-date', 'flow', 'kind', 'code']),
+			models.Index(fields=['user', 'date'])
 		]
 
 
@@ -497,6 +724,10 @@ class BrokerageNote(BaseIRPFModel):
 	                                help_text="A corretora que gerou essa nota.")
 	reference_id = models.PositiveBigIntegerField(verbose_name="Número da nota", null=True)
 	reference_date = models.DateField(verbose_name="Data do pregão")
+	content_hash = models.CharField(verbose_name="Hash do arquivo (sha256)",
+	                                max_length=64,
+	                                blank=True,
+	                                editable=False)
 
 	settlement_fee = MoneyField(verbose_name="Taxa de liquidação",
 	                            max_digits=DECIMAL_MAX_DIGITS,
@@ -542,6 +773,9 @@ class BrokerageNote(BaseIRPFModel):
 			'institution',
 		)
 		ordering = ('-reference_date',)
+		indexes = [
+			models.Index(fields=['user', 'content_hash'])
+		]
 
 
 class AssetEvent(BaseIRPFModel):
@@ -581,6 +815,9 @@ class AssetEvent(BaseIRPFModel):
 	class Meta:
 		verbose_name = "Evento"
 		verbose_name_plural = verbose_name + "s"
+		indexes = [
+			models.Index(fields=['user', 'date_com'])
+		]
 
 
 class AssetConvert(BaseIRPFModel):
@@ -608,6 +845,9 @@ class AssetConvert(BaseIRPFModel):
 	class Meta:
 		verbose_name = "Conversão de ativo"
 		verbose_name_plural = verbose_name + "s"
+		indexes = [
+			models.Index(fields=['user', 'date'])
+		]
 
 
 class Position(BaseIRPFModel):
@@ -666,7 +906,11 @@ class Position(BaseIRPFModel):
 		verbose_name = "Posição"
 		verbose_name_plural = "Posições"
 		indexes = [
-			models.Index(fields=['-date'])
+			models.Index(fields=['-date']),
+			# somente posições válidas são consultadas pelos relatórios
+			models.Index(fields=['user', 'consolidation', 'date'],
+			             condition=models.Q(is_valid=True),
+			             name='irpf_position_valid_idx')
 		]
 
 
@@ -704,6 +948,18 @@ class Statistic(BaseIRPFModel):
 	                            blank=True)
 	date = DateField(verbose_name="Data")
 	valid = models.BooleanField(verbose_name="Válido", editable=False, default=True)
+	# falso para os meses calculados automaticamente (cache do prejuízo acumulado)
+	authoritative = models.BooleanField(verbose_name="Salvo pelo usuário", editable=False, default=True)
+
+	@classmethod
+	def invalidate_cache(cls, user=None, date: datetime.date = None, **query) -> int:
+		"""Invalida os meses calculados automaticamente a partir da data (todos quando 'date' for None)"""
+		queryset = cls.objects.filter(valid=True, authoritative=False, **query)
+		if user is not None:
+			queryset = queryset.filter(user=user)
+		if date is not None:
+			queryset = queryset.filter(date__gte=date)
+		return queryset.update(valid=False)
 
 	def __str__(self):
 		msg = []
@@ -726,7 +982,54 @@ class Statistic(BaseIRPFModel):
 		verbose_name = "Estatística de dado"
 		verbose_name_plural = verbose_name + "s"
 		indexes = [
-			models.Index(fields=['-date'])
+			models.Index(fields=['-date']),
+			# somente estatísticas válidas são consultadas pelos relatórios
+			models.Index(fields=['user', 'consolidation', 'category', 'date'],
+			             condition=models.Q(valid=True),
+			             name='irpf_statistic_valid_idx')
+		]
+
+
+class ReportCheckpoint(BaseIRPFModel):
+	"""Resultados de um mês fechado do relatório de negociações (gravados junto com as posições)
+	O relatório anual reaproveita os meses com resultados válidos e calcula apenas os seguintes.
+	"""
+	# último dia do mês
+	date = DateField(verbose_name="Data")
+	institution = models.ForeignKey(Institution,
+	                                on_delete=models.CASCADE,
+	                                verbose_name="Instituição",
+	                                blank=True, null=True)
+	# filtros do relatório (categorias e ativo)
+	key = models.CharField(verbose_name="Filtros", max_length=64)
+	data = models.BinaryField(verbose_name="Resultados")
+	valid = models.BooleanField(verbose_name="Válido", editable=False, default=True)
+	updated = models.DateTimeField(verbose_name="Atualizado em", auto_now=True)
+
+	@classmethod
+	def invalidate(cls, user=None, date: datetime.date = None, **query) -> int:
+		"""Invalida os resultados dos meses a partir da data (todos quando 'date' for None)"""
+		queryset = cls.objects.filter(valid=True, **query)
+		if user is not None:
+			queryset = queryset.filter(user=user)
+		if date is not None:
+			queryset = queryset.filter(date__gte=date)
+		return queryset.update(valid=False)
+
+	def __str__(self):
+		msg = [f"Resultados até {date_format(self.date)}"]
+		if self.institution:
+			msg.append(f" - {self.institution.name}")
+		return ' '.join(msg)
+
+	class Meta:
+		unique_together = ("user", "institution", "key", "date")
+		verbose_name = "Resultado mensal salvo"
+		verbose_name_plural = "Resultados mensais salvos"
+		indexes = [
+			models.Index(fields=['user', 'key', 'date'],
+			             condition=models.Q(valid=True),
+			             name='irpf_checkpoint_valid_idx')
 		]
 
 
@@ -792,6 +1095,9 @@ class Taxes(BaseIRPFModel):
 		verbose_name = "Imposto"
 		verbose_name_plural = verbose_name + "s"
 		ordering = ('-created_date', 'category')
+		indexes = [
+			models.Index(fields=['user', 'created_date'])
+		]
 
 
 class TaxRate(BaseIRPFModel):
@@ -810,8 +1116,6 @@ class TaxRate(BaseIRPFModel):
 	valid_start = models.DateField(verbose_name="Começa em", default=timezone.now)
 	valid_until = models.DateField(verbose_name="Válido até", default=timezone.now)
 
-	valid_ranges = defaultdict(dict)
-
 	class Meta:
 		verbose_name = "Alíquota"
 		verbose_name_plural = verbose_name + "s"
@@ -844,26 +1148,6 @@ class TaxRate(BaseIRPFModel):
 		                                 fii_subscription=Decimal(fii_subscription['swing_trade']))
 		return tax_rate
 
-	@classmethod
-	def get_from_date(cls, user, start_date: datetime.date, end_date: datetime.date):
-		if (tax_rate := cls.valid_ranges[user].get((start_date, end_date))) is None:
-			qs = cls.objects.filter(valid_start__lte=start_date, valid_until__gte=end_date)
-			if (tax_rate := qs.first()) is None:
-				tax_rate = cls.create_instance(start_date, end_date)
-			cls.valid_ranges[user][(start_date, end_date)] = tax_rate
-		return tax_rate
-
-	@classmethod
-	def cache_clear(cls, user, forced=False):
-		if forced or len(cls.valid_ranges[user]) >= 24:
-			cls.valid_ranges[user].clear()
-
-	def save(self, *args, **kwargs):
-		try:
-			return super().save(*args, **kwargs)
-		finally:
-			type(self).cache_clear(self.user, forced=True)
-
 
 class AbstractTradeRate(BaseIRPFModel):
 	stock = models.DecimalField(verbose_name="Ações",
@@ -1,14 +1,12 @@
 import calendar
 import collections
 import datetime
-import io
-import itertools
 
 import django.forms as django_forms
 from django.contrib.auth import get_permission_codename
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.core.management import get_commands
-from django.db.models import Count
+from django.db.models import Count, Sum
 from django.db.models.functions import ExtractMonth
 from django.db.transaction import atomic
 from django.template.loader import render_to_string
@@ -16,18 +14,14 @@ from django.utils.functional import cached_property
 from guardian.shortcuts import get_objects_for_user, assign_perm
 
 from correpy.domain.entities.brokerage_note import BrokerageNote
-from correpy.domain.entities.security import Security
-from correpy.domain.entities.transaction import Transaction
-from correpy.domain.enums import TransactionType
-from correpy.parsers.brokerage_notes.b3_parser.b3_parser import B3Parser
-from correpy.parsers.brokerage_notes.base_parser import BaseBrokerageNoteParser
-from irpf.fields import CharCodeField
-from irpf.models import Negotiation, Position, Asset, Statistic, Institution
+from irpf.brokerage_note import get_content_hash, read_note_header, BrokerageNoteParseCache, NegotiationMatcher, \
+	get_parser_class
+from irpf.models import Negotiation, Position, Asset, Statistic, Institution, MonthlyTradeSummary
 from irpf.report import BaseReport
 from irpf.report.base import BaseReportMonth
+from irpf.report.checkpoint import ReportCheckpoints
 from irpf.report.stats import StatsReport, StatsReports
-from irpf.report.utils import Assets, Stats, OrderedDictResults, TransactionGroup, MoneyLC
-from irpf.utils import update_defaults
+from irpf.report.utils import Assets, Stats, OrderedDictResults
 from xadmin.plugins.utils import get_context_dict
 from xadmin.views import BaseAdminPlugin
 
@@ -104,12 +98,18 @@ class AssignUserAdminPlugin(GuardianAdminPluginMixin):
 
 class ListActionModelPlugin(BaseAdminPlugin):
 	list_action_activate = False
+	list_action_report = True
+	# nome da view de importação específica do modelo (sem argumentos)
+	list_action_import_view = None
 
 	def init_request(self, *args, **kwargs):
 		return self.list_action_activate
 
 	def get_import_action(self):
-		url = self.get_admin_url("import_listmodel", self.opts.label_lower)
+		if self.list_action_import_view:
+			url = self.get_admin_url(self.list_action_import_view)
+		else:
+			url = self.get_admin_url("import_listmodel", self.opts.label_lower)
 		return {
 			'title': "Importar lista de dados",
 			'url': url
@@ -127,10 +127,11 @@ class ListActionModelPlugin(BaseAdminPlugin):
 		list_actions_group = {}
 
 		command_name = f"import_{self.opts.model_name.lower()}"
-		if command_name in get_commands():
+		if self.list_action_import_view or command_name in get_commands():
 			list_actions_group['import_list'] = self.get_import_action()
 
-		list_actions_group["report_irpf"] = self.get_report_action()
+		if self.list_action_report:
+			list_actions_group["report_irpf"] = self.get_report_action()
 
 		context['list_actions_group'] = list_actions_group
 		return render_to_string("irpf/adminx.block.listtoolbar_action.html",
@@ -188,8 +189,9 @@ class ReportBaseAdminPlugin(GuardianAdminPluginMixin):
 
 
 class ReportSavePositionAdminPlugin(ReportBaseAdminPlugin):
-	"""Salva os dados de posição do relatório"""
+	"""Salva os dados de posição do relatório (e os resultados dos meses fechados)"""
 	position_model = Position
+	checkpoints_class = ReportCheckpoints
 
 	def block_form_buttons(self, context, nodes):
 		if self.admin_view.reports:
@@ -237,6 +239,14 @@ class ReportSavePositionAdminPlugin(ReportBaseAdminPlugin):
 		if categories := report.get_opts('categories', None):
 			qs_options['asset__category__in'] = categories
 		self.position_model.objects.filter(**qs_options).update(is_valid=False)
+		# resultados salvos dos meses seguintes
+		self.get_checkpoints(report).invalidate(end_date + datetime.timedelta(days=1))
+
+	def get_checkpoints(self, report: BaseReport) -> ReportCheckpoints:
+		return self.checkpoints_class(self.user,
+		                              institution=report.get_opts('institution', None),
+		                              categories=report.get_opts('categories', None),
+		                              asset=report.get_opts('asset', None))
 
 	@atomic
 	def save(self, reports: BaseReportMonth):
@@ -253,6 +263,7 @@ class ReportSavePositionAdminPlugin(ReportBaseAdminPlugin):
 					if asset.buy.quantity <= 0 or asset.instance is None:
 						continue
 					self.save_position(report, asset)
+				self.get_checkpoints(report).store(report)
 		except Exception as exc:
 			self.message_user(f"Falha ao salvar posições: {exc}", level="error")
 		else:
@@ -267,6 +278,7 @@ class BrokerageNoteAdminPlugin(GuardianAdminPluginMixin):
 	brokerage_note_field_update = ()
 	brokerage_note_negotiation = Negotiation
 	brokerage_note_asset_model = Asset
+	brokerage_note_matcher = NegotiationMatcher
 
 	def init_request(self, *args, **kwargs):
 		return bool(self.brokerage_note_negotiation and
@@ -287,134 +299,45 @@ class BrokerageNoteAdminPlugin(GuardianAdminPluginMixin):
 			value = field.initial
 		return value
 
+	@cached_property
+	def brokerage_note_parse_cache(self):
+		"""Cache de dados das notas (evita a extração repetida do mesmo arquivo)"""
+		return BrokerageNoteParseCache()
+
+	def _parse_note_file(self, parser, note_file) -> tuple[str, list[BrokerageNote]]:
+		"""Retorna o hash do arquivo e os dados da nota"""
+		try:
+			content = note_file.read()
+		finally:
+			note_file.seek(0)
+		content_hash = get_content_hash(content)
+		return content_hash, self.brokerage_note_parse_cache.parse(parser, content, content_hash)
+
 	@atomic
 	def _parser_and_update(self, parser, instance) -> list[BrokerageNote]:
 		"""Atualiza a instância com os dados da nota"""
-		notes = []
-		try:
-			parser = parser(brokerage_note=io.BytesIO(instance.note.read()))
-		finally:
-			instance.note.seek(0)
-		for note in parser.parse_brokerage_note():
+		instance.content_hash, notes = self._parse_note_file(parser, instance.note)
+		for note in notes:
 			for field_name in self.brokerage_note_field_update:
 				setattr(instance, field_name, getattr(note, field_name))
-			notes.append(note)
 		return notes
 
-	def get_asset(self, ticker: str):
-		"""O ativo"""
-		try:
-			asset = self.brokerage_note_asset_model.objects.get(code__iexact=ticker)
-		except self.brokerage_note_asset_model.DoesNotExist:
-			asset = None
-		return asset
-
-	def _save_transaction(self, transaction: Transaction, instance, **options) -> Negotiation:
-		"""Cria uma nova 'transaction' com os dados da nota"""
-		ticker = options['code']
-		options.update(
-			date=instance.reference_date,
-			quantity=transaction.amount,
-			price=transaction.unit_price,
-			brokerage_note=instance,
-			irrf=transaction.source_withheld_taxes,
-			institution_name=instance.institution.name,
-			asset=self.get_asset(ticker),
-			user=self.user
+	def _add_transactions(self, notes: list[BrokerageNote], instance):
+		"""Distribui as taxas das notas entre as negociações (consulta e atualização em lote)"""
+		matcher = self.brokerage_note_matcher(
+			self.user, instance.institution,
+			negotiation_model=self.brokerage_note_negotiation,
+			asset_model=self.brokerage_note_asset_model
 		)
-		defaults = options.setdefault('defaults', {})
-		defaults['total'] = transaction.amount * transaction.unit_price
-		obj, created = self.brokerage_note_negotiation.objects.get_or_create(**options)
-		if created:
-			self.set_guardian_object_perms(obj)
-		return obj
-
-	def _get_transaction_type(self, transaction: Transaction) -> str:
-		# filtro para a categoria de transação
-		if transaction.transaction_type == TransactionType.BUY:
-			kind = self.brokerage_note_negotiation.KIND_BUY
-		elif transaction.transaction_type == TransactionType.SELL:
-			kind = self.brokerage_note_negotiation.KIND_SELL
-		else:
-			kind = None
-		return kind
-
-	@staticmethod
-	def _get_clean_ticker(transaction: Transaction):
-		"""Retorna o ticker (code) simplificado"""
-		return CharCodeField().to_python(transaction.security.ticker)
-
-	def _get_transactions_group(self, note_transactions: list[Transaction]) -> collections.OrderedDict:
-		"""Agrupa transações que pertençam ao mesmo ativo (com compra e venda separado)"""
-		results = collections.OrderedDict()
-
-		def transaction_group_by(tns: Transaction):
-			return self._get_clean_ticker(tns), tns.transaction_type
-
-		for (ticker, transaction_type), items in itertools.groupby(note_transactions, key=transaction_group_by):
-			ts = TransactionGroup()
-			# soma as quantidade e totais para cada categoria (compra, venda)
-			# calcula o preço médio final com base no total de todas as negociações do ativo
-			for transaction in items:
-				ts.quantity += transaction.amount
-				ts.total += transaction.amount * transaction.unit_price
-
-			results[ticker] = Transaction(
-				transaction_type=transaction_type,
-				amount=ts.quantity,
-				unit_price=ts.avg_price,
-				security=Security(ticker)
-			)
-		return results
-
-	def _add_transactions(self, note: BrokerageNote, instance):
-		queryset = self.brokerage_note_negotiation.objects.all()
-		tax = sum([note.settlement_fee,
-		           note.term_fee,
-		           note.ana_fee,
-		           note.registration_fee,
-		           note.taxes,
-		           note.emoluments,
-		           note.others])
-
-		transactions = self._get_transactions_group(note.transactions)
-		paid = sum([(transactions[ticker].amount * transactions[ticker].unit_price)
-		            for ticker in transactions])
-		for ticker in transactions:
-			transaction = transactions[ticker]
-			if (kind := self._get_transaction_type(transaction)) is None:
-				continue
-			# rateio de taxas proporcional ao valor pago
-			avg_tax = MoneyLC(tax * ((transaction.amount * transaction.unit_price) / paid))
-			qs = queryset.filter(
-				date=instance.reference_date,
-				code__iexact=ticker,
-				kind__iexact=kind,
-				quantity=transaction.amount,
-				institution_name=instance.institution.name,
-				user=self.user
-			)
-			if self.is_save_transactions and not qs.exists():
-				self._save_transaction(
-					transaction, instance,
-					code=ticker,
-					kind=kind,
-					defaults={'tax': avg_tax}
-				)
-			else:
-				for negotiation in qs:
-					update_defaults(negotiation, {
-						'brokerage_note': instance,
-						'tax': avg_tax,
-					})
+		matcher.load([instance.reference_date])
+		for note in notes:
+			matcher.add(note, instance)
+		matcher.save(save_transactions=self.is_save_transactions,
+		             permissions=self.guardian_permissions_models)
 
-	def _get_parser(self, institution: Institution) -> BaseBrokerageNoteParser:
+	def _get_parser(self, institution: Institution):
 		"""Retorna o parser da nota corretamente para uma data corretora (instituição)"""
-		try:
-			parser = self.brokerage_note_parsers[institution.cnpj_nums]
-		except KeyError:
-			parser = B3Parser
-		return parser
+		return get_parser_class(self.brokerage_note_parsers, institution)
 
 	def valid_forms(self, is_valid: bool):
 		if is_valid:
@@ -425,34 +348,59 @@ class BrokerageNoteAdminPlugin(GuardianAdminPluginMixin):
 			parser_cls = self._get_parser(cleaned_data['institution'])
 			note_file = cleaned_data['note']
 			try:
-				parser = parser_cls(brokerage_note=io.BytesIO(note_file.read()))
+				content = note_file.read()
 			finally:
 				note_file.seek(0)
-			for note in parser.parse_brokerage_note():
+			content_hash = get_content_hash(content)
+			# arquivo idêntico já registrado (dispensa a extração de dados)
+			queryset = self.model.objects.filter(content_hash=content_hash, user=self.user)
+			if new_obj.pk is not None:
+				queryset = queryset.exclude(pk=new_obj.pk)
+			if queryset.exists():
+				self.message_user("Essa nota de corretagem já foi registrada.", level='error')
+				return False
+			new_obj.content_hash = content_hash
+			new_obj.user = self.user
+			# o cabeçalho basta para recusar uma nota já registrada (sem a extração completa)
+			if header := read_note_header(parser_cls, content):
+				new_obj.reference_id, new_obj.reference_date = header
+				if not self._validate_unique(new_obj):
+					return False
+			# o cabeçalho é uma heurística: valem os dados da extração completa (em cache para o registro)
+			for note in self.brokerage_note_parse_cache.parse(parser_cls, content, content_hash):
 				new_obj.reference_date = note.reference_date
 				new_obj.reference_id = note.reference_id
-				new_obj.user = self.user
 				break
-			if new_obj.reference_id and new_obj.reference_date and new_obj.user:
-				try:
-					new_obj.validate_unique()
-				except ValidationError as exc:
-					self.message_user('//'.join(exc.message_dict['__all__']), level='error')
-					is_valid = False
+			if header != (new_obj.reference_id, new_obj.reference_date):
+				is_valid = self._validate_unique(new_obj)
 		return is_valid
 
+	def _validate_unique(self, instance) -> bool:
+		"""Nota única (número e data do pregão da corretora)"""
+		if not (instance.reference_id and instance.reference_date and instance.user):
+			return True
+		try:
+			instance.validate_unique()
+		except ValidationError as exc:
+			self.message_user('//'.join(exc.message_dict['__all__']), level='error')
+			return False
+		return True
+
 	def save_models(self, __):
 		if instance := getattr(self.admin_view, "new_obj", None):
 			try:
 				parser = self._get_parser(instance.institution)
+				unique_key = (instance.reference_id, instance.reference_date)
 				brokerage_notes = self._parser_and_update(parser, instance)
+				if unique_key != (instance.reference_id, instance.reference_date):
+					# valores diferentes dos validados no formulário
+					instance.validate_unique()
 			except Exception as exc:
 				raise exc from None
 			else:
 				# salva a instância
 				retval = __()
-				for note in brokerage_notes:
-					self._add_transactions(note, instance)
+				self._add_transactions(brokerage_notes, instance)
 				return retval
 		else:
 			return __()
@@ -504,7 +452,8 @@ class ReportStatsAdminPlugin(ReportBaseAdminPlugin):
 			defaults = {
 				'residual_taxes': stats_category.taxes.residual,
 				'cumulative_losses': stats_category.cumulative_losses,
-				'valid': True
+				'valid': True,
+				'authoritative': True
 			}
 			instance, created = self.statistic_model.objects.get_or_create(
 				category=category,
@@ -516,8 +465,11 @@ class ReportStatsAdminPlugin(ReportBaseAdminPlugin):
 			)
 			if created:
 				self.set_guardian_object_perms(instance)
-			elif self._update_defaults(instance, defaults):
-				...
+			else:
+				if not instance.authoritative:
+					# registro calculado automaticamente (sem permissões) passa a ser do usuário
+					self.set_guardian_object_perms(instance)
+				self._update_defaults(instance, defaults)
 			if stats_category.taxes.paid:
 				# configura a data do pagamento do valor de imposto cadastrado pelo usuário
 				for taxes in stats_category.taxes.items:
@@ -596,6 +548,7 @@ class BreadcrumbMonthsAdminPlugin(BaseAdminPlugin):
 	"""Plugin gera um breadcrumb com meses de posição de total de ativos"""
 	report_for_model = Negotiation
 	position_model = Position
+	trade_summary_model = MonthlyTradeSummary
 
 	def init_request(self, *args, **kwargs):
 		activate = False
@@ -627,6 +580,29 @@ class BreadcrumbMonthsAdminPlugin(BaseAdminPlugin):
 		}, remove=['ts', '_dates', 'position'])
 		return query_string
 
+	def _get_trades_months(self, report: BaseReport, start_date: datetime.date, end_date: datetime.date) -> dict:
+		"""Quantidade de negociações por mês (totais mensais já agregados)"""
+		qs_options = dict(
+			date__range=[start_date, end_date],
+			user=self.user
+		)
+		if asset := report.get_opts('asset', None):
+			qs_options['asset'] = asset
+		if institution := report.get_opts('institution', None):
+			qs_options['institution_name'] = institution.name
+		if categories := report.get_opts('categories', None):
+			qs_options['asset__category__in'] = categories
+		queryset = self.trade_summary_model.objects.filter(
+			**qs_options
+		).annotate(
+			month=ExtractMonth('date')
+		).values('month').annotate(
+			buy_count=Sum('buy_count'),
+			sell_count=Sum('sell_count')
+		).order_by('month')
+		return {obj['month']: (obj['buy_count'] or 0) + (obj['sell_count'] or 0)
+		        for obj in queryset}
+
 	def _get_position_months(self, reports: BaseReportMonth):
 		"""https://stackoverflow.com/questions/37851053/django-query-group-by-month"""
 		report = reports.get_last()
@@ -654,15 +630,17 @@ class BreadcrumbMonthsAdminPlugin(BaseAdminPlugin):
 		).values('month').annotate(
 			count=Count("asset_id")
 		).order_by('month')
+		positions = {obj['month']: obj['count'] for obj in queryset}
+		trades = self._get_trades_months(report, start_date, end_date)
 		months = []
-		for obj in queryset:
-			month, count = obj['month'], obj['count']
+		for month in sorted(positions.keys() | trades.keys()):
 			date = datetime.date(end_date.year, month=month, day=1)
 			months.append({
 				'name': calendar.month_name[month].upper(),
 				'url': self._get_report_url(date),
 				'active': end_date.month == month,
-				'count': count
+				'count': positions.get(month, 0),
+				'trades': trades.get(month, 0)
 			})
 		return months
 
@@ -0,0 +1,190 @@
+import cProfile
+import datetime
+import gzip
+import json
+import logging
+import marshal
+import pstats
+import random
+import re
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger("irpf.profiling")
+
+
+class _ProfileData:
+	"""Interface esperada pelo 'pstats.Stats' para dados já carregados"""
+
+	def __init__(self, stats: dict):
+		self.stats = stats
+
+	def create_stats(self):
+		pass
+
+
+class ProfileStorage:
+	"""Perfis (cProfile) gravados em um diretório local
+	Cada perfil tem o arquivo de dados compactado (.prof.gz, formato do 'pstats') e os
+	metadados da requisição (.json). Os mais antigos são removidos acima do limite.
+	"""
+	key_re = re.compile(r"^[0-9]{8}T[0-9]{6}-[0-9a-f]{8}$")
+
+	def __init__(self, path=None, max_files: int = None):
+		if path is None:
+			path = getattr(settings, "IRPF_PROFILING_DIR", None) or Path(settings.BASE_DIR, "cache", "profiles")
+		if max_files is None:
+			max_files = getattr(settings, "IRPF_PROFILING_MAX_FILES", 200)
+		self.path = Path(path)
+		self.max_files = max_files
+
+	def _get_path(self, key: str, suffix: str) -> Path:
+		if not self.key_re.match(key or ''):
+			raise KeyError(key)
+		return self.path / f"{key}{suffix}"
+
+	def save(self, profiler: cProfile.Profile, **meta) -> str:
+		profiler.create_stats()
+		key = f"{datetime.datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+		self.path.mkdir(parents=True, exist_ok=True)
+		with gzip.open(self._get_path(key, ".prof.gz"), "wb") as fp:
+			marshal.dump(profiler.stats, fp)
+		meta['key'] = key
+		self._get_path(key, ".json").write_text(json.dumps(meta, default=str))
+		self.prune()
+		return key
+
+	def prune(self):
+		"""Remove os perfis mais antigos acima do limite"""
+		for filename in sorted(self.path.glob("*.json"), reverse=True)[self.max_files:]:
+			filename.with_name(filename.name[:-5] + ".prof.gz").unlink(missing_ok=True)
+			filename.unlink(missing_ok=True)
+
+	def get_profiles(self) -> list[dict]:
+		"""Metadados dos perfis (mais recentes primeiro)"""
+		items = []
+		if not self.path.exists():
+			return items
+		for filename in sorted(self.path.glob("*.json"), reverse=True):
+			try:
+				items.append(json.loads(filename.read_text()))
+			except (OSError, ValueError):
+				continue
+		return items
+
+	def get_meta(self, key: str) -> dict:
+		try:
+			return json.loads(self._get_path(key, ".json").read_text())
+		except (OSError, ValueError):
+			raise KeyError(key)
+
+	def read(self, key: str) -> bytes:
+		"""Dados do perfil no formato do 'pstats' (arquivo .prof)"""
+		try:
+			with gzip.open(self._get_path(key, ".prof.gz"), "rb") as fp:
+				return fp.read()
+		except OSError:
+			raise KeyError(key)
+
+	def get_stats(self, key: str) -> pstats.Stats:
+		return pstats.Stats(_ProfileData(marshal.loads(self.read(key))))
+
+	def get_hotspots(self, key: str, limit: int = 50, sort: str = 'cumulative') -> list[dict]:
+		"""Funções com os maiores tempos (acumulado por padrão)"""
+		stats = self.get_stats(key)
+		stats.sort_stats(sort)
+		rows = []
+		for func in stats.fcn_list[:limit]:
+			cc, nc, tt, ct, callers = stats.stats[func]
+			rows.append({
+				'function': pstats.func_std_string(func),
+				'ncalls': nc if nc == cc else f"{nc}/{cc}",
+				'tottime': tt,
+				'cumtime': ct,
+				'percall': ct / cc if cc else 0.0,
+			})
+		return rows
+
+
+class ProfilingMiddleware:
+	"""Perfil (cProfile) de uma amostra das requisições das views de relatório e importação
+	IRPF_PROFILING_SAMPLE_RATE: fração das requisições das views perfiladas (0 desativa a amostra).
+	IRPF_PROFILING_SLOW: segundos; uma requisição lenta sem perfil faz a próxima requisição da
+	mesma view ser perfilada (o cProfile só pode ser ligado antes da execução).
+	"""
+	storage_class = ProfileStorage
+	default_views = (
+		'reportirpf',
+		'reportirpf_asset',
+		'reportirpf_export',
+		'reportirpf_api',
+		'import_listmodel',
+		'xlsx_viewer',
+		'xlsx_viewer_data',
+		'brokerage_note_import',
+	)
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+		self.views = frozenset(getattr(settings, "IRPF_PROFILING_VIEWS", None) or self.default_views)
+		self.sample_rate = getattr(settings, "IRPF_PROFILING_SAMPLE_RATE", 0.0)
+		self.slow = getattr(settings, "IRPF_PROFILING_SLOW", 0)
+		# views com requisições lentas recentes (próxima requisição perfilada, por processo)
+		self.armed = set()
+		self.storage = self.storage_class()
+
+	def get_view_name(self, request):
+		match = getattr(request, "resolver_match", None)
+		if match is None or match.url_name not in self.views:
+			return None
+		return match.url_name
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		if not (self.sample_rate or self.slow) or (name := self.get_view_name(request)) is None:
+			return None
+		sampled = random.random() < self.sample_rate
+		armed = name in self.armed
+		if not (sampled or armed):
+			return None
+		profiler = cProfile.Profile()
+		try:
+			profiler.enable()
+		except ValueError:
+			# outro perfil ativo (outra thread)
+			return None
+		self.armed.discard(name)
+		request.irpf_profile = (profiler, 'sample' if sampled else 'slow')
+		return None
+
+	def __call__(self, request):
+		start = time.perf_counter()
+		response = self.get_response(request)
+		duration = time.perf_counter() - start
+		profile = getattr(request, "irpf_profile", None)
+		if profile is None:
+			if self.slow and duration >= self.slow and (name := self.get_view_name(request)):
+				self.armed.add(name)
+				logger.warning("slow request %s %s (%.3fs)", request.method, request.path, duration)
+			return response
+		profiler, reason = profile
+		profiler.disable()
+		user = getattr(request, "user", None)
+		try:
+			self.storage.save(
+				profiler,
+				created=datetime.datetime.now().isoformat(timespec="seconds"),
+				reason=reason,
+				view=request.resolver_match.url_name,
+				method=request.method,
+				path=request.get_full_path(),
+				status=response.status_code,
+				duration=round(duration, 6),
+				slow=bool(self.slow and duration >= self.slow),
+				user=user.pk if user is not None and user.is_authenticated else None,
+			)
+		except OSError:
+			logger.exception("profile not saved")
+		return response
@@ -1,5 +1,6 @@
 import datetime
 from irpf.report.cache import Cache
+from irpf.report.timing import null_stage
 from irpf.report.utils import OrderedDictResults
 from irpf.utils import MonthYearDates
 
@@ -23,6 +24,12 @@ class Base:
 				raise
 			return args[0]
 
+	def stage(self, name: str):
+		"""Medição da etapa quando o relatório é gerado com 'timer' (StageTimer)"""
+		if (timer := self.options.get('timer')) is None:
+			return null_stage
+		return timer.stage(name)
+
 	def __bool__(self):
 		return bool(self.results)
 
@@ -35,6 +42,9 @@ class Base:
 
 class BaseReport(Base):
 	"""Base report"""
+	# leitura das consultas grandes em blocos (cursor no servidor no postgresql)
+	chunk_size = 2000
+
 	def __init__(self, user, model, **option):
 		super().__init__(user, **option)
 		self.model = model
@@ -1,3 +1,17 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+from django.core.files import locks
+
+from irpf.models import DataVersion
+
+
 class EmptyCacheError(KeyError):
 	...
 
@@ -25,3 +39,148 @@ class Cache:
 
 	def clear(self):
 		self._cache.clear()
+
+
+class ReportCache:
+	"""Cache dos resultados de relatórios (django cache)
+	A chave inclui a versão dos dados do usuário, assim qualquer alteração invalida os resultados.
+	"""
+	key_prefix = "irpf:report"
+
+	def __init__(self, alias: str = None, timeout: int = None):
+		if alias is None:
+			alias = getattr(settings, "IRPF_REPORT_CACHE", DEFAULT_CACHE_ALIAS)
+		if timeout is None:
+			timeout = getattr(settings, "IRPF_REPORT_CACHE_TIMEOUT", 3600)
+		self.cache = caches[alias]
+		self.timeout = timeout
+
+	def get_key(self, user, name: str, params: dict) -> str:
+		"""Chave com o usuário, a versão de dados e os parâmetros do relatório"""
+		version = DataVersion.get_version(user)
+		params = json.dumps(params, sort_keys=True, default=str)
+		digest = hashlib.sha256(params.encode()).hexdigest()
+		return f"{self.key_prefix}:{user.pk}:{version}:{name}:{digest}"
+
+	def get(self, key: str, default=None):
+		return self.cache.get(key, default)
+
+	def set(self, key: str, value):
+		self.cache.set(key, value, self.timeout)
+		return value
+
+
+class _Flight:
+	"""Geração em andamento (compartilhada entre as threads do processo)"""
+
+	def __init__(self):
+		self.event = threading.Event()
+		self.result = None
+		self.error = None
+
+
+class ReportSingleFlight:
+	"""Uma única geração por relatório (mesma chave de cache) em andamento
+	As threads do processo aguardam a geração em andamento; entre processos a coordenação é feita por
+	um arquivo de trava (o processo que aguardou encontra o resultado no cache).
+	"""
+	# intervalo (segundos) entre as tentativas de obter a trava entre processos
+	poll_interval = 0.1
+
+	def __init__(self, lock_dir: str = None, timeout: int = None):
+		if lock_dir is None:
+			lock_dir = getattr(settings, "IRPF_REPORT_LOCK_DIR", None) or os.path.join(
+				tempfile.gettempdir(), "irpf-report-locks")
+		if timeout is None:
+			timeout = getattr(settings, "IRPF_REPORT_SINGLE_FLIGHT_TIMEOUT", 300)
+		self.lock_dir = lock_dir
+		self.timeout = timeout
+		self._lock = threading.Lock()
+		self._flights = {}
+
+	def get_lock_path(self, key: str) -> str:
+		return os.path.join(self.lock_dir, hashlib.sha256(key.encode()).hexdigest() + ".lock")
+
+	def _acquire(self, path: str):
+		"""Abre e trava o arquivo sem bloquear além do prazo ('None' com o tempo esgotado)"""
+		deadline = time.monotonic() + self.timeout
+		while True:
+			fp = open(path, "a+b")
+			try:
+				while not locks.lock(fp, locks.LOCK_EX | locks.LOCK_NB):
+					if time.monotonic() >= deadline:
+						fp.close()
+						return None
+					time.sleep(self.poll_interval)
+				# o arquivo pode ter sido removido por quem liberou a trava (abre o novo arquivo)
+				try:
+					if os.path.samestat(os.fstat(fp.fileno()), os.stat(path)):
+						return fp
+				except OSError:
+					pass
+				locks.unlock(fp)
+			except BaseException:
+				fp.close()
+				raise
+			fp.close()
+
+	def _run_locked(self, key: str, func, lookup):
+		"""Executa 'func' com a trava entre processos (verificando antes o resultado de outro processo)"""
+		if not locks.LOCK_EX:
+			# plataforma sem suporte a travas de arquivo
+			return func()
+		path = self.get_lock_path(key)
+		try:
+			os.makedirs(self.lock_dir, exist_ok=True)
+			fp = self._acquire(path)
+		except OSError:
+			# sem trava entre processos (diretório indisponível)
+			return func()
+		if fp is None:
+			# tempo esgotado: gera o próprio resultado (se ainda não estiver no cache)
+			if (result := lookup()) is not None:
+				return result
+			return func()
+		with fp:
+			try:
+				if (result := lookup()) is not None:
+					return result
+				return func()
+			finally:
+				# a chave inclui a versão dos dados: o arquivo não é usado novamente
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+				locks.unlock(fp)
+
+	def run(self, key: str, func, lookup=lambda: None):
+		"""Retorna o resultado de 'func' ou da geração já em andamento com a mesma chave
+		lookup: busca o resultado pronto (cache) antes de gerar e depois de aguardar outra geração.
+		"""
+		with self._lock:
+			flight = self._flights.get(key)
+			if leader := flight is None:
+				flight = self._flights[key] = _Flight()
+		if not leader:
+			if flight.event.wait(self.timeout):
+				if flight.error is not None:
+					raise flight.error
+				# cópia própria do cache (quando disponível)
+				result = lookup()
+				return flight.result if result is None else result
+			# tempo esgotado: gera o próprio resultado
+			return func()
+		try:
+			flight.result = self._run_locked(key, func, lookup)
+			return flight.result
+		except Exception as exc:
+			flight.error = exc
+			raise
+		finally:
+			with self._lock:
+				self._flights.pop(key, None)
+			flight.event.set()
+
+
+report_single_flight = ReportSingleFlight()
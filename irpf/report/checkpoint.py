@@ -0,0 +1,104 @@
+import calendar
+import datetime
+import hashlib
+import json
+import pickle
+import zlib
+
+from django.utils.crypto import salted_hmac, constant_time_compare
+
+from irpf.models import ReportCheckpoint
+
+
+class ReportCheckpoints:
+	"""Resultados de meses fechados do relatório (ReportCheckpoint)
+	Os resultados são gravados quando as posições do mês são salvas e reaproveitados pelo
+	relatório anual enquanto válidos (alterações nos dados invalidam os meses seguintes).
+	"""
+	checkpoint_model = ReportCheckpoint
+	key_salt = "irpf.report.checkpoint.ReportCheckpoints"
+
+	def __init__(self, user, institution=None, categories=(), asset=None):
+		self.user = user
+		self.institution = institution
+		self.key = self.get_key(categories, asset)
+
+	@staticmethod
+	def get_key(categories, asset) -> str:
+		"""Filtros do relatório que alteram os resultados"""
+		params = json.dumps({
+			'categories': sorted(categories or []),
+			'asset': asset.pk if asset else None
+		}, sort_keys=True)
+		return hashlib.sha256(params.encode()).hexdigest()
+
+	@staticmethod
+	def is_closed(start_date: datetime.date, end_date: datetime.date) -> bool:
+		"""Se o intervalo é o mês completo"""
+		max_day = calendar.monthrange(start_date.year, start_date.month)[1]
+		return start_date.day == 1 and end_date == datetime.date(start_date.year, start_date.month, max_day)
+
+	def _signature(self, data: bytes) -> bytes:
+		return salted_hmac(self.key_salt, data, algorithm="sha256").digest()
+
+	def _dumps(self, results: list) -> bytes:
+		data = zlib.compress(pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL))
+		return self._signature(data) + data
+
+	def _loads(self, data: bytes) -> list:
+		data = bytes(data)
+		signature, data = data[:32], data[32:]
+		# somente dados gerados pelo projeto (pickle)
+		if not constant_time_compare(signature, self._signature(data)):
+			raise ValueError("invalid signature")
+		return pickle.loads(zlib.decompress(data))
+
+	def get_queryset(self):
+		return self.checkpoint_model.objects.filter(
+			user=self.user,
+			institution=self.institution,
+			key=self.key,
+			valid=True
+		)
+
+	def get_contiguous(self, months_range: list) -> dict:
+		"""Resultados dos meses fechados em sequência desde o início do intervalo
+		Retorna {mês: resultados}; a sequência termina no primeiro mês sem resultado válido.
+		"""
+		dates = []
+		for start_date, end_date in months_range:
+			if not self.is_closed(start_date, end_date):
+				break
+			dates.append(end_date)
+		if not dates:
+			return {}
+		rows = dict(self.get_queryset().filter(date__in=dates).values_list('date', 'data'))
+		checkpoints = {}
+		for date in dates:
+			if (data := rows.get(date)) is None:
+				break
+			try:
+				checkpoints[date.month] = self._loads(data)
+			except Exception:
+				# dados inválidos: o mês volta a ser calculado
+				break
+		return checkpoints
+
+	def store(self, report):
+		"""Grava os resultados do relatório (mês fechado)"""
+		end_date = report.get_opts('end_date')
+		instance, _ = self.checkpoint_model.objects.update_or_create(
+			user=self.user,
+			institution=self.institution,
+			key=self.key,
+			date=end_date,
+			defaults={
+				'data': self._dumps(report.get_results()),
+				'valid': True
+			}
+		)
+		return instance
+
+	def invalidate(self, date: datetime.date = None) -> int:
+		"""Invalida os meses a partir da data (todos os filtros da instituição)"""
+		return self.checkpoint_model.invalidate(self.user, date=date, institution=self.institution)
@@ -3,7 +3,7 @@ from collections import OrderedDict
 
 from irpf.models import Asset, Earnings
 from irpf.report.base import BaseReport, BaseReportMonth
-from irpf.report.utils import Assets, Event
+from irpf.report.utils import Assets, Event, MoneyAccumulator
 
 
 class EarningsReport(BaseReport):
@@ -11,6 +11,9 @@ class EarningsReport(BaseReport):
 
 	def __init__(self, model, user, **options):
 		super().__init__(model, user, **options)
+		# somas dos valores de cada evento (aplicadas no final da geração)
+		self.accumulators = {}
+		self.total_field = self.model._meta.get_field('total')
 
 	def consolidate(self, instance: Earnings, asset: Assets):
 		obj = getattr(asset, "credit" if instance.is_credit else "debit")
@@ -19,10 +22,16 @@ class EarningsReport(BaseReport):
 			event = obj[kind_slug]
 		except KeyError:
 			obj[kind_slug] = event = Event(instance.kind)
+			self.accumulators[id(event)] = (event, MoneyAccumulator.from_field(self.total_field))
 
 		event.items.append(instance)
 		event.quantity += instance.quantity
-		event.value += instance.total
+		self.accumulators[id(event)][1].add(instance.total)
+
+	def apply_accumulators(self):
+		for event, accumulator in self.accumulators.values():
+			event.value += accumulator.to_money()
+		self.accumulators.clear()
 
 	def get_queryset(self, start_date: datetime.date, end_date: datetime.date, **options):
 		qs_options = dict(
@@ -50,16 +59,19 @@ class EarningsReport(BaseReport):
 			assets[asset.code] = Assets(ticker=asset.code,
 			                            institution=institution,
 			                            instance=asset)
-			for obj in self.get_queryset(start_date, end_date, **options):
-				self.consolidate(obj, assets[asset.code])
 		else:
 			for asset in self.asset_model.objects.all():
 				assets[asset.code] = Assets(ticker=asset.code,
 				                            institution=institution,
 				                            instance=asset)
-				options['asset'] = asset
-				for obj in self.get_queryset(start_date, end_date, **options):
-					self.consolidate(obj, assets[asset.code])
+			options['asset'] = None
+		# uma única consulta (lida em blocos) para todos os ativos
+		queryset = self.get_queryset(start_date, end_date, **options)
+		for obj in queryset.iterator(chunk_size=self.chunk_size):
+			if (asset_obj := assets.get(obj.code)) is not None:
+				self.consolidate(obj, asset_obj)
+
+		self.apply_accumulators()
 
 		# atualização resultados
 		self.results.clear()
@@ -80,8 +92,11 @@ class EarningsReportMonth(BaseReportMonth):
 			[(start_date, end_date, ...)]
 		"""
 		self.options.update(**options)
+		cancel_token = self.options.get('cancel_token')
 
 		for start_date, end_date in months_range:
+			if cancel_token is not None:
+				cancel_token.check()
 			report = self.report_class(self.user, self.model)
 			report.generate(start_date, end_date, **self.options)
 			self.results[start_date.month] = report
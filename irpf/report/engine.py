@@ -0,0 +1,184 @@
+import datetime
+from collections import namedtuple
+from decimal import Decimal
+
+from django.db.models import Q, F, Sum, Max, Min, Count, FloatField, ExpressionWrapper, Value
+from django.db.models.functions import Cast
+
+from irpf.fields import ScaledDecimalField
+from irpf.models import Negotiation, Bonus, BonusInfo, AssetEvent, AssetConvert, Subscription
+from irpf.report.utils import Buy, MoneyLC
+
+ENGINE_PYTHON = "python"
+ENGINE_SQL = "sql"
+
+# resultado do período para um ativo (valores da posição no final do período)
+Snapshot = namedtuple("Snapshot", [
+	"code", "asset_id",
+	"quantity", "total", "tax",
+	"period_quantity", "period_total", "period_tax",
+	"sell_quantity", "sell_total", "sell_tax",
+	"profits", "losses"
+])
+
+
+def _amount(value) -> Decimal:
+	value = getattr(value, "amount", value)
+	return Decimal(0) if value is None else Decimal(value)
+
+
+class AverageCostSQLEngine:
+	"""Preço médio e lucro/prejuízo calculados pelo banco (uma consulta agregada por código)
+	O resultado é exato apenas quando todas as compras do período antecedem as vendas (o preço médio
+	não muda entre as vendas) e todas as vendas ficam do mesmo lado do preço médio (só lucro ou só
+	prejuízo). Os códigos fora dessas condições, ou afetados por eventos (bonificação, desdobramento,
+	conversão e subscrição), são devolvidos para o cálculo em python.
+	A soma é exata no postgresql e com IRPF_MONEY_STORAGE=integer; no sqlite com decimal é feita em real.
+	A comparação das vendas com o preço médio é sempre feita em real (em reais nos dois armazenamentos).
+	"""
+	negotiation_model = Negotiation
+	bonus_model = Bonus
+	bonus_info_model = BonusInfo
+	event_model = AssetEvent
+	asset_convert_model = AssetConvert
+	subscription_model = Subscription
+
+	def __init__(self, user):
+		self.user = user
+
+	def get_events_codes(self, start_date: datetime.date, end_date: datetime.date) -> set:
+		"""Códigos de ativos com eventos no período"""
+		codes = set()
+		querysets = (
+			self.bonus_model.objects.filter(user=self.user, date_com__range=[start_date, end_date])
+			.values_list('asset__code', flat=True),
+			self.bonus_info_model.objects.filter(user=self.user, bonus__date__range=[start_date, end_date])
+			.values_list('bonus__asset__code', flat=True),
+			self.event_model.objects.filter(user=self.user, date_com__range=[start_date, end_date])
+			.values_list('asset__code', flat=True),
+			self.subscription_model.objects.filter(user=self.user, date__range=[start_date, end_date])
+			.values_list('asset__code', flat=True),
+		)
+		for queryset in querysets:
+			codes.update(queryset.order_by().distinct())
+		for origin, target in self.asset_convert_model.objects.filter(
+				user=self.user, date__range=[start_date, end_date]
+		).values_list('origin__code', 'target__code').order_by().distinct():
+			codes.update((origin, target))
+		return codes
+
+	@staticmethod
+	def _get_float_amount(name: str, field):
+		"""Valor da coluna em reais como real (colunas 'ScaledDecimalField' são divididas pela escala)"""
+		amount = Cast(F(name), FloatField())
+		# campo de valor do MoneyField (onde fica a escala do armazenamento)
+		field = getattr(field, 'amount_field', field)
+		if isinstance(field, ScaledDecimalField):
+			amount = amount / Value(float(10 ** field.scale), output_field=FloatField())
+		return amount
+
+	def get_aggregates(self, queryset):
+		"""Totais de compras e vendas por código (uma única consulta)"""
+		opts = self.negotiation_model._meta
+		price_field, tax_field = opts.get_field('price'), opts.get_field('tax')
+		buy = Q(kind__iexact=self.negotiation_model.KIND_BUY)
+		sell = Q(kind__iexact=self.negotiation_model.KIND_SELL)
+		value = ExpressionWrapper(F('quantity') * F('price'), output_field=price_field)
+		# preço líquido de cada venda (apenas para comparação com o preço médio, em reais)
+		quantity = Cast(F('quantity'), FloatField())
+		net_price = ((quantity * self._get_float_amount('price', price_field) -
+		              self._get_float_amount('tax', tax_field)) / quantity)
+		return queryset.order_by().values('code').annotate(
+			asset_id=Max('asset'),
+			subscriptions=Count('subscription'),
+			buy_quantity=Sum('quantity', filter=buy),
+			buy_value=Sum(value, filter=buy),
+			buy_total=Sum('total', filter=buy),
+			buy_tax=Sum('tax', filter=buy, output_field=tax_field),
+			buy_last=Max('date', filter=buy),
+			sell_quantity=Sum('quantity', filter=sell),
+			sell_value=Sum(value, filter=sell),
+			sell_tax=Sum('tax', filter=sell, output_field=tax_field),
+			sell_first=Min('date', filter=sell),
+			sell_net_min=Min(net_price, filter=sell),
+			sell_net_max=Max(net_price, filter=sell),
+		)
+
+	@staticmethod
+	def get_snapshot(row: dict, position: Buy = None):
+		"""Posição final do código ou None quando o cálculo precisa ser feito em python"""
+		if row['subscriptions']:
+			return None
+		buy_quantity, sell_quantity = _amount(row['buy_quantity']), _amount(row['sell_quantity'])
+		if buy_quantity and sell_quantity and row['buy_last'] >= row['sell_first']:
+			return None
+		buy_tax = _amount(row['buy_tax'])
+		quantity = buy_quantity
+		total = _amount(row['buy_value']) + buy_tax
+		tax = buy_tax
+		if position is not None:
+			quantity += _amount(position.quantity)
+			total += _amount(position.total)
+			tax += _amount(position.tax)
+		profits = losses = Decimal(0)
+		if sell_quantity:
+			if int(quantity) <= 0:
+				return None
+			avg_price, avg_tax = total / int(quantity), tax / int(quantity)
+			sell_tax = _amount(row['sell_tax'])
+			capital = _amount(row['sell_value']) - sell_tax - sell_quantity * avg_price
+			if row['sell_net_min'] >= float(avg_price):
+				profits = capital
+			elif row['sell_net_max'] <= float(avg_price):
+				losses = capital
+			else:
+				return None
+			quantity -= int(sell_quantity)
+			total, tax = quantity * avg_price, quantity * avg_tax
+		return Snapshot(
+			code=row['code'],
+			asset_id=row['asset_id'],
+			quantity=quantity,
+			total=total,
+			tax=tax,
+			period_quantity=buy_quantity,
+			period_total=_amount(row['buy_total']),
+			period_tax=buy_tax,
+			sell_quantity=sell_quantity,
+			sell_total=_amount(row['sell_value']),
+			sell_tax=_amount(row['sell_tax']),
+			profits=profits,
+			losses=losses
+		)
+
+	def compute(self, queryset, start_date: datetime.date, end_date: datetime.date,
+	            positions: dict = None) -> tuple[dict, set]:
+		"""Retorna as posições calculadas (por código) e os códigos que precisam do cálculo em python
+		positions: {código: Buy} com a posição no início do período
+		"""
+		positions = positions or {}
+		events_codes = self.get_events_codes(start_date, end_date)
+		snapshots, fallback = {}, set()
+		for row in self.get_aggregates(queryset):
+			code = row['code']
+			if code in events_codes or (snapshot := self.get_snapshot(row, positions.get(code))) is None:
+				fallback.add(code)
+			else:
+				snapshots[code] = snapshot
+		return snapshots, fallback
+
+	@staticmethod
+	def apply(snapshot: Snapshot, asset):
+		"""Aplica o resultado ao objeto 'Assets' do relatório"""
+		asset.buy = Buy(quantity=snapshot.quantity,
+		                total=MoneyLC(snapshot.total),
+		                tax=MoneyLC(snapshot.tax))
+		asset.period_buy = Buy(quantity=snapshot.period_quantity,
+		                       total=MoneyLC(snapshot.period_total),
+		                       tax=MoneyLC(snapshot.period_tax))
+		asset.sell.quantity += snapshot.sell_quantity
+		asset.sell.total += MoneyLC(snapshot.sell_total)
+		asset.sell.tax += MoneyLC(snapshot.sell_tax)
+		asset.sell.profits += MoneyLC(snapshot.profits)
+		asset.sell.losses += MoneyLC(snapshot.losses)
+		return asset
@@ -0,0 +1,215 @@
+import collections
+import csv
+
+from irpf.report.utils import Assets, Stats
+
+
+def _amount(value):
+	"""Valor numérico de MoneyLC (ou do próprio número)"""
+	return getattr(value, "amount", value)
+
+
+class Echo:
+	"""Objeto no formato de arquivo que só devolve o valor escrito (csv.writer em streaming)"""
+
+	def write(self, value):
+		return value
+
+
+def iter_csv(rows):
+	"""Gera as linhas no formato csv sob demanda"""
+	writer = csv.writer(Echo())
+	for row in rows:
+		yield writer.writerow(row)
+
+
+class ReportExport:
+	"""Linhas (tabela) com os resultados do relatório para exportação"""
+
+	def __init__(self, results: list, stats_categories: collections.OrderedDict = None):
+		self.results = results
+		self.stats_categories = stats_categories or collections.OrderedDict()
+
+	def _get_events_headers(self, name: str) -> collections.OrderedDict:
+		"""Títulos dos eventos (créditos ou débitos) de todos os ativos"""
+		headers = collections.OrderedDict()
+		for asset in self.results:
+			for kind, event in getattr(asset, name).items():
+				headers.setdefault(kind, str(event))
+		return headers
+
+	def get_assets_headers(self, credit: dict, debit: dict) -> list:
+		headers = [
+			"Código", "Nome", "CNPJ", "Categoria",
+			"Posição anterior (data)", "Posição anterior (quantidade)",
+			"Posição anterior (preço médio)", "Posição anterior (total)",
+			"Compras do período (quantidade)", "Compras do período (total)", "Compras do período (taxas)",
+			"Posição (quantidade)", "Posição (preço médio)", "Posição (total)", "Posição (taxas)",
+			"Vendas (quantidade)", "Vendas (preço médio)", "Vendas (total)",
+			"Vendas (lucro)", "Vendas (prejuízo)", "Vendas (taxas)",
+			"Bonificação (quantidade)", "Bonificação (valor)",
+		]
+		headers.extend(f"Crédito - {title}" for title in credit.values())
+		headers.extend(f"Débito - {title}" for title in debit.values())
+		return headers
+
+	def get_asset_row(self, asset: Assets, credit: dict, debit: dict) -> list:
+		instance, position = asset.instance, asset.position
+		period = asset.period
+		row = [
+			asset.ticker,
+			instance.name if instance else None,
+			instance.cnpj if instance else None,
+			instance.category_name if instance and instance.category else None,
+			position.date if position else None,
+			position.quantity if position else None,
+			_amount(position.avg_price) if position else None,
+			_amount(position.total) if position else None,
+			period.buy.quantity,
+			_amount(period.buy.total),
+			_amount(period.buy.tax),
+			asset.buy.quantity,
+			_amount(asset.buy.avg_price),
+			_amount(asset.buy.total),
+			_amount(asset.buy.tax),
+			asset.sell.quantity,
+			_amount(asset.sell.avg_price),
+			_amount(asset.sell.total),
+			_amount(asset.sell.profits),
+			_amount(asset.sell.losses),
+			_amount(asset.sell.tax),
+			asset.bonus.quantity,
+			_amount(asset.bonus.value),
+		]
+		for name, events in ((credit, asset.credit), (debit, asset.debit)):
+			for kind in name:
+				row.append(_amount(event.value) if (event := events.get(kind)) else None)
+		return row
+
+	def iter_assets(self):
+		"""Cabeçalho e uma linha por ativo"""
+		credit = self._get_events_headers("credit")
+		debit = self._get_events_headers("debit")
+		yield self.get_assets_headers(credit, debit)
+		for asset in self.results:
+			if asset:
+				yield self.get_asset_row(asset, credit, debit)
+
+	@staticmethod
+	def get_stats_headers() -> list:
+		return [
+			"Categoria", "Compras", "Vendas",
+			"Lucro tributável", "Lucro isento", "Prejuízo",
+			"Prejuízo compensado", "Prejuízo acumulado", "Patrimônio",
+			"Impostos", "Impostos residuais", "Impostos (total)",
+		]
+
+	@staticmethod
+	def get_stats_row(category_name: str, stats: Stats) -> list:
+		return [
+			category_name,
+			_amount(stats.buy),
+			_amount(stats.sell),
+			_amount(stats.profits),
+			_amount(stats.exempt_profit),
+			_amount(stats.losses),
+			_amount(stats.compensated_losses),
+			_amount(stats.cumulative_losses),
+			_amount(stats.patrimony),
+			_amount(stats.taxes.value),
+			_amount(stats.taxes.residual),
+			_amount(stats.taxes.total),
+		]
+
+	def iter_stats(self):
+		"""Cabeçalho e uma linha por categoria de ativo"""
+		yield self.get_stats_headers()
+		for category_name, stats in self.stats_categories.items():
+			yield self.get_stats_row(category_name, stats)
+
+
+def _decimal(value):
+	"""Número (ou MoneyLC) como texto, sem perda de precisão"""
+	value = _amount(value)
+	return None if value is None else str(value)
+
+
+class ReportSerializer:
+	"""Serialização compacta (json) dos resultados do relatório"""
+	asset_fields = ('ticker', 'name', 'category', 'position', 'period', 'buy', 'sell',
+	                'bonus', 'credit', 'debit')
+
+	def __init__(self, fields=None):
+		if fields:
+			fields = [name for name in self.asset_fields if name in fields]
+		self.fields = fields or self.asset_fields
+
+	@staticmethod
+	def _events(events) -> dict:
+		return {kind: {'title': str(event),
+		               'quantity': _decimal(event.quantity),
+		               'value': _decimal(event.value)}
+		        for kind, event in events.items()}
+
+	@staticmethod
+	def _buy(buy) -> dict:
+		return {'quantity': _decimal(buy.quantity),
+		        'avg_price': _decimal(buy.avg_price),
+		        'total': _decimal(buy.total),
+		        'tax': _decimal(buy.tax)}
+
+	def get_asset_field(self, asset: Assets, name: str):
+		instance = asset.instance
+		if name == 'ticker':
+			return asset.ticker
+		elif name == 'name':
+			return instance.name if instance else None
+		elif name == 'category':
+			return instance.category_name if instance and instance.category else None
+		elif name == 'position':
+			if position := asset.position:
+				return {'date': position.date.isoformat(),
+				        'quantity': _decimal(position.quantity),
+				        'avg_price': _decimal(position.avg_price),
+				        'total': _decimal(position.total),
+				        'tax': _decimal(position.tax)}
+			return None
+		elif name == 'period':
+			return {'buy': self._buy(asset.period.buy)}
+		elif name == 'buy':
+			return self._buy(asset.buy)
+		elif name == 'sell':
+			sell = asset.sell
+			return {'quantity': _decimal(sell.quantity),
+			        'avg_price': _decimal(sell.avg_price),
+			        'total': _decimal(sell.total),
+			        'profits': _decimal(sell.profits),
+			        'losses': _decimal(sell.losses),
+			        'tax': _decimal(sell.tax)}
+		elif name == 'bonus':
+			return {'quantity': _decimal(asset.bonus.quantity),
+			        'value': _decimal(asset.bonus.value)}
+		elif name == 'credit':
+			return self._events(asset.credit)
+		elif name == 'debit':
+			return self._events(asset.debit)
+		raise KeyError(name)
+
+	def serialize_asset(self, asset: Assets) -> dict:
+		return {name: self.get_asset_field(asset, name) for name in self.fields}
+
+	@staticmethod
+	def serialize_stats(stats: Stats) -> dict:
+		return {
+			'buy': _decimal(stats.buy),
+			'sell': _decimal(stats.sell),
+			'profits': _decimal(stats.profits),
+			'exempt_profit': _decimal(stats.exempt_profit),
+			'losses': _decimal(stats.losses),
+			'compensated_losses': _decimal(stats.compensated_losses),
+			'cumulative_losses': _decimal(stats.cumulative_losses),
+			'patrimony': _decimal(stats.patrimony),
+			'taxes': _decimal(stats.taxes.value),
+			'residual_taxes': _decimal(stats.taxes.residual),
+			'taxes_results': _decimal(stats.taxes_results),
+		}
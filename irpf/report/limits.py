@@ -0,0 +1,109 @@
+import contextlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches, DEFAULT_CACHE_ALIAS
+
+
+class ReportError(Exception):
+	"""Falha na geração do relatório (status http da resposta)"""
+	status = 503
+
+
+class ReportCancelled(ReportError):
+	"""Geração interrompida (prazo esgotado ou cancelada)"""
+	status = 503
+
+
+class ReportLimitExceeded(ReportError):
+	"""Limite de relatórios simultâneos do usuário atingido"""
+	status = 429
+
+
+class CancelToken:
+	"""Cancelamento cooperativo: verificado nos laços longos da geração do relatório
+	timeout: prazo em segundos (None ou 0 sem prazo).
+	"""
+
+	def __init__(self, timeout: float = None):
+		self.deadline = time.monotonic() + timeout if timeout else None
+		self.cancelled = False
+
+	def cancel(self):
+		self.cancelled = True
+
+	@property
+	def is_cancelled(self) -> bool:
+		return self.cancelled or (self.deadline is not None and time.monotonic() > self.deadline)
+
+	def check(self):
+		if self.is_cancelled:
+			raise ReportCancelled("A geração do relatório excedeu o tempo limite." if not self.cancelled
+			                      else "A geração do relatório foi cancelada.")
+
+	def __getstate__(self):
+		# o prazo não faz sentido fora do processo (cache de relatórios)
+		return {'deadline': None, 'cancelled': False}
+
+
+class ReportLimiter:
+	"""Limite de gerações simultâneas de relatórios por usuário
+	O contador fica no cache (compartilhado entre processos com um cache como o redis) e expira
+	junto com o prazo da geração, assim um processo interrompido não bloqueia o usuário.
+	"""
+	key_prefix = "irpf:report:running"
+
+	def __init__(self, alias: str = None, max_running: int = None, timeout: int = None):
+		if alias is None:
+			alias = getattr(settings, "IRPF_REPORT_CACHE", DEFAULT_CACHE_ALIAS)
+		if max_running is None:
+			max_running = getattr(settings, "IRPF_REPORT_MAX_RUNNING", 2)
+		if timeout is None:
+			timeout = getattr(settings, "IRPF_REPORT_TIMEOUT", 300)
+		self.cache = caches[alias]
+		self.max_running = max_running
+		self.timeout = timeout
+
+	def get_key(self, user) -> str:
+		return f"{self.key_prefix}:{user.pk}"
+
+	def _incr(self, key: str) -> int:
+		timeout = self.timeout or None
+		self.cache.add(key, 0, timeout)
+		try:
+			count = self.cache.incr(key)
+		except ValueError:
+			# expirou entre o 'add' e o 'incr'
+			self.cache.set(key, 1, timeout)
+			return 1
+		# o prazo conta a partir da geração mais recente (o contador não expira com gerações em andamento)
+		self.cache.touch(key, timeout)
+		return count
+
+	def _decr(self, key: str):
+		try:
+			count = self.cache.decr(key)
+		except ValueError:
+			return
+		if count < 0:
+			# contador recriado durante a geração (não fica negativo)
+			self.cache.delete(key)
+
+	def get_cancel_token(self) -> CancelToken:
+		return CancelToken(self.timeout)
+
+	@contextlib.contextmanager
+	def acquire(self, user):
+		"""Reserva uma geração para o usuário (ReportLimitExceeded acima do limite)"""
+		if not self.max_running:
+			yield self.get_cancel_token()
+			return
+		key = self.get_key(user)
+		count = self._incr(key)
+		try:
+			if count > self.max_running:
+				raise ReportLimitExceeded(f"Limite de {self.max_running} relatórios simultâneos atingido. "
+				                          f"Aguarde a conclusão dos relatórios em andamento.")
+			yield self.get_cancel_token()
+		finally:
+			self._decr(key)
@@ -2,11 +2,16 @@ import calendar
 import datetime
 from collections import OrderedDict
 from decimal import Decimal
+
+from django.conf import settings
+
 from irpf.models import Asset, Earnings, Bonus, Position, AssetEvent, Subscription, BonusInfo, \
 	AssetConvert
 from irpf.report.base import BaseReport, BaseReportMonth
 from irpf.report.cache import EmptyCacheError
-from irpf.report.utils import Event, Assets, Buy, MoneyLC, OrderedDictResults
+from irpf.report.checkpoint import ReportCheckpoints
+from irpf.report.engine import AverageCostSQLEngine, ENGINE_PYTHON, ENGINE_SQL
+from irpf.report.utils import Event, Assets, Buy, MoneyLC, OrderedDictResults, DateGroups
 from irpf.utils import range_dates
 
 
@@ -19,15 +24,20 @@ class NegotiationReport(BaseReport):
 	subscription_model = Subscription
 	bonus_model = Bonus
 	bonus_info_model = BonusInfo
+	sql_engine_class = AverageCostSQLEngine
+	# 'python' (cálculo registro a registro) ou 'sql' (banco, com python para os ativos com eventos)
+	engine = getattr(settings, "IRPF_REPORT_ENGINE", ENGINE_PYTHON)
 
 	def __init__(self, *args, **kwargs):
 		super().__init__(*args, **kwargs)
 		self.assets = {}
+		# resultados carregados de um mês salvo (sem cálculo)
+		self.checkpoint = False
 
 	def get_asset(self, code: str) -> Asset:
 		"""Retorna o registro do ativo (vindo do banco de dados)"""
 		try:
-			asset = self.asset_model.objects.get(code__iexact=code)
+			asset = self.asset_model.objects.get(code=code)
 		except self.asset_model.DoesNotExist:
 			asset = None
 		return asset
@@ -50,7 +60,7 @@ class NegotiationReport(BaseReport):
 
 		# Permite filtrar pelo ativo
 		if asset_instance := qs_options.pop('asset', None):
-			qs_options['code__iexact'] = asset_instance.code
+			qs_options['code'] = asset_instance.code
 		if institution := self.options.get('institution'):
 			qs_options['institution_name'] = institution.name
 
@@ -421,9 +431,9 @@ class NegotiationReport(BaseReport):
 		if institution := options.get('institution'):
 			qs_options['institution_name'] = institution.name
 		if assetft := qs_options.pop('asset', None):
-			qs_options['code__iexact'] = assetft.code
+			qs_options['code'] = assetft.code
 		queryset = self.earnings_model.objects.filter(**qs_options)
-		for instance in queryset:
+		for instance in queryset.iterator(chunk_size=self.chunk_size):
 			by_date.setdefault(instance.date, []).append(instance)
 		return by_date
 
@@ -525,6 +535,20 @@ class NegotiationReport(BaseReport):
 				positions[assets.ticker] = assets
 		return positions
 
+	def apply_sql_engine(self, queryset, start_date: datetime.date, end_date: datetime.date) -> list:
+		"""Calcula as posições no banco e retorna os códigos que precisam do cálculo em python"""
+		engine = self.sql_engine_class(self.user)
+		positions = {code: asset.buy for code, asset in self.assets.items()}
+		snapshots, fallback = engine.compute(queryset, start_date, end_date, positions=positions)
+		instances = self.asset_model.objects.in_bulk([s.asset_id for s in snapshots.values() if s.asset_id])
+		institution, asset_instance = self.options.get('institution'), self.options.get('asset')
+		for code, snapshot in snapshots.items():
+			asset = self.get_assets(code,
+			                        instance=instances.get(snapshot.asset_id) or asset_instance,
+			                        institution=institution)
+			engine.apply(snapshot, asset)
+		return list(fallback)
+
 	def generate(self, start_date: datetime.date, end_date: datetime.date, **options):
 		self.options.setdefault('start_date', start_date)
 		self.options.setdefault('end_date', end_date)
@@ -534,35 +558,53 @@ class NegotiationReport(BaseReport):
 		self.options.update(options)
 
 		# cache
-		self.assets = self.get_assets_position(date=start_date, **self.options)
-		assets_queryset = self.get_queryset(**self.options)
+		with self.stage('get_assets_position'):
+			self.assets = self.get_assets_position(date=start_date, **self.options)
+		queryset = self.get_queryset(**self.options)
+		if self.options.get('engine', self.engine) == ENGINE_SQL:
+			# apenas os ativos que o banco não calcula passam pelo cálculo em python
+			with self.stage('apply_sql_engine'):
+				queryset = queryset.filter(code__in=self.apply_sql_engine(queryset, start_date, end_date))
+		# uma única consulta (lida em blocos) no lugar de uma consulta por dia
+		negotiations = DateGroups(queryset.order_by('date', 'pk').iterator(
+			chunk_size=self.chunk_size
+		))
 
 		institution = self.options.get('institution')
 		asset_instance = self.options.get('asset')
+		cancel_token = self.options.get('cancel_token')
 
 		for date in range_dates(start_date, end_date):  # calcula um dia por vez
-			self.apply_asset_convert(date, **self.options)
+			if cancel_token is not None:
+				cancel_token.check()
+			with self.stage('apply_asset_convert'):
+				self.apply_asset_convert(date, **self.options)
 			# inclusão de bônus considera a data da incorporação
-			self.add_bonus(date, **self.options)
+			with self.stage('add_bonus'):
+				self.add_bonus(date, **self.options)
 			# inclusão de subscrições na data de incorporação
-			self.add_subscription(date, **self.options)
-
-			queryset = assets_queryset.filter(date=date)
-			for instance in queryset:
-				asset = self.get_assets(instance.code,
-				                        instance=instance.asset or asset_instance,
-				                        institution=institution)
-				# ignora os registros que já foram contabilizados na posição
-				if asset.is_position_interval(instance.date):
-					continue
-				asset.items.append(instance)
-				# cálculo de compra e venda
-				self.consolidate(instance, asset)
-
-			self.apply_earnings(date, **self.options)
-			self.apply_events(date, **self.options)
+			with self.stage('add_subscription'):
+				self.add_subscription(date, **self.options)
+
+			with self.stage('consolidate'):
+				for instance in negotiations.get(date):
+					asset = self.get_assets(instance.code,
+					                        instance=instance.asset or asset_instance,
+					                        institution=institution)
+					# ignora os registros que já foram contabilizados na posição
+					if asset.is_position_interval(instance.date):
+						continue
+					asset.items.append(instance)
+					# cálculo de compra e venda
+					self.consolidate(instance, asset)
+
+			with self.stage('apply_earnings'):
+				self.apply_earnings(date, **self.options)
+			with self.stage('apply_events'):
+				self.apply_events(date, **self.options)
 			# cria um registro de bônus para os ativos do dia
-			self.registry_bonus(date, **self.options)
+			with self.stage('registry_bonus'):
+				self.registry_bonus(date, **self.options)
 
 		# limpeza de resultados anteriores
 		self.results.clear()
@@ -572,10 +614,36 @@ class NegotiationReport(BaseReport):
 		self.cache.clear()
 		return self.results
 
+	def load(self, start_date: datetime.date, end_date: datetime.date, results: list, **options):
+		"""Usa os resultados salvos do mês no lugar do cálculo"""
+		self.options.setdefault('start_date', start_date)
+		self.options.setdefault('end_date', end_date)
+		self.options.setdefault('consolidation', self.position_model.CONSOLIDATION_MONTHLY)
+		self.options.setdefault('assets_position', None)
+		self.options.setdefault('categories', ())
+		self.options.update(options)
+		self.assets = {asset.ticker: asset for asset in results}
+		self.results.clear()
+		self.results.extend(results)
+		self.checkpoint = True
+		return self.results
+
 
 class NegotiationReportMonth(BaseReportMonth):
 	"""Relatório de todos os meses de um range"""
 	report_class = NegotiationReport
+	checkpoints_class = ReportCheckpoints
+
+	def get_checkpoints(self, months_range: list) -> dict:
+		"""Resultados salvos dos meses fechados (em sequência desde janeiro) do relatório anual"""
+		if not (self.options.get('checkpoint', True) and
+		        self.options.get('consolidation') == self.report_class.position_model.CONSOLIDATION_YEARLY):
+			return {}
+		checkpoints = self.checkpoints_class(self.user,
+		                                     institution=self.options.get('institution'),
+		                                     categories=self.options.get('categories'),
+		                                     asset=self.options.get('asset'))
+		return checkpoints.get_contiguous(months_range)
 
 	def generate(self, months_range: list, **options) -> OrderedDictResults:
 		"""Gera um relatório para cada mês
@@ -583,11 +651,21 @@ class NegotiationReportMonth(BaseReportMonth):
 			[(start_date, end_date, ...)]
 		"""
 		self.options.update(**options)
+		checkpoints = self.get_checkpoints(months_range)
+		cancel_token = self.options.get('cancel_token')
 
 		for start_date, end_date in months_range:
+			if cancel_token is not None:
+				cancel_token.check()
 			report = self.report_class(self.user, self.model)
 			opts = dict(self.options, consolidation=self.report_class.position_model.CONSOLIDATION_MONTHLY)
 
+			# meses já salvos não são calculados novamente
+			if (results := checkpoints.get(start_date.month)) is not None:
+				report.load(start_date, end_date, results, **opts)
+				self.results[start_date.month] = report
+				continue
+
 			# relatório do mês anterior (usado como posição para o mês atual)
 			if report_month := self.results.get(start_date.month - 1):
 				opts['assets_position'] = report_month.get_results()
@@ -3,10 +3,14 @@ import datetime
 from collections import OrderedDict
 from decimal import Decimal
 
+from django.conf import settings
+from django.db.transaction import atomic
 from django.utils.functional import cached_property
 
-from irpf.models import Asset, Statistic, Taxes, TaxRate
+from irpf.models import Asset, Statistic, Taxes, TaxRate, Negotiation, Position
 from irpf.report.base import Base, BaseReportMonth, BaseReport
+from irpf.report.negotiation import NegotiationReportMonth
+from irpf.report.tax_rate import tax_rate_resolver
 from irpf.report.utils import Stats, MoneyLC, OrderedDictResults
 
 
@@ -16,9 +20,12 @@ class StatsReport(Base):
 	statistic_model = Statistic
 	taxes_model = Taxes
 
-	def __init__(self, user, report: BaseReport, tax_rate: TaxRate, **options):
+	def __init__(self, user, report: BaseReport, tax_rate: TaxRate, statistic_resolver=None, **options):
+		# medição das etapas junto com o relatório
+		options.setdefault('timer', report.get_opts('timer', None))
 		super().__init__(user, **options)
 		self.report = report
+		self.statistic_resolver = statistic_resolver
 		self.results = OrderedDictResults()
 		self.start_date = self.report.get_opts('start_date')
 		self.end_date = self.report.get_opts('end_date')
@@ -26,21 +33,26 @@ class StatsReport(Base):
 
 	def _get_statistics(self, date: datetime.date, category: int, **options):
 		options.setdefault('consolidation', self.report.get_opts('consolidation'))
+		# a data de posição é sempre o último dia do mês ou ano.
+		if date.month - 1 > 0:
+			max_day = calendar.monthrange(date.year, date.month - 1)[1]
+			date = datetime.date(date.year, date.month - 1, max_day)
+		else:
+			max_day = calendar.monthrange(date.year - 1, 12)[1]
+			date = datetime.date(date.year - 1, 12, max_day)
+		if self.statistic_resolver is not None:
+			return self.statistic_resolver.get(date, category,
+			                                   consolidation=options['consolidation'],
+			                                   institution=options.get('institution'),
+			                                   backfill=options.get('backfill', True))
 		query = dict(
 			consolidation=options['consolidation'],
 			category=category,
+			date=date,
 			user=self.user
 		)
 		if institution := options.get('institution'):
 			query['institution'] = institution
-
-		# a data de posição é sempre o último dia do mês ou ano.
-		if date.month - 1 > 0:
-			max_day = calendar.monthrange(date.year, date.month - 1)[1]
-			query['date'] = datetime.date(date.year, date.month - 1, max_day)
-		else:
-			max_day = calendar.monthrange(date.year - 1, 12)[1]
-			query['date'] = datetime.date(date.year - 1, 12, max_day)
 		try:
 			instance = self.statistic_model.objects.get(**query)
 		except self.statistic_model.DoesNotExist:
@@ -237,8 +249,10 @@ class StatsReport(Base):
 			stats.patrimony += asset.buy.total
 
 		# taxas de período
-		self.generate_taxes()
-		self.generate_residual_taxes(**self.options)
+		with self.stage('generate_taxes'):
+			self.generate_taxes()
+		with self.stage('generate_residual_taxes'):
+			self.generate_residual_taxes(**self.options)
 		self.cache.clear()
 		return self.results
 
@@ -246,23 +260,28 @@ class StatsReport(Base):
 class StatsReports(Base):
 	"""Um conjunto de relatório dentro de vários meses"""
 	report_class = StatsReport
-	tax_rate_model = TaxRate
+	tax_rate_resolver = tax_rate_resolver
 
-	def __init__(self, user, reports: BaseReportMonth, **options):
+	def __init__(self, user, reports: BaseReportMonth, statistic_resolver=None, **options):
 		super().__init__(user, **options)
-		self.tax_rate_model.cache_clear(user)
 		self.start_date: datetime.date = reports.start_date
 		self.end_date: datetime.date = reports.end_date
-		self.tax_rate: TaxRate = self.tax_rate_model.get_from_date(user, reports.start_date, reports.end_date)
+		self.tax_rate: TaxRate = self.tax_rate_resolver.get_from_date(reports.start_date, reports.end_date)
 		self.reports: BaseReportMonth = reports
+		if statistic_resolver is None:
+			statistic_resolver = StatisticResolver(user, cancel_token=reports.get_opts('cancel_token', None))
+		self.statistic_resolver = statistic_resolver
 		self.results = OrderedDictResults()
 
 	def generate(self, **options) -> OrderedDict[int]:
 		"""Gera dados de estatística para cada mês de relatório"""
-
+		cancel_token = self.reports.get_opts('cancel_token', None)
 		for month in self.reports:
+			if cancel_token is not None:
+				cancel_token.check()
 			report = self.reports[month]
-			stats = self.report_class(self.user, report, self.tax_rate)
+			stats = self.report_class(self.user, report, self.tax_rate,
+			                          statistic_resolver=self.statistic_resolver)
 
 			opts = dict(options)
 			if stats_month := self.results.get(month - 1):
@@ -327,3 +346,163 @@ class StatsReports(Base):
 		"""Retorna o relatório do último mês"""
 		return self.results[self.end_date.month]
 
+
+class StatisticResolver:
+	"""Estatística do mês anterior (prejuízo acumulado e impostos residuais)
+	Quando o mês não foi salvo, os meses seguintes à estatística salva pelo usuário mais próxima (ou ao
+	início das negociações) são calculados e gravados como não autoritativos ('authoritative=False').
+	cancel_token: cancelamento da requisição (o cálculo pode percorrer vários anos).
+	max_months: limite de meses calculados na requisição (0 sem limite; usado pelo comando 'stats_backfill').
+	"""
+	statistic_model = Statistic
+	negotiation_model = Negotiation
+	position_model = Position
+	reports_class = NegotiationReportMonth
+	stats_reports_class = StatsReports
+
+	def __init__(self, user, cancel_token=None, max_months: int = None):
+		if max_months is None:
+			max_months = getattr(settings, "IRPF_STATS_BACKFILL_MAX_MONTHS", 24)
+		self.user = user
+		self.cancel_token = cancel_token
+		self.max_months = max_months
+		self._memo = {}
+
+	@staticmethod
+	def get_month_end(date: datetime.date) -> datetime.date:
+		return date.replace(day=calendar.monthrange(date.year, date.month)[1])
+
+	def get_queryset(self, consolidation: int, institution=None):
+		# 'institution=None' são as estatísticas de todas as instituições
+		return self.statistic_model.objects.filter(
+			consolidation=consolidation,
+			institution=institution,
+			user=self.user,
+			valid=True
+		)
+
+	def get(self, date: datetime.date, category: int, consolidation: int, institution=None,
+	        backfill: bool = True):
+		"""Estatística da categoria na data (último dia do mês)"""
+		key = (date, category, consolidation, institution.pk if institution else None)
+		try:
+			return self._memo[key]
+		except KeyError:
+			pass
+		queryset = self.get_queryset(consolidation, institution)
+		instance = queryset.filter(category=category, date=date).order_by('-authoritative', 'pk').first()
+		if instance is None:
+			if not (backfill and consolidation == self.position_model.CONSOLIDATION_MONTHLY):
+				# sem cálculo o mês pode ser gravado depois (não memoriza)
+				return instance
+			if self.backfill(date, institution):
+				instance = queryset.filter(category=category, date=date).order_by('-authoritative', 'pk').first()
+		self._memo[key] = instance
+		return instance
+
+	def get_start_date(self, date: datetime.date, institution=None):
+		"""Primeiro mês a calcular (após a estatística salva pelo usuário mais próxima ou início das negociações)
+		As estatísticas calculadas não têm posições salvas; recomeçar depois delas perderia o custo dos ativos.
+		"""
+		consolidation = self.position_model.CONSOLIDATION_MONTHLY
+		queryset = self.get_queryset(consolidation, institution).filter(date__lt=date, authoritative=True)
+		if last_date := queryset.order_by('-date').values_list('date', flat=True).first():
+			return last_date + datetime.timedelta(days=1)
+		queryset = self.negotiation_model.objects.filter(user=self.user, date__lte=date)
+		if institution:
+			queryset = queryset.filter(institution_name=institution.name)
+		if first_date := queryset.order_by('date').values_list('date', flat=True).first():
+			return first_date.replace(day=1)
+		return None
+
+	def get_months_range(self, start_date: datetime.date, end_date: datetime.date):
+		"""Intervalos mensais de 'start_date' até 'end_date' agrupados por ano"""
+		years = []
+		while start_date <= end_date:
+			months = []
+			year = start_date.year
+			while start_date <= end_date and start_date.year == year:
+				month_end = self.get_month_end(start_date)
+				months.append((start_date, month_end))
+				start_date = month_end + datetime.timedelta(days=1)
+			years.append(months)
+		return years
+
+	def _save(self, stats, institution=None) -> list:
+		"""Grava as estatísticas dos meses calculados (não autoritativas)"""
+		consolidation = self.position_model.CONSOLIDATION_MONTHLY
+		asset_model = self.stats_reports_class.report_class.asset_model
+		objs = []
+		for month in stats:
+			stats_report = stats[month]
+			end_date = stats_report.report.get_opts('end_date')
+			for category_name, stats_category in stats_report.get_results().items():
+				objs.append(self.statistic_model(
+					category=asset_model.get_category_by_name(category_name),
+					consolidation=consolidation,
+					institution=institution,
+					date=end_date,
+					user=self.user,
+					residual_taxes=stats_category.taxes.residual,
+					cumulative_losses=stats_category.cumulative_losses,
+					valid=True,
+					authoritative=False
+				))
+		if objs:
+			queryset = self.statistic_model.objects.filter(
+				consolidation=consolidation,
+				institution=institution,
+				date__in={obj.date for obj in objs},
+				user=self.user
+			)
+			# categorias já salvas no mês são mantidas
+			saved = set(queryset.filter(valid=True).values_list('date', 'category'))
+			objs = [obj for obj in objs if (obj.date, obj.category) not in saved]
+			# registros inválidos dos mesmos meses (unique_together) são atualizados: mantém os impostos
+			# relacionados ('Taxes.stats') dos registros do usuário
+			invalid = dict(((date, category), pk) for pk, date, category in
+			               queryset.filter(valid=False).values_list('pk', 'date', 'category'))
+			created = []
+			for obj in objs:
+				if (pk := invalid.get((obj.date, obj.category))) is None:
+					created.append(obj)
+					continue
+				# sem sinais (não altera a versão dos dados do usuário)
+				self.statistic_model.objects.filter(pk=pk).update(
+					residual_taxes=obj.residual_taxes,
+					cumulative_losses=obj.cumulative_losses,
+					valid=True,
+					authoritative=False
+				)
+			self.statistic_model.objects.bulk_create(created)
+		return objs
+
+	def backfill(self, date: datetime.date, institution=None) -> bool:
+		"""Calcula e grava as estatísticas até a data (último dia do mês)
+		Cada ano é gravado na própria transação; acima de 'max_months' nada é calculado.
+		"""
+		if (start_date := self.get_start_date(date, institution)) is None or start_date > date:
+			return False
+		years = self.get_months_range(start_date, date)
+		if self.max_months and sum(map(len, years)) > self.max_months:
+			return False
+		assets_position = None
+		for months_range in years:
+			if self.cancel_token is not None:
+				self.cancel_token.check()
+			reports = self.reports_class(self.user, self.negotiation_model)
+			# o token também é verificado entre os meses (relatórios e estatísticas)
+			reports.generate(months_range,
+			                 consolidation=self.position_model.CONSOLIDATION_YEARLY,
+			                 institution=institution,
+			                 categories=(),
+			                 asset=None,
+			                 cancel_token=self.cancel_token,
+			                 # janeiro usa o resultado de dezembro (o ano anterior não tem posições salvas)
+			                 assets_position=assets_position)
+			stats = self.stats_reports_class(self.user, reports, statistic_resolver=self)
+			stats.generate(institution=institution, backfill=False)
+			with atomic():
+				self._save(stats, institution)
+			assets_position = reports.get_last().get_results()
+		return True
@@ -0,0 +1,79 @@
+import bisect
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+from irpf.models import TaxRate
+
+
+class TaxRateResolver:
+	"""Localiza a alíquota válida para um período
+	Todas as alíquotas (com 'DayTrade' e 'SwingTrade') ficam em uma lista ordenada pelo início
+	da validade. O máximo acumulado de 'valid_until' permite responder cada consulta com uma
+	busca binária. Os períodos sem registro (valores padrão) ficam em um cache limitado (LRU).
+	"""
+	tax_rate_model = TaxRate
+	max_size = 128
+	# recarga periódica (alterações feitas por outros processos)
+	max_age = 300
+
+	def __init__(self, max_size: int = None, max_age: int = None):
+		if max_size is not None:
+			self.max_size = max_size
+		if max_age is not None:
+			self.max_age = max_age
+		self._lock = threading.RLock()
+		self._defaults = OrderedDict()
+		self._starts = None
+		self._prefix_max = None
+		self._loaded = 0.0
+
+	def get_queryset(self):
+		return self.tax_rate_model.objects.select_related('daytrade', 'swingtrade')
+
+	def _load(self):
+		tax_rates = sorted(self.get_queryset(), key=lambda obj: obj.valid_start)
+		prefix_max, tax_rate_max = [], None
+		for tax_rate in tax_rates:
+			# empate: mantém o primeiro ('first' da consulta ordenada por '-valid_until')
+			if tax_rate_max is None or tax_rate.valid_until > tax_rate_max.valid_until:
+				tax_rate_max = tax_rate
+			prefix_max.append(tax_rate_max)
+		self._starts = [tax_rate.valid_start for tax_rate in tax_rates]
+		self._prefix_max = prefix_max
+		self._defaults.clear()
+		self._loaded = time.monotonic()
+
+	def _is_expired(self) -> bool:
+		return self._starts is None or time.monotonic() - self._loaded > self.max_age
+
+	def _find(self, start_date: datetime.date, end_date: datetime.date):
+		"""Alíquota com 'valid_start <= start_date' e o maior 'valid_until >= end_date'"""
+		index = bisect.bisect_right(self._starts, start_date)
+		if index and (tax_rate := self._prefix_max[index - 1]).valid_until >= end_date:
+			return tax_rate
+
+	def get_from_date(self, start_date: datetime.date, end_date: datetime.date) -> TaxRate:
+		with self._lock:
+			if self._is_expired():
+				self._load()
+			if (tax_rate := self._find(start_date, end_date)) is not None:
+				return tax_rate
+			key = (start_date, end_date)
+			if (tax_rate := self._defaults.get(key)) is None:
+				tax_rate = self.tax_rate_model.create_instance(start_date, end_date)
+				self._defaults[key] = tax_rate
+				if len(self._defaults) > self.max_size:
+					self._defaults.popitem(last=False)
+			else:
+				self._defaults.move_to_end(key)
+			return tax_rate
+
+	def clear(self):
+		with self._lock:
+			self._starts = self._prefix_max = None
+			self._defaults.clear()
+
+
+tax_rate_resolver = TaxRateResolver()
@@ -0,0 +1,96 @@
+import contextlib
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from django.db import connections
+
+logger = logging.getLogger("irpf.report.timing")
+
+null_stage = contextlib.nullcontext()
+
+
+class Stage:
+	"""Totais de uma etapa (todas as chamadas)"""
+
+	def __init__(self, name: str):
+		self.name = name
+		self.calls = 0
+		self.time = 0.0
+		self.queries = 0
+		self.sql_time = 0.0
+
+	def as_dict(self) -> dict:
+		return {
+			'name': self.name,
+			'calls': self.calls,
+			'time': round(self.time, 6),
+			'queries': self.queries,
+			'sql_time': round(self.sql_time, 6),
+		}
+
+
+class StageTimer:
+	"""Tempo, número de consultas e tempo de sql por etapa da geração do relatório
+	As consultas são atribuídas à etapa mais interna em andamento; o tempo de uma etapa inclui
+	o das etapas internas. Ativo apenas quando solicitado (campo 'ts' do relatório).
+	"""
+
+	def __init__(self):
+		self.stages = OrderedDict()
+		self._stack = []
+		self.start = time.perf_counter()
+
+	def get_stage(self, name: str) -> Stage:
+		if (stage := self.stages.get(name)) is None:
+			stage = self.stages[name] = Stage(name)
+		return stage
+
+	@contextlib.contextmanager
+	def stage(self, name: str):
+		stage = self.get_stage(name)
+		self._stack.append(stage)
+		start = time.perf_counter()
+		try:
+			yield stage
+		finally:
+			stage.time += time.perf_counter() - start
+			stage.calls += 1
+			self._stack.pop()
+
+	def __call__(self, execute, sql, params, many, context):
+		"""'execute_wrapper' do django (conta as consultas da etapa atual)"""
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			if self._stack:
+				stage = self._stack[-1]
+				stage.queries += 1
+				stage.sql_time += time.perf_counter() - start
+
+	@contextlib.contextmanager
+	def activate(self, using=None):
+		"""Instala o contador de consultas nas conexões (todas quando 'using' for None)"""
+		with contextlib.ExitStack() as stack:
+			for alias in ([using] if using else connections):
+				stack.enter_context(connections[alias].execute_wrapper(self))
+			yield self
+
+	@property
+	def total(self) -> float:
+		return time.perf_counter() - self.start
+
+	def as_list(self) -> list:
+		return [stage.as_dict() for stage in self.stages.values()]
+
+	def get_server_timing(self) -> str:
+		"""Cabeçalho 'Server-Timing' (milissegundos)"""
+		return ", ".join(f'{name};dur={stage.time * 1000:.1f};desc="{stage.queries} sql"'
+		                 for name, stage in self.stages.items())
+
+	def log(self, **extra):
+		"""Registro estruturado (json) das etapas"""
+		logger.info(json.dumps(dict(extra, total=round(self.total, 6), stages=self.as_list()),
+		                       default=str))
@@ -1,11 +1,14 @@
 import copy
 import datetime
 import decimal
+import itertools
 from collections import OrderedDict
 from decimal import Decimal
 import moneyfield.fields
 from correpy.domain.enums import TransactionType
 
+from irpf.fields import ScaledDecimalField
+
 
 class MoneyLC(moneyfield.fields.MoneyLC):
 	"""Default BRL Currency"""
@@ -15,6 +18,48 @@ class MoneyLC(moneyfield.fields.MoneyLC):
 		super().__init__(amount=amount, currency=currency)
 
 
+class MoneyAccumulator:
+	"""Soma de valores monetários em um inteiro escalado (10^-scale BRL)
+	Em laços longos evita criar um MoneyLC (e Decimal) a cada soma; o resultado é convertido uma única vez.
+	A escala deve ser a do armazenamento dos valores somados ('from_field') para a soma ser exata.
+	"""
+	__slots__ = ('scale', 'value')
+
+	def __init__(self, scale: int = 8):
+		self.scale = scale
+		self.value = 0
+
+	@classmethod
+	def from_field(cls, field):
+		"""Acumulador com as casas decimais armazenadas pelo campo (inteiro escalado ou decimal)"""
+		field = getattr(field, 'amount_field', field)
+		if isinstance(field, ScaledDecimalField):
+			return cls(field.scale)
+		return cls(field.decimal_places)
+
+	def add_scaled(self, value: int):
+		"""Soma um valor já escalado (ex: coluna 'ScaledDecimalField' lida com 'values_list')"""
+		self.value += value
+		return self
+
+	def add(self, value):
+		value = Decimal(getattr(value, "amount", value)).scaleb(self.scale)
+		self.value += int(value.to_integral_value(rounding=decimal.ROUND_HALF_EVEN))
+		return self
+
+	__iadd__ = add
+
+	@property
+	def amount(self) -> Decimal:
+		return Decimal(self.value).scaleb(-self.scale)
+
+	def to_money(self) -> MoneyLC:
+		return MoneyLC(self.amount)
+
+	def __bool__(self):
+		return bool(self.value)
+
+
 def as_int_desc(value) -> Decimal:
 	try:
 		value = Decimal(int(value))
@@ -275,6 +320,25 @@ class Period:
 		self.sell = Sell() if sell is None else sell
 
 
+class DateGroups:
+	"""Registros agrupados por data a partir de uma leitura em ordem crescente de data (streaming)
+	As datas devem ser consultadas em ordem crescente; apenas o grupo atual fica em memória.
+	"""
+
+	def __init__(self, iterable, key=lambda obj: obj.date):
+		self._groups = itertools.groupby(iterable, key=key)
+		self._current = next(self._groups, None)
+
+	def get(self, date: datetime.date) -> list:
+		while self._current is not None and self._current[0] < date:
+			self._current = next(self._groups, None)
+		if self._current is not None and self._current[0] == date:
+			items = list(self._current[1])
+			self._current = next(self._groups, None)
+			return items
+		return []
+
+
 class Assets:
 	"""Ativos"""
 
@@ -300,6 +364,8 @@ class Assets:
 		self.institution = institution
 		self.instance = instance
 		self.conv = []
+		# compras do período já totalizadas (cálculo feito pelo banco, sem 'items')
+		self.period_buy = None
 
 	def is_position_interval(self, date: datetime.date):
 		"""Se a data presenta uma posição já calculada"""
@@ -315,12 +381,18 @@ class Assets:
 		self.credit.include(asset.credit)
 		self.debit.include(asset.debit)
 		self.bonus.update(asset.bonus)
+		if asset.period_buy is not None:
+			if self.period_buy is None:
+				self.period_buy = Buy()
+			self.period_buy.update(asset.period_buy)
 		return self
 
 	@property
 	def period(self) -> Period:
 		"""Compras e vendas do intervalo (sem posição)"""
 		period = Period(sell=self.sell)
+		if self.period_buy is not None:
+			period.buy.update(self.period_buy)
 		for instance in self.items:
 			if not instance.is_buy:
 				continue
@@ -355,6 +427,7 @@ class Assets:
 			instance=self.instance,
 			position=self.position
 		)
+		cpy.period_buy = copy.deepcopy(self.period_buy, memo)
 		return cpy
 
 	def __iter__(self):
@@ -0,0 +1,227 @@
+import datetime
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import pre_save, post_save, post_delete, m2m_changed
+
+from irpf.models import (
+	DataVersion,
+	Asset,
+	Institution,
+	Negotiation,
+	MonthlyTradeSummary,
+	ReportCheckpoint,
+	Earnings,
+	Bonus,
+	BonusInfo,
+	Subscription,
+	BrokerageNote,
+	AssetEvent,
+	AssetConvert,
+	Position,
+	Statistic,
+	Taxes,
+	TaxRate,
+	DayTrade,
+	SwingTrade
+)
+from irpf.report.tax_rate import tax_rate_resolver
+
+# modelos do usuário que alteram os resultados dos relatórios
+user_data_models = (
+	Negotiation,
+	Earnings,
+	Bonus,
+	BonusInfo,
+	Subscription,
+	BrokerageNote,
+	AssetEvent,
+	AssetConvert,
+	Position,
+	Statistic,
+	Taxes
+)
+
+# modelos compartilhados entre todos os usuários
+shared_data_models = (
+	Asset,
+	Institution,
+	TaxRate,
+	DayTrade,
+	SwingTrade
+)
+
+# modelos usados no cálculo dos meses (invalidam os resultados salvos a partir da data do registro)
+checkpoint_data_models = (
+	Negotiation,
+	Earnings,
+	Bonus,
+	BonusInfo,
+	Subscription,
+	AssetEvent,
+	AssetConvert
+)
+
+# campos de data considerados na invalidação (o menor valor)
+checkpoint_date_fields = ('date', 'date_com', 'date_ex', 'created')
+
+# alíquotas (invalidam o índice do 'tax_rate_resolver')
+tax_rate_models = (
+	TaxRate,
+	DayTrade,
+	SwingTrade
+)
+
+
+def user_data_changed(sender, instance, **kwargs):
+	if instance.user_id is not None:
+		DataVersion.touch(instance.user_id)
+
+
+def shared_data_changed(sender, instance, **kwargs):
+	DataVersion.touch()
+
+
+def tax_rate_changed(sender, instance, **kwargs):
+	tax_rate_resolver.clear()
+
+
+def negotiation_pre_save(sender, instance, **kwargs):
+	"""Guarda o grupo anterior da negociação (alteração de data, código ou instituição)"""
+	instance._trade_summary_key = None
+	if instance.pk is not None and not kwargs.get('raw'):
+		if values := sender.objects.filter(pk=instance.pk).values_list(
+				'code', 'institution_name', 'date').first():
+			code, institution_name, date = values
+			instance._trade_summary_key = (code, institution_name, MonthlyTradeSummary.get_month(date))
+
+
+def negotiation_changed(sender, instance, **kwargs):
+	"""Recalcula os totais mensais afetados pela negociação"""
+	if kwargs.get('raw') or instance.user_id is None:
+		return
+	keys = {MonthlyTradeSummary.get_key(instance)}
+	if key := getattr(instance, "_trade_summary_key", None):
+		keys.add(key)
+	MonthlyTradeSummary.refresh(instance.user_id, keys)
+
+
+def _get_checkpoint_date(values: dict):
+	dates = []
+	for name in checkpoint_date_fields:
+		if (value := values.get(name)) is None:
+			continue
+		if isinstance(value, datetime.datetime):
+			value = value.date()
+		dates.append(value)
+	return min(dates) if dates else None
+
+
+def _get_instance_checkpoint_date(instance):
+	# o registro de bonificação usa as datas do bônus
+	if isinstance(instance, BonusInfo):
+		try:
+			instance = instance.bonus
+		except ObjectDoesNotExist:
+			return None
+	return _get_checkpoint_date({name: getattr(instance, name, None) for name in checkpoint_date_fields})
+
+
+def checkpoint_pre_save(sender, instance, **kwargs):
+	"""Guarda a data anterior do registro (uma alteração de data invalida os dois períodos)"""
+	instance._checkpoint_date = None
+	if instance.pk is not None and not kwargs.get('raw'):
+		fields = [field.attname for field in sender._meta.concrete_fields
+		          if field.attname in checkpoint_date_fields]
+		if fields and (values := sender.objects.filter(pk=instance.pk).values(*fields).first()):
+			instance._checkpoint_date = _get_checkpoint_date(values)
+
+
+def checkpoint_data_changed(sender, instance, **kwargs):
+	"""Invalida os resultados salvos (e as estatísticas calculadas) a partir da data do registro
+	Sem data, todos os meses do usuário são invalidados.
+	"""
+	if kwargs.get('raw') or instance.user_id is None:
+		return
+	dates = [date for date in (
+		_get_instance_checkpoint_date(instance),
+		getattr(instance, "_checkpoint_date", None)
+	) if date is not None]
+	date = min(dates) if dates else None
+	ReportCheckpoint.invalidate(instance.user_id, date=date)
+	Statistic.invalidate_cache(instance.user_id, date=date)
+
+
+def brokerage_note_deleted(sender, instance, **kwargs):
+	"""Remove o cache de dados extraídos do arquivo da nota (quando não usado por outra nota)"""
+	if not instance.content_hash or sender.objects.filter(content_hash=instance.content_hash).exists():
+		return
+	from irpf.brokerage_note import BrokerageNoteParseCache
+	BrokerageNoteParseCache().delete(instance.content_hash)
+
+
+def checkpoint_position_changed(sender, instance, **kwargs):
+	"""Uma posição altera somente os resultados dos meses seguintes
+	Da instituição da posição e do relatório de todas as instituições (que também lê a posição).
+	"""
+	if kwargs.get('raw') or instance.user_id is None:
+		return
+	date = instance.date + datetime.timedelta(days=1)
+	ReportCheckpoint.invalidate(instance.user_id, date=date, institution=instance.institution_id)
+	ReportCheckpoint.invalidate(instance.user_id, date=date, institution__isnull=True)
+	Statistic.invalidate_cache(instance.user_id, date=date)
+
+
+def checkpoint_shared_changed(sender, instance, **kwargs):
+	"""Ativos e instituições fazem parte dos resultados de todos os usuários"""
+	if not kwargs.get('raw'):
+		ReportCheckpoint.invalidate()
+		Statistic.invalidate_cache()
+
+
+def taxes_stats_changed(sender, instance, action, **kwargs):
+	if action in ("post_add", "post_remove", "post_clear"):
+		user_data_changed(sender, instance)
+
+
+def connect():
+	for model in user_data_models:
+		post_save.connect(user_data_changed, sender=model,
+		                  dispatch_uid=f"irpf_data_version_{model._meta.model_name}_save")
+		post_delete.connect(user_data_changed, sender=model,
+		                    dispatch_uid=f"irpf_data_version_{model._meta.model_name}_delete")
+	for model in shared_data_models:
+		post_save.connect(shared_data_changed, sender=model,
+		                  dispatch_uid=f"irpf_data_version_{model._meta.model_name}_save")
+		post_delete.connect(shared_data_changed, sender=model,
+		                    dispatch_uid=f"irpf_data_version_{model._meta.model_name}_delete")
+	for model in tax_rate_models:
+		post_save.connect(tax_rate_changed, sender=model,
+		                  dispatch_uid=f"irpf_tax_rate_{model._meta.model_name}_save")
+		post_delete.connect(tax_rate_changed, sender=model,
+		                    dispatch_uid=f"irpf_tax_rate_{model._meta.model_name}_delete")
+	pre_save.connect(negotiation_pre_save, sender=Negotiation,
+	                 dispatch_uid="irpf_trade_summary_negotiation_pre_save")
+	post_save.connect(negotiation_changed, sender=Negotiation,
+	                  dispatch_uid="irpf_trade_summary_negotiation_save")
+	post_delete.connect(negotiation_changed, sender=Negotiation,
+	                    dispatch_uid="irpf_trade_summary_negotiation_delete")
+	for model in checkpoint_data_models:
+		pre_save.connect(checkpoint_pre_save, sender=model,
+		                 dispatch_uid=f"irpf_checkpoint_{model._meta.model_name}_pre_save")
+		post_save.connect(checkpoint_data_changed, sender=model,
+		                  dispatch_uid=f"irpf_checkpoint_{model._meta.model_name}_save")
+		post_delete.connect(checkpoint_data_changed, sender=model,
+		                    dispatch_uid=f"irpf_checkpoint_{model._meta.model_name}_delete")
+	post_save.connect(checkpoint_position_changed, sender=Position,
+	                  dispatch_uid="irpf_checkpoint_position_save")
+	post_delete.connect(checkpoint_position_changed, sender=Position,
+	                    dispatch_uid="irpf_checkpoint_position_delete")
+	for model in (Asset, Institution):
+		post_save.connect(checkpoint_shared_changed, sender=model,
+		                  dispatch_uid=f"irpf_checkpoint_{model._meta.model_name}_save")
+		post_delete.connect(checkpoint_shared_changed, sender=model,
+		                    dispatch_uid=f"irpf_checkpoint_{model._meta.model_name}_delete")
+	post_delete.connect(brokerage_note_deleted, sender=BrokerageNote,
+	                    dispatch_uid="irpf_brokerage_note_parse_cache_delete")
+	m2m_changed.connect(taxes_stats_changed, sender=Taxes.stats.through,
+	                    dispatch_uid="irpf_data_version_taxes_stats")
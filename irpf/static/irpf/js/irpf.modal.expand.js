@@ -26,6 +26,7 @@ $(function () {
             $('html,body').scrollTop(scrollTop);
         });
         $el.hide();
+        $parent.find(".asset-detail").collapse("show");
         $parent.detach()
             .appendTo(modal.find(".modal-body"));
         modal.appendTo("body");
@@ -39,9 +39,27 @@ $(function () {
             $form.data('$submitter', null);
         }
     });
-    $('.irpfreport [data-toggle="popover"]').popover({
-        animation: false
-    }).on("shown.bs.popover", function () {
-        $(this).copyClipboard();
+    var popover_init = function ($el) {
+        $el.find('[data-toggle="popover"]').popover({
+            animation: false
+        }).on("shown.bs.popover", function () {
+            $(this).copyClipboard();
+        });
+    }
+    popover_init($('.irpfreport'));
+    // detalhes do ativo carregados na primeira expansão
+    $(".irpfreport .asset-detail[data-url]").on("show.bs.collapse", function (evt) {
+        var $el = $(this);
+        if (evt.target !== this || $el.data("loaded")) {
+            return;
+        }
+        $el.data("loaded", true);
+        $.get($el.data("url")).done(function (content) {
+            $el.html(content);
+            popover_init($el);
+        }).fail(function () {
+            $el.data("loaded", false);
+            $el.find(".fa-spinner").removeClass("fa-spinner fa-spin").addClass("fa-exclamation-triangle");
+        });
     });
 })
\ No newline at end of file
@@ -3,7 +3,11 @@ $(function () {
     $("table.xlsx_viewer:not(.full)").each(function () {
         var $el = $(this).addClass("full");
         $el.DataTable({
-            data: $el.data("items"),
+            // paginação, busca e ordenação feitas no servidor
+            serverSide: true,
+            processing: true,
+            searchDelay: 400,
+            ajax: $el.data("url"),
             language: {
                 url: $el.data("language_url")
             }
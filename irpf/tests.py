@@ -1,3 +1,577 @@
-from django.test import TestCase
+import datetime
+import os
+import pickle
+import tempfile
+import threading
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.files import locks
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase, SimpleTestCase
+from django.urls import reverse
+
+from irpf.brokerage_note import BrokerageNoteImporter, NoteHeader, read_note_header, get_parser_class, \
+	NegotiationMatcher
+from irpf.models import Institution, Asset, Negotiation, Statistic, Position, Earnings, Taxes, MonthlyTradeSummary
+from irpf.report.cache import ReportSingleFlight
+from irpf.report.earnings import EarningsReport
+from irpf.report.engine import AverageCostSQLEngine, ENGINE_PYTHON, ENGINE_SQL, _amount
+from irpf.report.limits import CancelToken, ReportLimiter, ReportLimitExceeded, ReportCancelled
+from irpf.report.negotiation import NegotiationReportMonth, NegotiationReport
+from irpf.report.stats import StatisticResolver
+
+User = get_user_model()
+
+
+class BrokerageNoteImportViewTest(TestCase):
+	def setUp(self):
+		self.user = User.objects.create_superuser("admin", "admin@irpf.local", "admin")
+		self.client.force_login(self.user)
+		self.institution = Institution.objects.create(name="NU INVEST CORRETORA DE VALORES S.A.",
+		                                              cnpj="62.169.875/0001-79")
+
+	def test_import_adminx(self):
+		# os formulários das views são criados na importação do módulo
+		import irpf.adminx  # noqa: F401
+
+	def test_post_multiple_files(self):
+		url = reverse("xadmin:brokerage_note_import")
+		with mock.patch.object(BrokerageNoteImporter, "import_files", return_value=[]) as import_files:
+			response = self.client.post(url, {
+				'institution': self.institution.pk,
+				'notes': [SimpleUploadedFile("nota1.pdf", b"%PDF-1.4 1"),
+				          SimpleUploadedFile("nota2.pdf", b"%PDF-1.4 2")],
+			})
+		self.assertEqual(response.status_code, 302)
+		files = import_files.call_args[0][0]
+		self.assertEqual([file.name for file in files], ["nota1.pdf", "nota2.pdf"])
+
+
+class ReportDataTestCase(TestCase):
+	"""Usuário com negociações de um único ativo"""
+	negotiations = ()
+
+	def setUp(self):
+		self.user = User.objects.create_user("investidor", "investidor@irpf.local", "investidor")
+		self.institution = Institution.objects.create(name="NU INVEST CORRETORA DE VALORES S.A.",
+		                                              cnpj="62.169.875/0001-79")
+		self.asset = Asset.objects.create(code="PETR4", name="PETROBRAS", cnpj="33.000.167/0001-01",
+		                                  category=Asset.CATEGORY_STOCK)
+		for date, kind, quantity, price, tax in self.negotiations:
+			self.add_negotiation(date, kind, quantity, price, tax)
+
+	def add_negotiation(self, date, kind, quantity, price, tax=Decimal(0)):
+		return Negotiation.objects.create(
+			user=self.user,
+			date=date,
+			kind=kind,
+			code=self.asset.code,
+			asset=self.asset,
+			institution_name=self.institution.name,
+			quantity=Decimal(quantity),
+			price=Decimal(price),
+			total=Decimal(quantity) * Decimal(price),
+			tax=Decimal(tax)
+		)
+
+
+class StatisticResolverTest(ReportDataTestCase):
+	negotiations = (
+		(datetime.date(2023, 1, 10), Negotiation.KIND_BUY, 100, "10", 0),
+		(datetime.date(2023, 2, 10), Negotiation.KIND_SELL, 50, "8", 0),
+		(datetime.date(2023, 3, 10), Negotiation.KIND_SELL, 50, "8", 0),
+	)
+
+	def get_statistic(self, date):
+		return Statistic.objects.get(user=self.user,
+		                             category=Asset.CATEGORY_STOCK,
+		                             consolidation=Statistic.CONSOLIDATION_MONTHLY,
+		                             institution=None,
+		                             date=date,
+		                             valid=True)
+
+	def test_backfill_after_invalidate(self):
+		date = datetime.date(2023, 3, 31)
+		self.assertTrue(StatisticResolver(self.user).backfill(date))
+		statistic = self.get_statistic(date)
+		self.assertFalse(statistic.authoritative)
+		self.assertEqual(abs(statistic.cumulative_losses), Decimal(200))
+
+		# os meses anteriores continuam válidos (não autoritativos e sem posições salvas)
+		Statistic.invalidate_cache(self.user, date=datetime.date(2023, 3, 1))
+		self.assertTrue(StatisticResolver(self.user).backfill(date))
+		self.assertEqual(abs(self.get_statistic(date).cumulative_losses), Decimal(200))
+
+	def test_backfill_keeps_invalid_user_statistic(self):
+		date = datetime.date(2023, 2, 28)
+		# estatística do usuário invalidada por um novo cálculo do relatório (com imposto relacionado)
+		statistic = Statistic.objects.create(user=self.user,
+		                                     category=Asset.CATEGORY_STOCK,
+		                                     consolidation=Statistic.CONSOLIDATION_MONTHLY,
+		                                     date=date,
+		                                     valid=False)
+		taxes = Taxes.objects.create(user=self.user,
+		                             total=Decimal(5),
+		                             category=Asset.CATEGORY_STOCK,
+		                             created_date=datetime.date(2022, 1, 1),
+		                             paid=True)
+		taxes.stats.add(statistic)
+		self.assertTrue(StatisticResolver(self.user).backfill(date))
+		statistic.refresh_from_db()
+		self.assertTrue(statistic.valid)
+		self.assertFalse(statistic.authoritative)
+		self.assertEqual(abs(statistic.cumulative_losses), Decimal(100))
+		self.assertEqual(list(statistic.taxes_set.all()), [taxes])
+
+	def test_other_institution_statistic(self):
+		date = datetime.date(2023, 2, 28)
+		# estatística salva somente para uma instituição (não vale para todas as instituições)
+		Statistic.objects.create(user=self.user,
+		                         category=Asset.CATEGORY_STOCK,
+		                         consolidation=Statistic.CONSOLIDATION_MONTHLY,
+		                         institution=self.institution,
+		                         date=date,
+		                         cumulative_losses=Decimal(-999))
+		resolver = StatisticResolver(self.user)
+		self.assertEqual(resolver.get_start_date(date), datetime.date(2023, 1, 1))
+		statistic = resolver.get(date, Asset.CATEGORY_STOCK, Statistic.CONSOLIDATION_MONTHLY)
+		self.assertIsNone(statistic.institution)
+		self.assertEqual(abs(statistic.cumulative_losses), Decimal(100))
+
+	def test_backfill_max_months(self):
+		date = datetime.date(2023, 3, 31)
+		self.assertFalse(StatisticResolver(self.user, max_months=2).backfill(date))
+		self.assertFalse(Statistic.objects.filter(user=self.user).exists())
+		self.assertTrue(StatisticResolver(self.user, max_months=0).backfill(date))
+
+
+class MonthlyTradeSummaryTest(ReportDataTestCase):
+	"""Totais mensais mantidos pelos sinais da negociação e pela vinculação das notas"""
+	negotiations = (
+		(datetime.date(2023, 1, 10), Negotiation.KIND_BUY, 100, "10", "1"),
+		(datetime.date(2023, 1, 20), Negotiation.KIND_SELL, 50, "12", "1"),
+	)
+	january = datetime.date(2023, 1, 1)
+
+	def get_totals(self, date: datetime.date, code: str = "PETR4"):
+		"""(quantidade, total, taxas, negociações) de compras e vendas do grupo (None sem registro)"""
+		try:
+			summary = MonthlyTradeSummary.objects.get(user=self.user, code=code, date=date,
+			                                          institution_name=self.institution.name)
+		except MonthlyTradeSummary.DoesNotExist:
+			return None
+		return (
+			(_amount(summary.buy_quantity), _amount(summary.buy_total), _amount(summary.buy_tax), summary.buy_count),
+			(_amount(summary.sell_quantity), _amount(summary.sell_total), _amount(summary.sell_tax), summary.sell_count),
+		)
+
+	def get_negotiation(self, kind: str) -> Negotiation:
+		return Negotiation.objects.get(user=self.user, kind=kind)
+
+	def test_save(self):
+		self.assertEqual(self.get_totals(self.january), (
+			(Decimal(100), Decimal(1000), Decimal(1), 1),
+			(Decimal(50), Decimal(600), Decimal(1), 1),
+		))
+		self.add_negotiation(datetime.date(2023, 1, 25), Negotiation.KIND_BUY, 10, "11", "0.5")
+		self.assertEqual(self.get_totals(self.january)[0], (Decimal(110), Decimal(1110), Decimal("1.5"), 2))
+
+	def test_date_move(self):
+		negotiation = self.get_negotiation(Negotiation.KIND_BUY)
+		negotiation.date = datetime.date(2023, 2, 5)
+		negotiation.save()
+		# o grupo anterior também é recalculado
+		self.assertEqual(self.get_totals(self.january)[0], (Decimal(0), Decimal(0), Decimal(0), 0))
+		self.assertEqual(self.get_totals(datetime.date(2023, 2, 1))[0], (Decimal(100), Decimal(1000), Decimal(1), 1))
+
+	def test_code_move(self):
+		negotiation = self.get_negotiation(Negotiation.KIND_SELL)
+		negotiation.code = "VALE3"
+		negotiation.asset = None
+		negotiation.save()
+		self.assertEqual(self.get_totals(self.january)[1], (Decimal(0), Decimal(0), Decimal(0), 0))
+		self.assertEqual(self.get_totals(self.january, code="VALE3")[1], (Decimal(50), Decimal(600), Decimal(1), 1))
+
+	def test_delete(self):
+		self.get_negotiation(Negotiation.KIND_SELL).delete()
+		self.assertEqual(self.get_totals(self.january)[1], (Decimal(0), Decimal(0), Decimal(0), 0))
+		self.get_negotiation(Negotiation.KIND_BUY).delete()
+		self.assertIsNone(self.get_totals(self.january))
+
+	def test_negotiation_matcher(self):
+		matcher = NegotiationMatcher(self.user, self.institution)
+		matcher.load([datetime.date(2023, 1, 10)])
+		negotiation, = matcher.negotiations[matcher.get_key(datetime.date(2023, 1, 10), "PETR4",
+		                                                    Negotiation.KIND_BUY, Decimal(100))]
+		# taxa rateada da nota (atualização em lote, sem sinais)
+		negotiation.tax = Decimal(3)
+		matcher.updated[negotiation.pk] = negotiation
+		matcher.save()
+		self.assertEqual(self.get_totals(self.january)[0], (Decimal(100), Decimal(1000), Decimal(3), 1))
+
+
+class EarningsReportTest(ReportDataTestCase):
+	start_date, end_date = datetime.date(2023, 1, 1), datetime.date(2023, 1, 31)
+
+	def add_earnings(self, date, kind, total, flow=Earnings.FLOW_CREDIT):
+		return Earnings.objects.create(
+			user=self.user,
+			date=date,
+			flow=flow,
+			kind=kind,
+			code=self.asset.code,
+			name=self.asset.name,
+			asset=self.asset,
+			institution_name=self.institution.name,
+			quantity=Decimal(100),
+			total=Decimal(total)
+		)
+
+	def generate(self):
+		report = EarningsReport(self.user, Earnings)
+		report.generate(self.start_date, self.end_date, categories=())
+		asset, = [asset for asset in report.get_results() if asset.ticker == self.asset.code]
+		return asset
+
+	def test_exact_sum(self):
+		for day, total in ((5, "0.123456789012"), (10, "1000000.000000000001"), (20, "3.3")):
+			self.add_earnings(datetime.date(2023, 1, day), "Dividendo", total)
+		# soma dos valores armazenados (casas decimais do armazenamento ativo)
+		expected = sum(_amount(obj.total) for obj in Earnings.objects.filter(user=self.user))
+		event = self.generate().credit[Earnings.get_kind_slug("Dividendo")]
+		self.assertEqual(_amount(event.value), expected)
+		self.assertEqual(event.quantity, Decimal(300))
+
+
+class AverageCostSQLEngineTest(ReportDataTestCase):
+	"""O cálculo no banco deve ser igual ao cálculo em python
+	Os campos monetários são criados na importação dos modelos: rodar também com IRPF_MONEY_STORAGE=integer.
+	"""
+	negotiations = (
+		# janeiro: compras antes das vendas (venda com lucro)
+		(datetime.date(2023, 1, 5), Negotiation.KIND_BUY, 100, "10.00", "1.50"),
+		(datetime.date(2023, 1, 6), Negotiation.KIND_BUY, 50, "12.00", "0.75"),
+		(datetime.date(2023, 1, 20), Negotiation.KIND_SELL, 60, "13.00", "0.90"),
+		# fevereiro: venda com prejuízo sobre a posição de abertura (resultado de janeiro)
+		(datetime.date(2023, 2, 10), Negotiation.KIND_SELL, 40, "7.50", "0.60"),
+		# março: compras e vendas intercaladas (cálculo em python)
+		(datetime.date(2023, 3, 1), Negotiation.KIND_BUY, 30, "9.00", "0.45"),
+		(datetime.date(2023, 3, 2), Negotiation.KIND_SELL, 20, "11.00", "0.33"),
+		(datetime.date(2023, 3, 3), Negotiation.KIND_BUY, 10, "8.00", "0.12"),
+		(datetime.date(2023, 3, 4), Negotiation.KIND_SELL, 30, "6.00", "0.27"),
+	)
+	months_range = [
+		(datetime.date(2023, 1, 1), datetime.date(2023, 1, 31)),
+		(datetime.date(2023, 2, 1), datetime.date(2023, 2, 28)),
+		(datetime.date(2023, 3, 1), datetime.date(2023, 3, 31)),
+	]
+
+	def generate(self, engine: str) -> dict:
+		reports = NegotiationReportMonth(self.user, Negotiation)
+		reports.generate(self.months_range,
+		                 consolidation=Position.CONSOLIDATION_YEARLY,
+		                 institution=None,
+		                 categories=(),
+		                 asset=None,
+		                 checkpoint=False,
+		                 engine=engine)
+		results = {}
+		for month in reports:
+			for asset in reports[month].get_results():
+				results[(month, asset.ticker)] = [
+					_amount(value) for value in (
+						asset.buy.quantity, asset.buy.total, asset.buy.tax,
+						asset.sell.quantity, asset.sell.total, asset.sell.tax,
+						asset.sell.profits, asset.sell.losses
+					)
+				]
+		return results
+
+	def test_engine_equivalence(self):
+		python_results = self.generate(ENGINE_PYTHON)
+		sql_results = self.generate(ENGINE_SQL)
+		self.assertEqual(python_results.keys(), sql_results.keys())
+		for key, values in python_results.items():
+			for python_value, sql_value in zip(values, sql_results[key]):
+				self.assertAlmostEqual(float(python_value), float(sql_value), places=4, msg=key)
+		# fevereiro tem somente prejuízo
+		february = sql_results[(2, self.asset.code)]
+		self.assertEqual(february[6], Decimal(0))
+		self.assertNotEqual(february[7], Decimal(0))
+
+	def test_net_price_units(self):
+		"""Preço líquido da venda em reais (independente do armazenamento)"""
+		engine = AverageCostSQLEngine(self.user)
+		queryset = Negotiation.objects.filter(user=self.user, date__range=self.months_range[1])
+		row, = engine.get_aggregates(queryset)
+		self.assertAlmostEqual(row['sell_net_min'], (40 * 7.5 - 0.6) / 40, places=6)
+		self.assertAlmostEqual(row['sell_net_max'], (40 * 7.5 - 0.6) / 40, places=6)
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN QUERY PLAN do sqlite")
+class ReportIndexesTest(TestCase):
+	"""As consultas dos relatórios usam os índices compostos e parciais"""
+	start_date, end_date = datetime.date(2023, 1, 1), datetime.date(2023, 1, 31)
+
+	def setUp(self):
+		self.user = User.objects.create_user("investidor", "investidor@irpf.local", "investidor")
+
+	@staticmethod
+	def get_index_name(model, fields: list) -> str:
+		for index in model._meta.indexes:
+			if index.fields == fields:
+				return index.name
+		raise LookupError(fields)
+
+	def assertIndexUsed(self, queryset, index_name: str):
+		plan = queryset.explain()
+		self.assertIn(f"USING INDEX {index_name} ", plan)
+
+	def test_negotiation_queryset(self):
+		report = NegotiationReport(self.user, Negotiation)
+		queryset = report.get_queryset(start_date=self.start_date, end_date=self.end_date)
+		self.assertIndexUsed(queryset, self.get_index_name(Negotiation, ['user', 'date']))
+
+	def test_earnings_queryset(self):
+		report = EarningsReport(self.user, Earnings)
+		queryset = report.get_queryset(self.start_date, self.end_date, categories=())
+		self.assertIndexUsed(queryset, self.get_index_name(Earnings, ['user', 'date']))
+
+	def test_position_queryset(self):
+		report = NegotiationReport(self.user, Negotiation)
+		queryset = report.get_position_queryset(datetime.date(2023, 2, 1),
+		                                        consolidation=Position.CONSOLIDATION_MONTHLY)
+		self.assertIndexUsed(queryset, "irpf_position_valid_idx")
+
+	def test_statistic_queryset(self):
+		resolver = StatisticResolver(self.user)
+		queryset = resolver.get_queryset(Statistic.CONSOLIDATION_MONTHLY).filter(
+			category=Asset.CATEGORY_STOCK, date=self.end_date)
+		self.assertIndexUsed(queryset, "irpf_statistic_valid_idx")
+
+
+class NoteHeaderTest(TestCase):
+	"""Número e data do pregão lidos da primeira página (layouts B3/sinacor e NuInvest)"""
+	# (x, y, texto) no cabeçalho da primeira página
+	b3_layout = (
+		(30, 30, "NOTA DE CORRETAGEM"),
+		(400, 50, "Nr. nota"), (460, 50, "Folha"), (500, 50, "Data pregão"),
+		(400, 62, "123456"), (460, 62, "1"), (500, 62, "02/01/2023"),
+		(30, 90, "XP INVESTIMENTOS CCTVM S/A"),
+		(560, 120, "C.I"),
+	)
+	nuinvest_layout = (
+		(30, 30, "NOTA DE NEGOCIAÇÃO"),
+		(360, 50, "Número da nota"), (450, 50, "Folha"), (490, 50, "Data pregão"),
+		(360, 62, "98765"), (450, 62, "1"), (490, 62, "15/03/2023"),
+		(30, 100, "NU INVEST CORRETORA DE VALORES S.A."),
+		(500, 130, "Valor/Ajuste D/C"),
+	)
+
+	@staticmethod
+	def make_pdf(items) -> bytes:
+		import fitz
+		with fitz.open() as doc:
+			page = doc.new_page(width=595, height=842)
+			for x, y, text in items:
+				page.insert_text((x, y), text, fontsize=8)
+			return doc.tobytes()
+
+	def get_parser_class(self, cnpj: str):
+		from irpf.adminx import brokerage_note_parsers
+		return get_parser_class(brokerage_note_parsers, Institution(name="Corretora", cnpj=cnpj))
+
+	def test_b3_layout(self):
+		parser_class = self.get_parser_class("02.332.886/0001-04")
+		self.assertEqual(read_note_header(parser_class, self.make_pdf(self.b3_layout)),
+		                 NoteHeader(123456, datetime.date(2023, 1, 2)))
+
+	def test_nuinvest_layout(self):
+		parser_class = self.get_parser_class("62.169.875/0001-79")
+		self.assertEqual(read_note_header(parser_class, self.make_pdf(self.nuinvest_layout)),
+		                 NoteHeader(98765, datetime.date(2023, 3, 15)))
+
+	def test_unknown_layout(self):
+		parser_class = self.get_parser_class("62.169.875/0001-79")
+		self.assertIsNone(read_note_header(parser_class, self.make_pdf(self.b3_layout)))
+		self.assertIsNone(read_note_header(parser_class, b"not a pdf"))
+
+	def test_unexpected_error(self):
+		class Parser:
+			# constante removida/renomeada no correpy (erro registrado no log)
+			CI_TITLE = "C.I"
+		with self.assertLogs("irpf.brokerage_note", level="ERROR"):
+			self.assertIsNone(read_note_header(Parser, self.make_pdf(self.b3_layout)))
+
+
+class ReportSingleFlightTest(SimpleTestCase):
+	"""Uma geração por chave: as demais chamadas aguardam o resultado (threads) ou a trava (processos)"""
+	key = "irpf:report:1:1:test"
+
+	def setUp(self):
+		self.lock_dir = tempfile.TemporaryDirectory()
+		self.addCleanup(self.lock_dir.cleanup)
+		self.single_flight = ReportSingleFlight(lock_dir=self.lock_dir.name, timeout=5)
+		self.started = threading.Event()
+		self.release = threading.Event()
+
+	def leader_func(self, result=None, error=None):
+		self.started.set()
+		self.release.wait(5)
+		if error is not None:
+			raise error
+		return result
+
+	def start(self, func) -> dict:
+		"""Executa 'run' em uma thread (resultado/erro no dicionário retornado)"""
+		output = {}
+
+		def target():
+			try:
+				output['result'] = self.single_flight.run(self.key, func)
+			except Exception as exc:
+				output['error'] = exc
+
+		output['thread'] = thread = threading.Thread(target=target)
+		thread.start()
+		return output
+
+	def start_waiter(self) -> dict:
+		self.assertTrue(self.started.wait(5))
+		waiter = self.start(mock.Mock(return_value="waiter"))
+		# a segunda chamada aguarda a geração em andamento
+		waiter['thread'].join(0.2)
+		self.assertTrue(waiter['thread'].is_alive())
+		return waiter
+
+	def test_coalesce(self):
+		leader = self.start(lambda: self.leader_func(result="leader"))
+		waiter = self.start_waiter()
+		self.release.set()
+		for output in (leader, waiter):
+			output['thread'].join(5)
+			self.assertEqual(output['result'], "leader")
+		# a chave é liberada com o fim da geração
+		self.assertEqual(self.single_flight.run(self.key, lambda: "next"), "next")
+
+	def test_error_propagation(self):
+		error = ValueError("report")
+		leader = self.start(lambda: self.leader_func(error=error))
+		waiter = self.start_waiter()
+		self.release.set()
+		for output in (leader, waiter):
+			output['thread'].join(5)
+			self.assertIs(output['error'], error)
+
+	def test_waiter_timeout(self):
+		self.single_flight.timeout = 0.1
+		leader = self.start(lambda: self.leader_func(result="leader"))
+		self.assertTrue(self.started.wait(5))
+		# tempo esgotado: o resultado é gerado pela própria chamada
+		self.assertEqual(self.single_flight.run(self.key, lambda: "own"), "own")
+		self.release.set()
+		leader['thread'].join(5)
+		self.assertEqual(leader['result'], "leader")
+
+	def test_lookup(self):
+		func = mock.Mock(return_value="generated")
+		self.assertEqual(self.single_flight.run(self.key, func, lookup=lambda: "cached"), "cached")
+		func.assert_not_called()
+
+	@skipUnless(locks.LOCK_EX, "travas de arquivo")
+	def test_lock_file_removed(self):
+		self.assertEqual(self.single_flight.run(self.key, lambda: "result"), "result")
+		self.assertEqual(os.listdir(self.lock_dir.name), [])
+
+	@skipUnless(locks.LOCK_EX, "travas de arquivo")
+	def test_lock_reopen_after_removal(self):
+		path = self.single_flight.get_lock_path(self.key)
+		# outro processo com a trava (descritor próprio)
+		with open(path, "a+b") as holder:
+			self.assertTrue(locks.lock(holder, locks.LOCK_EX | locks.LOCK_NB))
+			output = {}
+			thread = threading.Thread(target=lambda: output.update(fp=self.single_flight._acquire(path)))
+			thread.start()
+			thread.join(0.3)
+			self.assertTrue(thread.is_alive())
+			# o processo termina: remove o arquivo e libera a trava
+			os.remove(path)
+			locks.unlock(holder)
+		thread.join(5)
+		with output['fp'] as fp:
+			# a trava obtida é a do novo arquivo (não a do arquivo removido)
+			self.assertTrue(os.path.samestat(os.fstat(fp.fileno()), os.stat(path)))
+			locks.unlock(fp)
+
+
+class ReportLimiterTest(SimpleTestCase):
+	"""Gerações simultâneas por usuário (contador no cache)"""
+
+	def setUp(self):
+		self.user = User(pk=1)
+		self.limiter = ReportLimiter(max_running=1, timeout=60)
+		self.key = self.limiter.get_key(self.user)
+		self.limiter.cache.delete(self.key)
+		self.addCleanup(self.limiter.cache.delete, self.key)
+
+	def test_over_limit(self):
+		with self.limiter.acquire(self.user) as cancel_token:
+			self.assertIsInstance(cancel_token, CancelToken)
+			with self.assertRaises(ReportLimitExceeded) as context:
+				with self.limiter.acquire(self.user):
+					pass
+			self.assertEqual(context.exception.status, 429)
+			# a tentativa recusada não conta como geração
+			self.assertEqual(self.limiter.cache.get(self.key), 1)
+		self.assertEqual(self.limiter.cache.get(self.key), 0)
+		with self.limiter.acquire(self.user):
+			pass
+
+	def test_decrement_on_error(self):
+		with self.assertRaises(ReportCancelled):
+			with self.limiter.acquire(self.user):
+				raise ReportCancelled
+		self.assertEqual(self.limiter.cache.get(self.key), 0)
+
+	def test_expired_counter(self):
+		with self.limiter.acquire(self.user):
+			# contador expirado durante a geração (não fica negativo)
+			self.limiter.cache.delete(self.key)
+		self.assertIsNone(self.limiter.cache.get(self.key))
+		with self.limiter.acquire(self.user):
+			self.assertEqual(self.limiter.cache.get(self.key), 1)
+
+	def test_unlimited(self):
+		self.limiter.max_running = 0
+		with self.limiter.acquire(self.user), self.limiter.acquire(self.user):
+			self.assertIsNone(self.limiter.cache.get(self.key))
+
+
+class CancelTokenTest(SimpleTestCase):
+	def test_deadline(self):
+		cancel_token = CancelToken(10)
+		self.assertFalse(cancel_token.is_cancelled)
+		cancel_token.check()
+		with mock.patch("irpf.report.limits.time.monotonic", return_value=cancel_token.deadline + 1):
+			self.assertTrue(cancel_token.is_cancelled)
+			with self.assertRaisesMessage(ReportCancelled, "tempo limite"):
+				cancel_token.check()
+
+	def test_without_deadline(self):
+		cancel_token = CancelToken(None)
+		self.assertIsNone(cancel_token.deadline)
+		self.assertFalse(cancel_token.is_cancelled)
+		cancel_token.cancel()
+		with self.assertRaisesMessage(ReportCancelled, "cancelada"):
+			cancel_token.check()
+
+	def test_pickle(self):
+		cancel_token = CancelToken(10)
+		cancel_token.cancel()
+		# o prazo e o cancelamento não são copiados (cache de relatórios)
+		copy = pickle.loads(pickle.dumps(cancel_token))
+		self.assertIsNone(copy.deadline)
+		self.assertFalse(copy.is_cancelled)
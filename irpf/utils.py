@@ -75,8 +75,8 @@ def range_dates(start_of_range: date, end_of_range: date) -> Sequence[date]:
 
 def ticker_validator(ticker: str):
 	"""Faz a validação ticker (formato e tamanho)"""
-	from irpf.fields import CharCodeField
-	return CharCodeField().to_python(ticker)
+	from irpf.fields import normalize_ticker
+	return normalize_ticker(ticker)
 
 
 def update_defaults(instance, defaults):
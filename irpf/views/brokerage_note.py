@@ -0,0 +1,73 @@
+import django.forms as django_forms
+from django.core.exceptions import PermissionDenied
+
+from irpf.brokerage_note import BrokerageNoteImporter, get_parser_class
+from irpf.models import BrokerageNote, Institution
+from irpf.views.base import AdminFormView
+from irpf.widgets import MultipleFileField
+
+
+class BrokerageNoteImportForm(django_forms.Form):
+	institution = django_forms.ModelChoiceField(label="Corretora",
+	                                            queryset=Institution.objects.all(),
+	                                            help_text="A corretora que gerou as notas.")
+	notes = MultipleFileField(label="Notas de corretagem",
+	                          help_text="arquivos pdf ou zip (com vários pdf)")
+	save_transactions = django_forms.BooleanField(label="Registrar negociações",
+	                                              required=False,
+	                                              help_text="Registra as negociações da nota que não existirem.")
+
+
+class AdminBrokerageNoteImportView(AdminFormView):
+	"""Importação em lote de notas de corretagem"""
+	template_name = "irpf/adminx_import_listmodel_view.html"
+	form_class = BrokerageNoteImportForm
+	title = "Importação de notas de corretagem"
+	form_method_post = True
+
+	brokerage_note_model = BrokerageNote
+	brokerage_note_importer = BrokerageNoteImporter
+	brokerage_note_parsers = None
+	brokerage_note_field_update = ()
+	guardian_permissions_models = None
+
+	def init_request(self, *args, **kwargs):
+		super().init_request(*args, **kwargs)
+		if not self.has_model_perm(self.brokerage_note_model, "add"):
+			raise PermissionDenied
+
+	def get_success_url(self):
+		return self.get_model_url(self.brokerage_note_model, "changelist")
+
+	def get_context_data(self, **kwargs):
+		context = super().get_context_data(**kwargs)
+		context['verbose_name'] = self.brokerage_note_model._meta.verbose_name_plural
+		return context
+
+	def _get_parser(self, institution: Institution):
+		"""Retorna o parser da nota corretamente para uma data corretora (instituição)"""
+		return get_parser_class(self.brokerage_note_parsers, institution)
+
+	def form_valid(self, form):
+		institution = form.cleaned_data['institution']
+		importer = self.brokerage_note_importer(
+			self.user, institution,
+			self._get_parser(institution),
+			field_update=self.brokerage_note_field_update,
+			save_transactions=form.cleaned_data['save_transactions'],
+			permissions=self.guardian_permissions_models
+		)
+		try:
+			note_files = importer.import_files(form.cleaned_data['notes'])
+		except Exception as exc:
+			self.message_user(f"Falha na importação das notas: {exc}", level='error')
+			return super().form_valid(form)
+		count = 0
+		for note_file in note_files:
+			if note_file.is_valid:
+				count += 1
+			else:
+				self.message_user(f"{note_file}: {note_file.error}", level='warning')
+		if count > 0:
+			self.message_user(f"{count} nota(s) importada(s) com sucesso!", level='success')
+		return super().form_valid(form)
@@ -0,0 +1,58 @@
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
+from xadmin.views.base import CommAdminView
+
+from irpf.profiling import ProfileStorage
+
+
+class AdminProfilesView(CommAdminView):
+	"""Perfis das requisições lentas ou amostradas (somente superusuário)"""
+	template_name = "irpf/adminx_profiles_view.html"
+	title = "Perfis de requisições"
+	storage_class = ProfileStorage
+	sort_fields = {
+		'cumulative': "Tempo acumulado",
+		'tottime': "Tempo interno",
+		'ncalls': "Chamadas",
+	}
+	limit = 50
+
+	def init_request(self, *args, **kwargs):
+		super().init_request(*args, **kwargs)
+		if not self.user.is_superuser:
+			raise PermissionDenied
+		self.storage = self.storage_class()
+
+	def get_limit(self) -> int:
+		try:
+			return max(1, min(int(self.request.GET.get('limit', self.limit)), 1000))
+		except ValueError:
+			return self.limit
+
+	def download(self, key: str):
+		response = HttpResponse(self.storage.read(key), content_type="application/octet-stream")
+		response['Content-Disposition'] = f'attachment; filename="{key}.prof"'
+		return response
+
+	def get(self, request, *args, **kwargs):
+		context = self.get_context()
+		context['title'] = self.title
+		key = request.GET.get('key')
+		if key:
+			try:
+				if request.GET.get('download'):
+					return self.download(key)
+				sort = request.GET.get('sort')
+				if sort not in self.sort_fields:
+					sort = 'cumulative'
+				context.update({
+					'profile': self.storage.get_meta(key),
+					'hotspots': self.storage.get_hotspots(key, limit=self.get_limit(), sort=sort),
+					'sort': sort,
+					'sort_fields': self.sort_fields,
+				})
+			except KeyError:
+				raise Http404
+		else:
+			context['profiles'] = self.storage.get_profiles()
+		return self.template_response(self.template_name, context)
@@ -1,18 +1,26 @@
+import hashlib
+import tempfile
 from datetime import date
 from datetime import datetime
 
 import django.forms as django_forms
 import time
 from django.apps import apps
-from django.http import Http404
+from django.http import Http404, StreamingHttpResponse, FileResponse, JsonResponse, HttpResponseNotModified, \
+	HttpResponse
 from django.utils.datastructures import MultiValueDict
 from django.utils.formats import date_format
+from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
 from xadmin.views import filter_hook
 from xadmin.widgets import AdminSelectWidget, AdminSelectMultiple
 
 from irpf.models import Institution, Asset, Position
 from irpf.report.base import BaseReportMonth
+from irpf.report.cache import ReportCache, report_single_flight
+from irpf.report.limits import ReportLimiter, ReportError
+from irpf.report.timing import StageTimer
+from irpf.report.export import ReportExport, ReportSerializer, iter_csv
 from irpf.utils import MonthYearDates
 from irpf.views.base import AdminFormView
 from irpf.widgets import MonthYearWidgetNavigator, MonthYearNavigatorField
@@ -62,7 +70,13 @@ class ReportIRPFFAdminView(AdminFormView):
 		super().init_request(*args, **kwargs)
 		self.model_app_label = self.kwargs['model_app_label']
 		self.reports: BaseReportMonth = None
+		self.report_cache = ReportCache()
+		self.report_single_flight = report_single_flight
+		self.report_limiter = ReportLimiter()
+		self.cancel_token = None
+		self.stats = None
 		self.ts = None
+		self.timer: StageTimer = None
 		self.model = apps.get_model(*self.model_app_label.split('.', 1))
 		if not self.admin_site.get_registry(self.model, None):
 			raise Http404
@@ -99,16 +113,13 @@ class ReportIRPFFAdminView(AdminFormView):
 		report = self.report_class(self.user, self.model, **options)
 		return report
 
-	@filter_hook
-	def report_generate(self, form):
+	def get_report_months(self, form) -> list:
+		"""Intervalos de datas (meses) do relatório"""
 		now = datetime.now().date()
 
 		form_data = form.cleaned_data
 		dates: MonthYearDates = form_data['dates']
-		institution = form_data['institution']
 		consolidation = form_data['consolidation']
-		categories = form_data['categories']
-		asset = form_data['asset']
 
 		if (_dates := self.request.GET.get('_dates')) == "next":
 			if consolidation == Position.CONSOLIDATION_YEARLY:
@@ -136,25 +147,107 @@ class ReportIRPFFAdminView(AdminFormView):
 			months = [dates.get_month_range(now)]
 		else:
 			months = []
+		return months
 
+	@filter_hook
+	def report_generate(self, form):
+		form_data = form.cleaned_data
 		reports = self.report_object()
 		reports.generate(
-			months,
-			consolidation=consolidation,
-			institution=institution,
-			categories=categories,
-			asset=asset
+			self.get_report_months(form),
+			consolidation=form_data['consolidation'],
+			institution=form_data['institution'],
+			categories=form_data['categories'],
+			asset=form_data['asset'],
+			checkpoint=self.is_report_checkpoint(form),
+			cancel_token=self.cancel_token,
+			timer=self.timer
 		)
 		return reports
 
+	def generate_reports(self, form):
+		"""Gera o relatório dentro do limite de gerações simultâneas do usuário e do prazo"""
+		with self.report_limiter.acquire(self.user) as cancel_token:
+			self.cancel_token = cancel_token
+			try:
+				return self.report_generate(form)
+			finally:
+				self.cancel_token = None
+
+	def get_report_params(self, form) -> dict:
+		"""Parâmetros que identificam o relatório (chave de cache)"""
+		form_data = form.cleaned_data
+		institution, asset = form_data['institution'], form_data['asset']
+		return {
+			'months': self.get_report_months(form),
+			'consolidation': form_data['consolidation'],
+			'institution': institution.pk if institution else None,
+			'categories': sorted(form_data['categories'] or []),
+			'asset': asset.pk if asset else None,
+		}
+
+	def is_report_cache(self, form) -> bool:
+		"""Relatórios que salvam posições ou medem o tempo são sempre gerados"""
+		if form.cleaned_data['ts']:
+			return False
+		return self.is_report_checkpoint(form)
+
+	def is_report_checkpoint(self, form) -> bool:
+		"""Reaproveita os meses salvos, exceto quando as posições estão sendo salvas (recalculo)"""
+		field = django_forms.BooleanField(required=False)
+		for params in (self.request.GET, self.request.POST):
+			try:
+				if field.to_python(params.get('position')):
+					return False
+			except django_forms.ValidationError:
+				continue
+		return True
+
+	def get_report_cache_key(self, form) -> str:
+		return self.report_cache.get_key(self.user, self.model_app_label,
+		                                 self.get_report_params(form))
+
+	def _report_generate_cached(self, form, cache_key: str) -> tuple:
+		self.reports = self.generate_reports(form)
+		return self.report_cache.set(cache_key, (self.reports, self.stats))
+
+	def get_reports(self, form):
+		"""Relatório (e estatísticas) do cache ou gerados
+		Requisições simultâneas do mesmo relatório aguardam uma única geração.
+		"""
+		cache_key = self.get_report_cache_key(form) if self.is_report_cache(form) else None
+		if cache_key is None:
+			self.reports = self.generate_reports(form)
+		elif (cached := self.report_cache.get(cache_key)) is not None:
+			self.reports, self.stats = cached
+		else:
+			self.reports, self.stats = self.report_single_flight.run(
+				cache_key,
+				lambda: self._report_generate_cached(form, cache_key),
+				lookup=lambda: self.report_cache.get(cache_key)
+			)
+		return self.reports
+
 	@filter_hook
 	def form_valid(self, form):
-		ts = time.time()
-		self.reports = self.report_generate(form)
-		if form.cleaned_data['ts']:  # tempo da operação
+		if not form.cleaned_data['ts']:
+			self.get_reports(form)
+			form.data = self.get_form_data(form, self.reports.start_date, self.reports.end_date)
+			return self.render_to_response(self.get_context_data(form=form))
+		# tempo da operação por etapa (consultas e tempo de sql)
+		self.timer = StageTimer()
+		with self.timer.activate():
+			ts = time.time()
+			self.get_reports(form)
 			self.ts = time.time() - ts
-		form.data = self.get_form_data(form, self.reports.start_date, self.reports.end_date)
-		return self.render_to_response(self.get_context_data(form=form))
+			form.data = self.get_form_data(form, self.reports.start_date, self.reports.end_date)
+			response = self.render_to_response(self.get_context_data(form=form))
+			if hasattr(response, 'render'):
+				with self.timer.stage('render'):
+					response.render()
+		response['Server-Timing'] = self.timer.get_server_timing()
+		self.timer.log(user=self.user.pk, path=self.request.path)
+		return response
 
 	@filter_hook
 	def get_form_data(self, form, start_date: date, end_date: date) -> MultiValueDict:
@@ -184,10 +277,49 @@ class ReportIRPFFAdminView(AdminFormView):
 				'start_date': self.reports.start_date,
 				'end_date': self.reports.end_date,
 				'results': results,
+				'export_urls': self.get_export_urls(),
+				'asset_url': self.get_asset_url(),
 				'ts': self.ts,
+				'timing': self.timer.as_list() if self.timer else None,
 			}
 		return context
 
+	def get_report_query_string(self) -> str:
+		"""Parâmetros do relatório (mesmo período) para as views derivadas"""
+		return self.get_query_string(new_params={
+			'dates_0': self.reports.end_date.month,
+			'dates_1': self.reports.end_date.year,
+		}, remove=['ts', '_dates', 'position', 'ticker'])
+
+	def get_asset_url(self) -> str:
+		"""Link dos detalhes de um ativo (carregados sob demanda)"""
+		return self.get_admin_url("reportirpf_asset", self.model_app_label) + self.get_report_query_string()
+
+	def get_export_urls(self) -> list:
+		"""Links de exportação dos resultados (mesmo período do relatório)"""
+		query_string = self.get_report_query_string()
+		urls = []
+		for name, title in ReportIRPFExportAdminView.export_names.items():
+			for export_format in ReportIRPFExportAdminView.export_formats:
+				url = self.get_admin_url("reportirpf_export", self.model_app_label, name, export_format)
+				urls.append({
+					'title': f"{title} ({export_format})",
+					'url': url + query_string
+				})
+		return urls
+
+	def report_error_response(self, exc: ReportError):
+		"""Resposta para o relatório interrompido ou acima do limite do usuário"""
+		self.message_user(str(exc), level='warning')
+		self.reports = self.stats = None
+		return self.render_to_response(self.get_context_data(form=self.get_form()))
+
+	def post(self, request, *args, **kwargs):
+		try:
+			return super().post(request, *args, **kwargs)
+		except ReportError as exc:
+			return self.report_error_response(exc)
+
 	def get(self, request, *args, **kwargs):
 		"""
 		Handle POST requests: instantiate a form instance with the passed
@@ -198,3 +330,187 @@ class ReportIRPFFAdminView(AdminFormView):
 		else:
 			response = super().get(request, *args, **kwargs)
 		return response
+
+
+class ReportIRPFAssetAdminView(ReportIRPFFAdminView):
+	"""Detalhes (fragmento html) de um ativo do relatório
+	O html é mantido em cache por ativo e versão dos dados do usuário.
+	"""
+	template_name = "irpf/adminx_report_irpf_item_detail.html"
+
+	def init_request(self, *args, **kwargs):
+		super().init_request(*args, **kwargs)
+		self.ticker = self.request.GET.get('ticker', '')
+		if not self.ticker:
+			raise Http404
+
+	def report_error_response(self, exc: ReportError):
+		return HttpResponse(str(exc), status=exc.status)
+
+	def get_asset(self):
+		for asset in self.reports.compile():
+			if asset and asset.ticker == self.ticker:
+				return asset
+		raise Http404
+
+	def render_asset(self, form) -> str:
+		self.get_reports(form)
+		return render_to_string(self.template_name, {
+			'asset': self.get_asset(),
+			'report': {'end_date': self.reports.end_date},
+		}, request=self.request)
+
+	def get(self, request, *args, **kwargs):
+		return self.post(request, *args, **kwargs)
+
+	def form_invalid(self, form):
+		raise Http404
+
+	def form_valid(self, form):
+		if self.is_report_cache(form):
+			cache_key = f"{self.get_report_cache_key(form)}:asset:{self.ticker}"
+			if (content := self.report_cache.get(cache_key)) is None:
+				content = self.report_cache.set(cache_key, self.render_asset(form))
+		else:
+			content = self.render_asset(form)
+		return HttpResponse(content)
+
+
+class ReportIRPFExportAdminView(ReportIRPFFAdminView):
+	"""Exportação (csv, xlsx) dos resultados do relatório sem manter o arquivo completo em memória"""
+	export_names = {
+		'assets': "Ativos",
+		'stats': "Estatísticas",
+	}
+	export_formats = ('csv', 'xlsx')
+
+	def init_request(self, *args, **kwargs):
+		super().init_request(*args, **kwargs)
+		self.export_name = self.kwargs['export_name']
+		self.export_format = self.kwargs['export_format']
+		if self.export_name not in self.export_names or self.export_format not in self.export_formats:
+			raise Http404
+
+	def report_error_response(self, exc: ReportError):
+		return HttpResponse(str(exc), status=exc.status, content_type="text/plain; charset=utf-8")
+
+	def get_export_rows(self):
+		stats_categories = self.stats.compile() if self.stats else None
+		export = ReportExport(self.reports.compile(), stats_categories)
+		if self.export_name == 'stats':
+			return export.iter_stats()
+		return export.iter_assets()
+
+	def get_export_filename(self) -> str:
+		return (f"irpf-{self.export_name}-{self.reports.start_date:%Y%m%d}-"
+		        f"{self.reports.end_date:%Y%m%d}.{self.export_format}")
+
+	def export_csv(self, rows):
+		response = StreamingHttpResponse(iter_csv(rows), content_type="text/csv; charset=utf-8")
+		response['Content-Disposition'] = f'attachment; filename="{self.get_export_filename()}"'
+		return response
+
+	def export_xlsx(self, rows):
+		from openpyxl import Workbook
+		wb = Workbook(write_only=True)
+		ws = wb.create_sheet(self.export_names[self.export_name])
+		for row in rows:
+			ws.append(row)
+		# arquivo temporário (removido ao fechar a resposta)
+		tmp = tempfile.TemporaryFile(suffix=".xlsx")
+		wb.save(tmp)
+		tmp.seek(0)
+		return FileResponse(tmp, as_attachment=True,
+		                    filename=self.get_export_filename(),
+		                    content_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+	def get(self, request, *args, **kwargs):
+		return self.post(request, *args, **kwargs)
+
+	def form_invalid(self, form):
+		raise Http404
+
+	def form_valid(self, form):
+		self.get_reports(form)
+		rows = self.get_export_rows()
+		if self.export_format == 'xlsx':
+			return self.export_xlsx(rows)
+		return self.export_csv(rows)
+
+
+class ReportIRPFApiAdminView(ReportIRPFFAdminView):
+	"""Resultados do relatório em json (esquema compacto, valores decimais como texto)
+	Parâmetros extras: fields (campos do ativo, separados por vírgula), page e page_size.
+	"""
+	serializer_class = ReportSerializer
+	page_size = 100
+	max_page_size = 1000
+
+	def get_page_params(self) -> tuple[int, int]:
+		params = self.request.GET
+		try:
+			page = max(int(params.get('page', 1)), 1)
+			page_size = int(params.get('page_size', self.page_size))
+		except ValueError:
+			page, page_size = 1, self.page_size
+		if page_size < 1 or page_size > self.max_page_size:
+			page_size = self.max_page_size
+		return page, page_size
+
+	def get_fields(self) -> list:
+		fields = self.request.GET.get('fields', '')
+		return [name.strip() for name in fields.split(',') if name.strip()]
+
+	def get_etag(self, form) -> str:
+		"""A chave de cache muda com a versão dos dados do usuário"""
+		value = f"{self.get_report_cache_key(form)}:{self.get_page_params()}:{self.get_fields()}"
+		return f'"{hashlib.sha256(value.encode()).hexdigest()}"'
+
+	def get_stats_data(self, serializer) -> dict:
+		if not self.stats:
+			return {}
+		stats_categories = self.stats.compile()
+		stats_all_results, stats_fii_results = self.stats.compile_results(stats_categories)
+		return {
+			'categories': {name: serializer.serialize_stats(stats)
+			               for name, stats in stats_categories.items()},
+			'all': serializer.serialize_stats(self.stats.compile_all(stats_categories)),
+			'results': serializer.serialize_stats(stats_all_results),
+			'results_fii': serializer.serialize_stats(stats_fii_results),
+		}
+
+	def get_data(self) -> dict:
+		serializer = self.serializer_class(self.get_fields())
+		page, page_size = self.get_page_params()
+		results = [asset for asset in self.reports.compile() if asset]
+		offset = (page - 1) * page_size
+		return {
+			'start_date': self.reports.start_date.isoformat(),
+			'end_date': self.reports.end_date.isoformat(),
+			'page': page,
+			'page_size': page_size,
+			'count': len(results),
+			'results': [serializer.serialize_asset(asset)
+			            for asset in results[offset:offset + page_size]],
+			'stats': self.get_stats_data(serializer),
+		}
+
+	def get(self, request, *args, **kwargs):
+		return self.post(request, *args, **kwargs)
+
+	def form_invalid(self, form):
+		return JsonResponse({'errors': form.errors.get_json_data()}, status=400)
+
+	def report_error_response(self, exc: ReportError):
+		return JsonResponse({'error': str(exc)}, status=exc.status)
+
+	def form_valid(self, form):
+		etag = self.get_etag(form) if self.is_report_cache(form) else None
+		if etag and etag in self.request.headers.get('If-None-Match', ''):
+			response = HttpResponseNotModified()
+		else:
+			self.get_reports(form)
+			response = JsonResponse(self.get_data())
+		if etag:
+			response['ETag'] = etag
+		return response
@@ -1,11 +1,18 @@
+import hashlib
+import io
 import json
+import os
+import sqlite3
+import tempfile
+from contextlib import closing
+from pathlib import Path
 
 from xadmin.util import vendor, xstatic
+from xadmin.views import BaseAdminView
 from xadmin.widgets import AdminFileWidget
 import django.forms as django_forms
 from django.conf import settings
-from openpyxl.reader.excel import load_workbook
-import collections
+from django.http import Http404, JsonResponse, HttpResponseBadRequest
 from irpf.views.base import AdminFormView
 
 
@@ -15,6 +22,122 @@ class XLSXViewerForm(django_forms.Form):
 	                                    widget=AdminFileWidget)
 
 
+class XlsxSheetCache:
+	"""Cache local (sqlite) das linhas das planilhas de um usuário
+	Indexado pelo hash (sha256) do conteúdo do arquivo.
+	"""
+	max_files = 20
+	chunk_size = 1000
+
+	def __init__(self, user, path=None):
+		if path is None:
+			path = settings.IRPF_XLSX_VIEWER_CACHE_DIR
+		self.path = Path(path) / str(user.pk)
+
+	def get_filename(self, key: str) -> Path:
+		return self.path / f"{key}.sqlite3"
+
+	def exists(self, key: str) -> bool:
+		return self.get_filename(key).exists()
+
+	def connect(self, key: str):
+		return sqlite3.connect(f"{self.get_filename(key).as_uri()}?mode=ro", uri=True)
+
+	@staticmethod
+	def _get_value(value):
+		# números mantidos (ordenação numérica), o resto como texto
+		if value is None or isinstance(value, (int, float)):
+			return value
+		return str(value)
+
+	def _store_sheet(self, conn, index: int, ws):
+		rows = ws.iter_rows(values_only=True)
+		headers = ['' if value is None else str(value) for value in next(rows, ())]
+		if not headers:
+			return
+		columns = len(headers)
+		conn.execute("INSERT INTO sheets (id, title, headers) VALUES (?, ?, ?)",
+		             (index, ws.title, json.dumps(headers)))
+		conn.execute(f"CREATE TABLE sheet_{index} ({', '.join(f'c{i}' for i in range(columns))})")
+		conn.executemany(
+			f"INSERT INTO sheet_{index} VALUES ({', '.join('?' * columns)})",
+			(tuple(self._get_value(value) for value in (row + (None,) * columns)[:columns])
+			 for row in rows)
+		)
+
+	def store(self, file) -> str:
+		"""Guarda as linhas do arquivo (quando ainda não estão no cache) e retorna a chave"""
+		content = file.read()
+		key = hashlib.sha256(content).hexdigest()
+		filename = self.get_filename(key)
+		if filename.exists():
+			os.utime(filename)
+			return key
+		from openpyxl.reader.excel import load_workbook
+		self.path.mkdir(parents=True, exist_ok=True)
+		fd, tmp_filename = tempfile.mkstemp(suffix=".tmp", dir=self.path)
+		os.close(fd)
+		try:
+			wb = load_workbook(filename=io.BytesIO(content), read_only=True, data_only=True)
+			try:
+				with closing(sqlite3.connect(tmp_filename)) as conn:
+					conn.execute("CREATE TABLE sheets (id INTEGER PRIMARY KEY, title TEXT, headers TEXT)")
+					for index, sheet_name in enumerate(wb.sheetnames):
+						self._store_sheet(conn, index, wb[sheet_name])
+					conn.commit()
+			finally:
+				wb.close()
+			os.replace(tmp_filename, filename)
+		finally:
+			if os.path.exists(tmp_filename):
+				os.remove(tmp_filename)
+		self.prune()
+		return key
+
+	def prune(self):
+		"""Remove os arquivos mais antigos acima do limite"""
+		filenames = sorted(self.path.glob("*.sqlite3"), key=lambda f: f.stat().st_mtime, reverse=True)
+		for filename in filenames[self.max_files:]:
+			filename.unlink(missing_ok=True)
+
+	def get_sheets(self, key: str) -> list[dict]:
+		with closing(self.connect(key)) as conn:
+			return [{'index': index, 'title': title, 'headers': json.loads(headers)}
+			        for index, title, headers in conn.execute("SELECT id, title, headers FROM sheets ORDER BY id")]
+
+	def query(self, key: str, sheet: int, start: int = 0, length: int = 10, search: str = '',
+	          order_column: int = None, order_dir: str = 'asc') -> dict:
+		"""Página de linhas da planilha (filtro, ordenação e paginação feitos pelo sqlite)"""
+		with closing(self.connect(key)) as conn:
+			row = conn.execute("SELECT headers FROM sheets WHERE id = ?", (sheet,)).fetchone()
+			if row is None:
+				raise KeyError(sheet)
+			columns = [f"c{i}" for i in range(len(json.loads(row[0])))]
+			table = f"sheet_{sheet}"
+			where, params = '', []
+			if search:
+				search = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+				where = "WHERE " + " OR ".join(f"CAST({column} AS TEXT) LIKE ? ESCAPE '\\'"
+				                               for column in columns)
+				params = [f"%{search}%"] * len(columns)
+			order = ''
+			if order_column is not None and 0 <= order_column < len(columns):
+				order = f"ORDER BY {columns[order_column]} {'DESC' if order_dir == 'desc' else 'ASC'}"
+			total = conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+			if where:
+				filtered = conn.execute(f"SELECT COUNT(*) FROM {table} {where}", params).fetchone()[0]
+			else:
+				filtered = total
+			rows = conn.execute(f"SELECT {', '.join(columns)} FROM {table} {where} {order} LIMIT ? OFFSET ?",
+			                    params + [length, start])
+			data = [['-' if value is None else str(value) for value in row] for row in rows]
+		return {
+			'recordsTotal': total,
+			'recordsFiltered': filtered,
+			'data': data
+		}
+
+
 class AdminXlsxViewer(AdminFormView):
 	"""Visualizador de dados de um arquivo Excel (xlsx)"""
 	template_name = "irpf/adminx_report_irpf_viewer.html"
@@ -23,48 +146,13 @@ class AdminXlsxViewer(AdminFormView):
 
 	title = "Visualizador de arquivos Excel"
 
-	def process_sheet(self, ws):
-		if settings.DEBUG:
-			print("SHEET ", ws.title)
-		data = collections.OrderedDict()
-
-		rows = ws.iter_rows()
-
-		headers = []
-		for cell in next(rows):
-			headers.append(cell.value)
-
-		data['title'] = ws.title
-		data['headers'] = headers
-		items = []
-
-		if settings.DEBUG:
-			print(" / ".join(headers))
-
-		for row in rows:
-			cells = []
-			for index, cell in enumerate(row):
-				cells.append('-' if cell.value is None else str(cell.value))
-
-			items.append(cells)
-			if settings.DEBUG:
-				print(" / ".join(cells))
-
-		data['items'] = json.dumps(items)
-		return data
-
 	def file_handle(self, file):
-		wb = None
-		sheets = []
+		cache = XlsxSheetCache(self.user)
 		with file:
-			try:
-				wb = load_workbook(filename=file, data_only=True)
-				for sheet_name in wb.sheetnames:
-					sheet_item = self.process_sheet(wb[sheet_name])
-					sheets.append(sheet_item)
-			finally:
-				if wb:
-					wb.close()
+			key = cache.store(file)
+		sheets = cache.get_sheets(key)
+		for sheet in sheets:
+			sheet['url'] = self.get_admin_url("xlsx_viewer_data", key, sheet['index'])
 		return sheets
 
 	def get_context(self):
@@ -93,3 +181,40 @@ class AdminXlsxViewer(AdminFormView):
 		context['sheets'] = sheets
 
 		return self.render_to_response(context)
+
+
+class AdminXlsxViewerData(BaseAdminView):
+	"""Dados de uma planilha em cache (DataTables - processamento no servidor)"""
+	max_page_length = 1000
+
+	def init_request(self, *args, **kwargs):
+		super().init_request(*args, **kwargs)
+		self.key = self.kwargs['key']
+		self.sheet = int(self.kwargs['sheet'])
+		self.cache = XlsxSheetCache(self.user)
+		if not self.cache.exists(self.key):
+			raise Http404
+
+	def get(self, request, *args, **kwargs):
+		params = request.GET
+		try:
+			draw = int(params.get('draw', 0))
+			start = max(int(params.get('start', 0)), 0)
+			length = int(params.get('length', 10))
+			order_column = params.get('order[0][column]')
+			order_column = None if order_column is None else int(order_column)
+		except ValueError:
+			return HttpResponseBadRequest()
+		if length < 0 or length > self.max_page_length:
+			length = self.max_page_length
+		try:
+			data = self.cache.query(self.key, self.sheet,
+			                        start=start,
+			                        length=length,
+			                        search=params.get('search[value]', ''),
+			                        order_column=order_column,
+			                        order_dir=params.get('order[0][dir]', 'asc'))
+		except KeyError:
+			raise Http404
+		data['draw'] = draw
+		return JsonResponse(data)
@@ -74,3 +74,30 @@ class MonthYearField(django_forms.MultiValueField):
 class MonthYearNavigatorField(MonthYearField):
 	"""Inclui botões de navegação datas passadas e futuras"""
 	widget = MonthYearWidgetNavigator
+
+
+class MultipleFileInput(django_forms.ClearableFileInput):
+	"""Seleção de vários arquivos no mesmo campo"""
+	allow_multiple_selected = True
+
+	def value_from_datadict(self, data, files, name):
+		if hasattr(files, "getlist"):
+			return files.getlist(name)
+		return files.get(name)
+
+
+class MultipleFileField(django_forms.FileField):
+	"""Campo de arquivo que retorna a lista de arquivos do 'MultipleFileInput'"""
+
+	def __init__(self, *args, **kwargs):
+		kwargs.setdefault("widget", MultipleFileInput())
+		super().__init__(*args, **kwargs)
+
+	def clean(self, data, initial=None):
+		if not isinstance(data, (list, tuple)):
+			data = [data] if data else []
+		clean = super().clean
+		if not data:
+			clean(None, initial)  # campo obrigatório
+			return []
+		return [clean(item, initial) for item in data]